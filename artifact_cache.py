@@ -0,0 +1,176 @@
+"""Content-fingerprinted manifest of the artifacts built by prepare_custom_data.
+
+Every artifact (vocabulary, token-ids file) is recorded in
+<working_directory>/prepare_manifest.json together with the content hashes
+of the files it was built from, the parameters it was built with and the
+size/mtime of the files it consists of. An artifact is rebuilt only when
+one of these changed. Artifacts are built under temporary names and renamed
+into place, and the whole preparation runs under an exclusive lock on the
+working directory, so concurrent jobs never see or write half-built files.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import threading
+
+try:
+  import fcntl
+except ImportError:  # Windows
+  fcntl = None
+  import msvcrt
+
+MANIFEST_NAME = "prepare_manifest.json"
+LOCK_NAME = ".prepare.lock"
+_MANIFEST_VERSION = 1
+_HASH_BLOCK_BYTES = 1 << 20
+
+
+def _stat(path):
+  st = os.stat(path)
+  return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _sha256(path):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(_HASH_BLOCK_BYTES), b""):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def _params_key(params):
+  return json.dumps(params, sort_keys=True)
+
+
+class ArtifactCache(object):
+  """Decides which artifacts of a working directory must be rebuilt.
+
+  Use as a context manager: entering takes the working directory lock and
+  loads the manifest, leaving saves the manifest and releases the lock.
+  """
+
+  def __init__(self, working_directory):
+    self.working_directory = working_directory
+    self.manifest_path = os.path.join(working_directory, MANIFEST_NAME)
+    self._lock_path = os.path.join(working_directory, LOCK_NAME)
+    self._lock_file = None
+    self._mutex = threading.Lock()
+    self._manifest = None
+
+  def __enter__(self):
+    if not os.path.isdir(self.working_directory):
+      os.makedirs(self.working_directory)
+    self._lock_file = open(self._lock_path, "a+")
+    if fcntl is not None:
+      fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+    else:
+      self._lock_file.seek(0)
+      msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_LOCK, 1)
+    self._manifest = self._load()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      self._save()
+    finally:
+      if fcntl is not None:
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+      else:
+        self._lock_file.seek(0)
+        msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+      self._lock_file.close()
+      self._lock_file = None
+
+  def _load(self):
+    if os.path.exists(self.manifest_path):
+      with open(self.manifest_path) as f:
+        manifest = json.load(f)
+      if manifest.get("version") == _MANIFEST_VERSION:
+        return manifest
+    return {"version": _MANIFEST_VERSION, "files": {}, "artifacts": {}}
+
+  def _save(self):
+    tmp_path = self.temp_path(self.manifest_path)
+    with open(tmp_path, "w") as f:
+      json.dump(self._manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, self.manifest_path)
+
+  def fingerprint(self, path):
+    """Returns the sha256 of a file's content.
+
+    The hash is only recomputed when the file's size or mtime differ from
+    the ones recorded alongside the last computed hash.
+    """
+    path = os.path.abspath(path)
+    stat = _stat(path)
+    with self._mutex:
+      known = self._manifest["files"].get(path)
+    if known and known["size"] == stat["size"] and (
+        known["mtime_ns"] == stat["mtime_ns"]):
+      return known["sha256"]
+    digest = _sha256(path)
+    stat["sha256"] = digest
+    with self._mutex:
+      self._manifest["files"][path] = stat
+    return digest
+
+  def fingerprints(self, paths):
+    """Returns a dict mapping the absolute paths to their fingerprints."""
+    return dict((os.path.abspath(path), self.fingerprint(path))
+                for path in paths)
+
+  def is_fresh(self, artifact, inputs, params, outputs):
+    """True if `artifact` was built from the current inputs and params.
+
+    Args:
+      artifact: path identifying the artifact.
+      inputs: fingerprints of the files the artifact is built from, as
+        returned by fingerprints().
+      params: JSON-serializable dict of the build parameters.
+      outputs: paths of the files making up the artifact.
+    """
+    artifact = os.path.abspath(artifact)
+    with self._mutex:
+      entry = self._manifest["artifacts"].get(artifact)
+    if entry is None:
+      return False
+    if entry["params"] != _params_key(params):
+      print("  %s is stale: build parameters changed" % artifact)
+      return False
+    for path in outputs:
+      path = os.path.abspath(path)
+      if not os.path.exists(path) or entry["outputs"].get(path) != _stat(path):
+        print("  %s is stale: %s is missing or was modified" % (artifact, path))
+        return False
+    for path, digest in inputs.items():
+      if entry["inputs"].get(path) != digest:
+        print("  %s is stale: %s changed" % (artifact, path))
+        return False
+    return True
+
+  def temp_path(self, path):
+    """Returns a process and thread unique name to build `path` under."""
+    return "%s.tmp%d.%d" % (path, os.getpid(), threading.current_thread().ident)
+
+  def commit(self, artifact, inputs, params, renames):
+    """Moves freshly built files into place and records the artifact.
+
+    Args:
+      artifact: path identifying the artifact.
+      inputs: fingerprints of the files the artifact was built from, taken
+        before the build started.
+      params: JSON-serializable dict of the build parameters.
+      renames: list of (temporary path, final path) pairs making up the
+        artifact, renamed in this order.
+    """
+    for tmp_path, path in renames:
+      os.replace(tmp_path, path)
+    outputs = dict((os.path.abspath(path), _stat(path))
+                   for _, path in renames)
+    with self._mutex:
+      self._manifest["artifacts"][os.path.abspath(artifact)] = {
+          "inputs": inputs, "params": _params_key(params), "outputs": outputs}
@@ -0,0 +1,165 @@
+"""Prepares training batches in background threads.
+
+Assembling a batch (gathering its pairs, padding and transposing them)
+would otherwise run between two session runs. BatchPrefetcher runs it in
+worker threads that keep a bounded queue of batches ahead of the train
+loop; Session.run releases the GIL, so the workers fill the queue while the
+current step executes. The batches are returned in the order the sampler
+drew them, whatever worker finished first.
+
+InputFeeder goes one step further for models with input queues: it
+enqueues the batches into the graph, so the train loop only runs the steps.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+import time
+
+from six.moves import queue
+
+
+class BatchPrefetcher(object):
+  """Queue of batches drawn by a sampler and filled by worker threads.
+
+  With num_workers = 0 there are no threads: get() draws and assembles the
+  batch itself, like the train loop used to.
+  """
+
+  def __init__(self, batch_fn, sampler, queue_depth=4, num_workers=1):
+    """Create the prefetcher and start its workers.
+
+    Args:
+      batch_fn: function returning the batch of a bucket id and pair
+        indices, e.g. functools.partial(model.get_batch, train_set). It is
+        called from several threads at once.
+      sampler: bucket_sampler.EpochBucketSampler drawing the batches; it is
+        only used by the prefetcher from now on.
+      queue_depth: number of batches prepared ahead of the train loop.
+      num_workers: number of worker threads.
+    """
+    self.batch_fn = batch_fn
+    self.sampler = sampler
+    # Sampler state after the batch last returned by get().
+    self.state = sampler.state()
+    self._batches = queue.Queue(max(queue_depth, 1))
+    self._stop = threading.Event()
+    self._sampler_lock = threading.Lock()
+    self._drawn = 0
+    self._returned = 0
+    self._ready = {}
+    self._workers = []
+    for _ in range(num_workers):
+      worker = threading.Thread(target=self._work)
+      worker.daemon = True
+      worker.start()
+      self._workers.append(worker)
+
+  def _next(self):
+    with self._sampler_lock:
+      number = self._drawn
+      bucket_id, indices = self.sampler.next()
+      state = self.sampler.state()
+      self._drawn += 1
+    return number, bucket_id, self.batch_fn(bucket_id, indices), state
+
+  def _work(self):
+    try:
+      while not self._stop.is_set():
+        self._put(self._next())
+    except Exception as e:  # Re-raised in the consumer.
+      self._put(e)
+
+  def _put(self, item):
+    while not self._stop.is_set():
+      try:
+        self._batches.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def get(self):
+    """Returns (bucket_id, batch, seconds spent waiting for the batch)."""
+    start_time = time.time()
+    if not self._workers:
+      item = self._next()
+    else:
+      # Batches finished out of order wait in _ready for their turn.
+      while self._returned not in self._ready:
+        item = self._batches.get()
+        if isinstance(item, Exception):
+          raise item
+        self._ready[item[0]] = item
+      item = self._ready.pop(self._returned)
+    self._returned += 1
+    _, bucket_id, batch, self.state = item
+    return bucket_id, batch, time.time() - start_time
+
+  def close(self):
+    """Stops the workers."""
+    self._stop.set()
+    for worker in self._workers:
+      worker.join()
+    self._workers = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class InputFeeder(object):
+  """Moves the batches of a BatchPrefetcher into the model's input queues.
+
+  A feeder thread enqueues every batch to the queue of its bucket and then
+  announces its bucket id; the train loop takes the ids in the same order,
+  so the batch a queued step dequeues is the one announced.
+  """
+
+  def __init__(self, prefetcher, enqueue_fn):
+    """Create the feeder and start its thread.
+
+    Args:
+      prefetcher: BatchPrefetcher the batches are taken from.
+      enqueue_fn: function enqueuing a batch, called as
+        enqueue_fn(bucket_id, *batch), e.g. functools.partial(model.enqueue,
+        session).
+    """
+    self.prefetcher = prefetcher
+    self.enqueue_fn = enqueue_fn
+    # Sampler state after the batch last returned by get().
+    self.state = prefetcher.state
+    self._enqueued = queue.Queue()
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._feed)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _feed(self):
+    try:
+      while not self._stop.is_set():
+        bucket_id, batch, _ = self.prefetcher.get()
+        self.enqueue_fn(bucket_id, *batch)
+        self._enqueued.put((bucket_id, self.prefetcher.state))
+    except Exception as e:  # Re-raised in the consumer.
+      self._enqueued.put(e)
+
+  def get(self):
+    """Returns (bucket_id, seconds spent waiting) of the next queued batch."""
+    start_time = time.time()
+    item = self._enqueued.get()
+    if isinstance(item, Exception):
+      raise item
+    bucket_id, self.state = item
+    return bucket_id, time.time() - start_time
+
+  def close(self):
+    """Stops feeding.
+
+    A feeder blocked on a full input queue stays blocked until the queue is
+    closed or the process exits; the thread is a daemon.
+    """
+    self._stop.set()
+    self.prefetcher.close()
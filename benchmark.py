@@ -0,0 +1,1257 @@
+"""Throughput benchmarks for the data pipeline and the model.
+
+Every benchmark compares a new code path against the implementation it
+replaces on the same input and checks that both produce the same result.
+
+Usage:
+  python benchmark.py tokenizer --data dataset/article.txt
+  python benchmark.py vocabulary --copies 20 [--max_memory_mb 64]
+  python benchmark.py prepare --copies 20
+  python benchmark.py vocabulary_update --copies 20
+  python benchmark.py vocabulary_load --vocab working_dir/vocab80000_enc.txt
+  python benchmark.py bpe --merges 16000 --model
+  python benchmark.py read_data --copies 20
+  python benchmark.py buckets --num_buckets 5
+  python benchmark.py get_batch --batch_sizes 64,128,256,512,1024
+  python benchmark.py input_pipeline --steps 50
+  python benchmark.py model_graph --num_buckets 5,20
+  python benchmark.py cold_start --config seq2seq.ini
+  python benchmark.py data_parallel --workers 1,2,4
+  python benchmark.py quantization --config seq2seq.ini --lines 400
+  python benchmark.py shortlist --sizes 0,2000,5000
+  python benchmark.py losses --seconds 600
+  python benchmark.py checkpoint --saves 5
+  python benchmark.py distillation --config seq2seq.ini --lines 400
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import configparser
+import functools
+import hashlib
+import multiprocessing
+import random
+import os
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import batch_prefetcher
+import bucket_planner
+import bucket_sampler
+import data_utils
+import token_corpus
+import token_counts
+import vocabulary
+
+# Default buckets of execute.py, which cannot be imported without TensorFlow.
+_BUCKETS = [(30, 10), (30, 20), (40, 10), (40, 20), (50, 20)]
+
+
+def _best_time(fn, repeat):
+  """Runs fn() `repeat` times, returns (best wall time, last result)."""
+  best, result = float("inf"), None
+  for _ in range(repeat):
+    start_time = time.time()
+    result = fn()
+    best = min(best, time.time() - start_time)
+  return best, result
+
+
+def _read_lines(path, copies):
+  with open(path) as f:
+    return f.readlines() * copies
+
+
+# Reference tokenizer: the per-fragment / per-token implementation that
+# data_utils.BatchTokenizer replaces.
+_LEGACY_WORD_SPLIT = re.compile("([.,!?\"':;)(])")
+_LEGACY_DIGIT_RE = re.compile(r"\d")
+
+
+def _legacy_basic_tokenizer(sentence):
+  words = []
+  for space_separated_fragment in sentence.strip().split():
+    words.extend(re.split(_LEGACY_WORD_SPLIT, space_separated_fragment))
+  return [w for w in words if w]
+
+
+def _legacy_sentence_to_token_ids(sentence, vocabulary):
+  words = _legacy_basic_tokenizer(sentence)
+  return [vocabulary.get(re.sub(_LEGACY_DIGIT_RE, "0", w), data_utils.UNK_ID)
+          for w in words]
+
+
+def bench_tokenizer(args):
+  lines = _read_lines(args.data, args.copies)
+  vocab = {}
+  for line in lines:
+    for w in _legacy_basic_tokenizer(line):
+      word = re.sub(_LEGACY_DIGIT_RE, "0", w)
+      if word not in vocab and len(vocab) < args.vocab_size:
+        vocab[word] = len(vocab)
+
+  legacy_time, legacy_ids = _best_time(
+      lambda: [_legacy_sentence_to_token_ids(l, vocab) for l in lines],
+      args.repeat)
+  engine = data_utils.BatchTokenizer(vocab)
+  engine_time, engine_ids = _best_time(
+      lambda: engine.encode_batch(lines), args.repeat)
+  if legacy_ids != engine_ids:
+    raise AssertionError("BatchTokenizer ids differ from the legacy path.")
+
+  print("tokenizer: %d lines, vocabulary %d" % (len(lines), len(vocab)))
+  print("  legacy sentence_to_token_ids : %10.0f lines/s"
+        % (len(lines) / legacy_time))
+  print("  BatchTokenizer.encode_batch  : %10.0f lines/s"
+        % (len(lines) / engine_time))
+  print("  speedup %.2fx, ids identical" % (legacy_time / engine_time))
+
+
+def bench_vocabulary(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    data_path = os.path.join(scratch, "data.txt")
+    with open(data_path, "w") as f:
+      f.writelines(_read_lines(args.data, args.copies))
+    workers = [1] + [n for n in (2, 4, 8, 16, 32)
+                     if n <= multiprocessing.cpu_count()]
+    reference, serial_time = None, None
+    print("create_vocabulary: %s x%d, max size %d, counts memory limit %s"
+          % (args.data, args.copies, args.vocab_size,
+             "%d MB" % args.max_memory_mb if args.max_memory_mb else "none"))
+    for num_workers in workers:
+      vocab_path = os.path.join(scratch, "vocab%d.txt" % num_workers)
+
+      def build():
+        if os.path.exists(vocab_path):
+          os.remove(vocab_path)
+        data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size,
+                                     num_workers=num_workers,
+                                     max_memory_mb=args.max_memory_mb)
+        with open(vocab_path, "rb") as f:
+          return f.read()
+      elapsed, vocab = _best_time(build, args.repeat)
+      if reference is None:
+        reference, serial_time = vocab, elapsed
+      elif vocab != reference:
+        raise AssertionError("Vocabulary built with %d workers differs from "
+                             "the single process one." % num_workers)
+      print("  %2d workers: %7.2fs  speedup %.2fx"
+            % (num_workers, elapsed, serial_time / elapsed))
+    print("  vocabulary files identical for every worker count")
+  finally:
+    shutil.rmtree(scratch)
+
+
+def bench_prepare(args):
+  workers = [1] + [n for n in (2, 4, 8, 16, 32)
+                   if n <= multiprocessing.cpu_count()]
+  print("prepare_custom_data: x%d copies, %s corpus"
+        % (args.copies, args.corpus_format))
+  reference, serial_time = None, None
+  for num_workers in workers:
+    scratch = tempfile.mkdtemp()
+    try:
+      paths = []
+      for name, source in (("enc.txt", args.enc), ("dec.txt", args.dec)):
+        paths.append(os.path.join(scratch, name))
+        with open(paths[-1], "w") as f:
+          f.writelines(_read_lines(source, args.copies))
+      start_time = time.time()
+      outputs = data_utils.prepare_custom_data(
+          scratch, paths[0], paths[1], paths[0], paths[1], args.vocab_size,
+          args.vocab_size, num_workers=num_workers,
+          corpus_format=args.corpus_format)
+      elapsed = time.time() - start_time
+      contents = []
+      for path in outputs:
+        for suffix in ("", ".tokens", ".offsets"):
+          if os.path.exists(path + suffix):
+            with open(path + suffix, "rb") as f:
+              contents.append(f.read())
+    finally:
+      shutil.rmtree(scratch)
+    if reference is None:
+      reference, serial_time = contents, elapsed
+    elif contents != reference:
+      raise AssertionError("Output prepared with %d workers differs from the "
+                           "single process one." % num_workers)
+    print("  %2d workers: %7.2fs  speedup %.2fx"
+          % (num_workers, elapsed, serial_time / elapsed))
+  print("  prepared files identical for every worker count")
+
+
+def bench_vocabulary_update(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    data_path = os.path.join(scratch, "data.txt")
+    lines = _read_lines(args.data, args.copies)
+    appended = lines[len(lines) - len(lines) // args.copies:]
+    with open(data_path, "w") as f:
+      f.writelines(lines[:len(lines) - len(appended)])
+    previous_path = os.path.join(scratch, "previous.txt")
+    data_utils.create_vocabulary(previous_path, data_path, args.vocab_size)
+    with open(data_path, "a") as f:
+      f.writelines(appended)
+
+    def build(name, previous):
+      vocab_path = os.path.join(scratch, name)
+      if os.path.exists(vocab_path):
+        os.remove(vocab_path)
+      data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size,
+                                   previous_vocabulary=previous)
+      with open(vocab_path, "rb") as f:
+        return f.read()
+    full_time, full = _best_time(lambda: build("full.txt", None), args.repeat)
+    update_time, updated = _best_time(
+        lambda: build("updated.txt", previous_path), args.repeat)
+    if updated != full:
+      raise AssertionError("Updated vocabulary differs from the recount.")
+
+    print("vocabulary update: %s x%d, 1 copy appended"
+          % (args.data, args.copies))
+    print("  full recount        : %7.2fs" % full_time)
+    print("  merge appended data : %7.2fs  speedup %.2fx"
+          % (update_time, full_time / update_time))
+    print("  vocabulary files identical")
+  finally:
+    shutil.rmtree(scratch)
+
+
+def bench_vocabulary_load(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    vocab_path = os.path.join(scratch, "vocab.txt")
+    if args.vocab:
+      shutil.copy(args.vocab, vocab_path)
+    else:
+      data_path = os.path.join(scratch, "data.txt")
+      with open(data_path, "w") as f:
+        f.writelines(_read_lines(args.data, 1))
+      data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size)
+    vocabulary.build_index(vocab_path)
+
+    def measure(load):
+      tracemalloc.start()
+      elapsed, result = _best_time(load, args.repeat)
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      return elapsed, peak, result
+    dict_time, dict_memory, (vocab, rev_vocab) = measure(
+        lambda: data_utils.initialize_vocabulary(vocab_path))
+    mmap_time, mmap_memory, compact = measure(
+        lambda: vocabulary.Vocabulary.load(vocab_path))
+
+    lines = _read_lines(args.data, 1)
+    expected = data_utils.BatchTokenizer(vocab).encode_batch(lines)
+    if [ids.tolist() for ids in compact.encode(lines)] != expected:
+      raise AssertionError("Vocabulary.encode differs from the dict lookup.")
+    if compact.decode(list(range(len(rev_vocab)))) != rev_vocab:
+      raise AssertionError("Vocabulary.decode differs from rev_vocab.")
+
+    print("vocabulary load: %d words" % len(rev_vocab))
+    print("  initialize_vocabulary : %8.2f ms, %8.2f MB Python heap"
+          % (dict_time * 1e3, dict_memory / 2.0**20))
+    print("  Vocabulary.load       : %8.2f ms, %8.2f MB Python heap "
+          "(index memory-mapped)" % (mmap_time * 1e3, mmap_memory / 2.0**20))
+    print("  encode/decode identical to the dict lookup")
+  finally:
+    shutil.rmtree(scratch)
+
+
+# Reference loader: the nested-list execute.read_data that
+# token_corpus.read_text_pairs replaces.
+def _legacy_read_data(source_path, target_path, buckets, max_size=None):
+  data_set = [[] for _ in buckets]
+  with open(source_path) as source_file:
+    with open(target_path) as target_file:
+      source, target = source_file.readline(), target_file.readline()
+      counter = 0
+      while source and target and (not max_size or counter < max_size):
+        counter += 1
+        source_ids = [int(x) for x in source.split()]
+        target_ids = [int(x) for x in target.split()]
+        target_ids.append(data_utils.EOS_ID)
+        for bucket_id, (source_size, target_size) in enumerate(buckets):
+          if len(source_ids) < source_size and len(target_ids) < target_size:
+            data_set[bucket_id].append([source_ids, target_ids])
+            break
+        source, target = source_file.readline(), target_file.readline()
+  return data_set
+
+
+def _resident_bytes():
+  """Current RSS of this process (Linux only)."""
+  with open("/proc/self/statm") as f:
+    return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _measure_load(loader, args, results):
+  """Child process: loads the data, reports time, RSS growth and a digest."""
+  resident_before = _resident_bytes()
+  peak_before = token_counts.peak_rss_bytes()
+  start_time = time.time()
+  data_set = loader(*args)
+  elapsed = time.time() - start_time
+  rss_growth = (token_counts.peak_rss_bytes() - peak_before,
+                _resident_bytes() - resident_before)
+  digest = hashlib.sha1()
+  for bucket in data_set:
+    digest.update(repr([bucket[i] for i in range(len(bucket))]).encode())
+  results.put((elapsed, rss_growth, [len(b) for b in data_set],
+               digest.hexdigest()))
+
+
+def bench_read_data(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    paths = []
+    for name, source in (("enc", args.enc), ("dec", args.dec)):
+      data_path = os.path.join(scratch, name + ".txt")
+      with open(data_path, "w") as f:
+        f.writelines(_read_lines(source, args.copies))
+      vocab_path = os.path.join(scratch, name + "_vocab.txt")
+      data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size)
+      paths.append(data_path + ".ids")
+      data_utils.data_to_token_ids(data_path, paths[-1], vocab_path)
+
+    print("read_data: %s x%d" % (args.enc, args.copies))
+    reference = None
+    for name, loader in (("nested lists (legacy)", _legacy_read_data),
+                         ("flat arrays + offsets",
+                          functools.partial(token_corpus.read_text_pairs,
+                                            target_suffix=[data_utils.EOS_ID]))):
+      # A fresh process per loader, so the RSS growth is its own.
+      results = multiprocessing.Queue()
+      process = multiprocessing.Process(
+          target=_measure_load,
+          args=(loader, (paths[0], paths[1], _BUCKETS, args.max_size),
+                results))
+      process.start()
+      elapsed, rss_growth, sizes, digest = results.get()
+      process.join()
+      if reference is None:
+        reference = (sizes, digest)
+      elif (sizes, digest) != reference:
+        raise AssertionError("Buckets differ from the legacy read_data.")
+      print("  %-22s: %7.2fs, peak RSS +%7.1f MB, RSS after load +%7.1f MB"
+            % (name, elapsed, rss_growth[0] / 2.0**20,
+               rss_growth[1] / 2.0**20))
+    print("  bucket sizes %s, pairs identical" % (reference[0],))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def bench_buckets(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    lengths = []
+    for name, source in (("enc", args.enc), ("dec", args.dec)):
+      data_path = os.path.join(scratch, name + ".txt")
+      with open(data_path, "w") as f:
+        f.writelines(_read_lines(source, 1))
+      vocab_path = os.path.join(scratch, name + "_vocab.txt")
+      data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size)
+      data_utils.data_to_token_ids(data_path, data_path + ".ids", vocab_path)
+      lengths.append(token_corpus.line_lengths(data_path + ".ids"))
+    num_lines = min(len(lengths[0]), len(lengths[1]))
+    source_lengths = lengths[0][:num_lines]
+    target_lengths = lengths[1][:num_lines] + 1  # EOS_ID
+
+    print("buckets: %s, %d pairs" % (args.enc, num_lines))
+    elapsed, planned = _best_time(
+        lambda: bucket_planner.plan_buckets(
+            source_lengths, target_lengths, args.num_buckets, args.coverage),
+        args.repeat)
+    for name, buckets in (("default %s" % _BUCKETS, _BUCKETS),
+                          ("planned %s (%.2fs)" % (planned, elapsed),
+                           planned)):
+      print(" ", name)
+      print(bucket_planner.format_report(
+          *bucket_planner.bucket_report(source_lengths, target_lengths,
+                                        buckets)))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def _legacy_get_batch(bucket, indices, encoder_size, decoder_size):
+  """Seq2SeqModel.get_batch before time_major_batch, drawing `indices`."""
+  batch_size = len(indices)
+  encoder_inputs, decoder_inputs = [], []
+  for index in indices:
+    encoder_input, decoder_input = bucket[index]
+    encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
+    encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
+    decoder_pad_size = decoder_size - len(decoder_input) - 1
+    decoder_inputs.append([data_utils.GO_ID] + decoder_input +
+                          [data_utils.PAD_ID] * decoder_pad_size)
+  batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
+  for length_idx in range(encoder_size):
+    batch_encoder_inputs.append(
+        np.array([encoder_inputs[batch_idx][length_idx]
+                  for batch_idx in range(batch_size)], dtype=np.int32))
+  for length_idx in range(decoder_size):
+    batch_decoder_inputs.append(
+        np.array([decoder_inputs[batch_idx][length_idx]
+                  for batch_idx in range(batch_size)], dtype=np.int32))
+    batch_weight = np.ones(batch_size, dtype=np.float32)
+    for batch_idx in range(batch_size):
+      if length_idx < decoder_size - 1:
+        target = decoder_inputs[batch_idx][length_idx + 1]
+      if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
+        batch_weight[batch_idx] = 0.0
+    batch_weights.append(batch_weight)
+  return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+
+
+def _token_ids(args, scratch):
+  """Tokenizes args.enc and args.dec in scratch, returns the ids paths."""
+  paths = []
+  for name, source in (("enc", args.enc), ("dec", args.dec)):
+    data_path = os.path.join(scratch, name + ".txt")
+    with open(data_path, "w") as f:
+      f.writelines(_read_lines(source, 1))
+    vocab_path = os.path.join(scratch, name + "_vocab.txt")
+    data_utils.create_vocabulary(vocab_path, data_path, args.vocab_size)
+    paths.append(data_path + ".ids")
+    data_utils.data_to_token_ids(data_path, paths[-1], vocab_path)
+  return paths
+
+
+def _bucketed_pairs(args, scratch):
+  """Tokenizes args.enc and args.dec in scratch and reads them in buckets."""
+  paths = _token_ids(args, scratch)
+  return token_corpus.read_text_pairs(paths[0], paths[1], _BUCKETS,
+                                      target_suffix=[data_utils.EOS_ID])
+
+
+def bench_get_batch(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    data_set = _bucketed_pairs(args, scratch)
+    bucket_id = int(np.argmax([len(bucket) for bucket in data_set]))
+    bucket = data_set[bucket_id]
+    encoder_size, decoder_size = _BUCKETS[bucket_id]
+
+    print("get_batch: bucket %s, %d pairs"
+          % (_BUCKETS[bucket_id], len(bucket)))
+    rng = np.random.RandomState(0)
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+      indices = rng.randint(len(bucket), size=batch_size)
+      legacy_time, legacy = _best_time(
+          lambda: _legacy_get_batch(bucket, indices, encoder_size,
+                                    decoder_size), args.repeat)
+      out = token_corpus.time_major_batch(
+          bucket, indices, encoder_size, decoder_size, data_utils.GO_ID,
+          data_utils.PAD_ID)
+      new_time, new = _best_time(
+          lambda: token_corpus.time_major_batch(
+              bucket, indices, encoder_size, decoder_size, data_utils.GO_ID,
+              data_utils.PAD_ID, out), args.repeat)
+      for legacy_arrays, new_arrays in zip(legacy, new):
+        if not np.array_equal(np.array(legacy_arrays), new_arrays):
+          raise AssertionError("Batches differ from the legacy get_batch.")
+      print("  batch %5d: %8.0f batches/s legacy, %8.0f batches/s arrays "
+            "(x%.1f), identical" % (batch_size, 1 / legacy_time,
+                                    1 / new_time, legacy_time / new_time))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def _pipeline_steps_per_second(data_set, args, input_queue_capacity):
+  """Training steps/s of a model fed by feed_dict or by its input queues."""
+  import tensorflow as tf  # Only needed by this benchmark.
+  import seq2seq_model
+
+  with tf.Graph().as_default(), tf.Session() as sess:
+    model = seq2seq_model.Seq2SeqModel(
+        args.vocab_size, args.vocab_size, _BUCKETS, args.size,
+        args.num_layers, 5.0, args.batch_size, 0.5, 0.99,
+        input_queue_capacity=input_queue_capacity)
+    sess.run(tf.initialize_all_variables())
+    sampler = bucket_sampler.EpochBucketSampler(
+        [len(bucket) for bucket in data_set], args.batch_size)
+    batches = batch_prefetcher.BatchPrefetcher(
+        functools.partial(model.get_batch, data_set), sampler)
+    if input_queue_capacity:
+      inputs = batch_prefetcher.InputFeeder(
+          batches, functools.partial(model.enqueue, sess))
+      def step():
+        model.queued_step(sess, inputs.get()[0])
+    else:
+      def step():
+        bucket_id, batch, _ = batches.get()
+        model.step(sess, batch[0], batch[1], batch[2], bucket_id, False)
+    for _ in range(args.warmup):
+      step()
+    start_time = time.time()
+    for _ in range(args.steps):
+      step()
+    return args.steps / (time.time() - start_time)
+
+
+def bench_input_pipeline(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    data_set = _bucketed_pairs(args, scratch)
+    print("input_pipeline: batch %d, %d layers of %d units"
+          % (args.batch_size, args.num_layers, args.size))
+    for name, capacity in (("feed_dict", 0), ("queue", args.queue_capacity)):
+      print("  %-9s: %6.2f steps/s"
+            % (name, _pipeline_steps_per_second(data_set, args, capacity)))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def _measure_model(model_name, paths, buckets, args, results):
+  """Child process: builds a model, reports build time, RSS growth, steps/s."""
+  import tensorflow as tf  # Only needed by this benchmark.
+  import seq2seq_model
+
+  data_set = token_corpus.read_text_pairs(paths[0], paths[1], buckets,
+                                          target_suffix=[data_utils.EOS_ID])
+  model_class = {"bucketed": seq2seq_model.Seq2SeqModel,
+                 "dynamic": seq2seq_model.DynamicSeq2SeqModel}[model_name]
+  resident_before = _resident_bytes()
+  start_time = time.time()
+  with tf.Session() as sess:
+    model = model_class(args.vocab_size, args.vocab_size, buckets, args.size,
+                        args.num_layers, 5.0, args.batch_size, 0.5, 0.99)
+    sess.run(tf.initialize_all_variables())
+    build_time = time.time() - start_time
+    resident_growth = _resident_bytes() - resident_before
+    sampler = bucket_sampler.EpochBucketSampler(
+        [len(bucket) for bucket in data_set], args.batch_size)
+    batches = batch_prefetcher.BatchPrefetcher(
+        functools.partial(model.get_batch, data_set), sampler)
+
+    def step():
+      bucket_id, batch, _ = batches.get()
+      model.step(sess, batch[0], batch[1], batch[2], bucket_id, False)
+    for _ in range(args.warmup):
+      step()
+    start_time = time.time()
+    for _ in range(args.steps):
+      step()
+    steps_per_second = args.steps / (time.time() - start_time)
+    batches.close()
+  results.put((build_time, resident_growth, steps_per_second))
+
+
+def bench_model_graph(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    paths = _token_ids(args, scratch)
+    source_lengths = token_corpus.line_lengths(paths[0])
+    target_lengths = token_corpus.line_lengths(paths[1]) + 1  # EOS_ID
+    print("model_graph: batch %d, %d layers of %d units"
+          % (args.batch_size, args.num_layers, args.size))
+    for num_buckets in [int(n) for n in args.num_buckets.split(",")]:
+      buckets = bucket_planner.plan_buckets(source_lengths, target_lengths,
+                                            num_buckets, coverage=1.0)
+      print("  %d buckets, up to %s" % (len(buckets), buckets[-1]))
+      for model_name in ("bucketed", "dynamic"):
+        # A fresh process per model, so the RSS growth is its own.
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_measure_model,
+            args=(model_name, paths, buckets, args, results))
+        process.start()
+        build_time, resident_growth, steps_per_second = results.get()
+        process.join()
+        print("    %-8s: graph built in %6.1fs, RSS +%7.1f MB, %6.2f steps/s"
+              % (model_name, build_time, resident_growth / 2.0**20,
+                 steps_per_second))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def _measure_cold_start(config_path, frozen_path, results):
+  """Child process: seconds from start to the first prediction of execute."""
+  import execute  # Imports TF; not part of the measured time.
+
+  execute.gConfig = execute.get_config(config_path)
+  execute.gConfig['frozen_model'] = frozen_path or 'none'
+  start_time = time.time()
+  execute._setup_buckets()
+  predict = execute._load_predictor()
+  predict([data_utils.UNK_ID] * 10)
+  results.put(time.time() - start_time)
+
+
+def bench_cold_start(args):
+  parser = configparser.ConfigParser()
+  parser.read(args.config)
+  frozen_path = args.frozen or os.path.join(
+      parser.get("strings", "working_directory"), "frozen_model.pb")
+  if not os.path.exists(frozen_path):
+    raise ValueError("%s not found; write it with mode = export first."
+                     % frozen_path)
+  print("cold_start: %s" % args.config)
+  for name, path in (("checkpoint", None), ("frozen graph", frozen_path)):
+    timings = []
+    for _ in range(args.repeat):
+      # A fresh process per run: nothing is built or cached yet.
+      results = multiprocessing.Queue()
+      process = multiprocessing.Process(
+          target=_measure_cold_start, args=(args.config, path, results))
+      process.start()
+      timings.append(results.get())
+      process.join()
+    print("  %-12s: first prediction after %6.2fs" % (name, min(timings)))
+
+
+def _data_parallel_config(num_workers):
+  import tensorflow as tf  # Only needed by this benchmark.
+
+  # The workers share the cores of the host.
+  return tf.ConfigProto(intra_op_parallelism_threads=max(
+      multiprocessing.cpu_count() // num_workers, 1))
+
+
+def _data_parallel_worker(data_set, args, results, cluster, task_index,
+                          server):
+  """Worker process of a local cluster: the chief reports pairs/s."""
+  import tensorflow as tf  # Only needed by this benchmark.
+  import distributed
+  import seq2seq_model
+
+  num_workers = distributed.num_workers(cluster)
+  config = _data_parallel_config(num_workers)
+  with tf.device(tf.train.replica_device_setter(
+      worker_device=distributed.worker_device(task_index), cluster=cluster)):
+    model = seq2seq_model.Seq2SeqModel(
+        args.vocab_size, args.vocab_size, _BUCKETS, args.size,
+        args.num_layers, 5.0, args.batch_size, 0.5, 0.99,
+        sync_replicas=num_workers)
+  sess = distributed.replica_session(server, model, task_index == 0,
+                                     config=config)
+  # The same bucket schedule on every worker, each on its own slice.
+  sampler = bucket_sampler.EpochBucketSampler(
+      [len(bucket) for bucket in data_set], num_workers * args.batch_size)
+  batch_slice = slice(task_index * args.batch_size,
+                      (task_index + 1) * args.batch_size)
+
+  def step():
+    bucket_id, indices = sampler.next()
+    batch = model.get_batch(data_set, bucket_id, indices[batch_slice])
+    model.step(sess, batch[0], batch[1], batch[2], bucket_id, False)
+  for _ in range(args.warmup):
+    step()
+  start_time = time.time()
+  for _ in range(args.steps):
+    step()
+  if task_index == 0:
+    results.put(args.steps * num_workers * args.batch_size /
+                (time.time() - start_time))
+
+
+def bench_data_parallel(args):
+  import distributed  # Imports TF; no session is created before the fork.
+
+  scratch = tempfile.mkdtemp()
+  try:
+    data_set = _bucketed_pairs(args, scratch)
+    print("data_parallel: batch %d per worker, %d layers of %d units, "
+          "%d cores" % (args.batch_size, args.num_layers, args.size,
+                        multiprocessing.cpu_count()))
+    base = None
+    for num_workers in [int(n) for n in args.workers.split(",")]:
+      results = multiprocessing.Queue()
+      _, ps_processes, worker_processes = distributed.start_local(
+          num_workers, functools.partial(_data_parallel_worker, data_set,
+                                         args, results),
+          worker_config=_data_parallel_config(num_workers))
+      try:
+        pairs_per_second = results.get()
+      finally:
+        # Workers may wait for a step the chief no longer runs.
+        for process in ps_processes + worker_processes:
+          process.terminate()
+      if base is None:
+        base = pairs_per_second / num_workers
+      print("  %2d workers: %8.1f pairs/s, scaling efficiency %5.1f%%"
+            % (num_workers, pairs_per_second,
+               100 * pairs_per_second / (num_workers * base)))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def _export_frozen(config_path, path, weights):
+  """Child process: exports the latest checkpoint with execute.export."""
+  import execute  # Imports TF.
+
+  execute.gConfig = execute.get_config(config_path)
+  execute.gConfig['frozen_model'] = path
+  execute.gConfig['frozen_weights'] = weights
+  execute.export()
+
+
+def _measure_decoder(config_path, overrides, sentences, results,
+                     student=False):
+  """Child process: decodes sentences like execute.decode.
+
+  Reports the RSS growth since before loading the model, peak and after
+  decoding every sentence (so everything the runs keep, such as folded
+  constants, is counted), the median latency of a sentence and the
+  headlines.
+
+  Args:
+    config_path: the seq2seq.ini to use.
+    overrides: dict of settings replacing those of config_path.
+    sentences: sentences to decode.
+    results: multiprocessing.Queue the results are put in.
+    student: whether to decode with the student of mode = distill.
+  """
+  import execute  # Imports TF; not part of the measured memory.
+
+  execute.gConfig = execute.get_config(config_path)
+  execute.gConfig.update(overrides)
+  if student:
+    execute._use_student()
+  execute._setup_buckets()
+  enc_vocab, dec_vocab = execute._load_vocabularies()
+  resident_before = _resident_bytes()
+  peak_before = token_counts.peak_rss_bytes()
+  predict = execute._load_predictor()
+  predict([data_utils.UNK_ID] * 10)  # The first run folds the constants.
+  headlines, latencies = [], []
+  for sentence in sentences:
+    start_time = time.time()
+    headlines.append(execute._decode_headline(predict, enc_vocab, dec_vocab,
+                                              sentence))
+    latencies.append(time.time() - start_time)
+  rss_growth = (token_counts.peak_rss_bytes() - peak_before,
+                _resident_bytes() - resident_before)
+  results.put((rss_growth, float(np.median(latencies)), headlines))
+
+
+def _test_split(config_path, num_lines):
+  """First num_lines sentences and true headlines of the test split."""
+  parser = configparser.ConfigParser()
+  parser.read(config_path)
+  with open(parser.get("strings", "test_enc")) as f:
+    sentences = [line for _, line in zip(range(num_lines), f)]
+  with open(parser.get("strings", "test_dec")) as f:
+    true_headlines = [line.strip() for _, line in zip(range(num_lines), f)]
+  return sentences, true_headlines
+
+
+def _decode_report(config_path, overrides, sentences, true_headlines,
+                   student=False):
+  """Decodes in a fresh process; returns RSS growth, latency and BLEU.
+
+  The RSS growth is a (peak, resident after decoding) pair.
+  """
+  import evaluation  # Needs nltk and pandas.
+
+  results = multiprocessing.Queue()
+  process = multiprocessing.Process(
+      target=_measure_decoder,
+      args=(config_path, overrides, sentences, results, student))
+  process.start()
+  resident_growth, latency, headlines = results.get()
+  process.join()
+  _, bleu = evaluation.getBLEUscore(true_headlines, headlines)
+  return resident_growth, latency, bleu
+
+
+def bench_quantization(args):
+  sentences, true_headlines = _test_split(args.config, args.lines)
+  scratch = tempfile.mkdtemp()
+  try:
+    print("quantization: %s, %d test sentences" % (args.config,
+                                                   len(sentences)))
+    float_bleu = None
+    for weights in ("float32", "int8"):
+      path = os.path.join(scratch, "frozen_%s.pb" % weights)
+      # Fresh processes: the export and the decoder start from nothing.
+      process = multiprocessing.Process(target=_export_frozen,
+                                        args=(args.config, path, weights))
+      process.start()
+      process.join()
+      (peak_growth, resident_growth), latency, bleu = _decode_report(
+          args.config, {'frozen_model': path}, sentences, true_headlines)
+      if float_bleu is None:
+        float_bleu = bleu
+      print("  %-7s: graph %7.1f MB, RSS +%7.1f MB (peak +%7.1f MB), "
+            "%6.1f ms/sentence, BLEU %.4f (%+.4f)"
+            % (weights, os.path.getsize(path) / 2.0**20,
+               resident_growth / 2.0**20, peak_growth / 2.0**20,
+               latency * 1e3, bleu, bleu - float_bleu))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def bench_shortlist(args):
+  sentences, true_headlines = _test_split(args.config, args.lines)
+  print("shortlist: %s, %d test sentences" % (args.config, len(sentences)))
+  full_bleu = None
+  for size in [int(n) for n in args.sizes.split(",")]:
+    # decode_shortlist = 0 is the full softmax.
+    _, latency, bleu = _decode_report(
+        args.config, {'decode_shortlist': size, 'frozen_model': 'none'},
+        sentences, true_headlines)
+    if full_bleu is None:
+      full_bleu = bleu
+    print("  %-16s: %6.1f ms/sentence, BLEU %.4f (%+.4f)"
+          % ("full softmax" if size == 0 else "shortlist %d" % size,
+             latency * 1e3, bleu, bleu - full_bleu))
+
+
+def _train_for(model, sess, data_set, train_indices, seconds, rng):
+  """Trains on train_indices of every bucket for seconds; returns steps."""
+  sizes = np.array([len(indices) for indices in train_indices], np.float64)
+  steps, start_time = 0, time.time()
+  while time.time() - start_time < seconds:
+    bucket_id = rng.choice(len(sizes), p=sizes / sizes.sum())
+    indices = rng.choice(train_indices[bucket_id], model.batch_size)
+    batch = model.get_batch(data_set, bucket_id, indices)
+    model.step(sess, batch[0], batch[1], batch[2], bucket_id, False)
+    steps += 1
+  return steps
+
+
+def _dev_perplexity(model, sess, data_set, dev_indices):
+  """Full softmax perplexity of the dev pairs, in batches of batch_size."""
+  total_loss, num_pairs = 0.0, 0
+  for bucket_id, indices in enumerate(dev_indices):
+    for start in range(0, len(indices), model.batch_size):
+      chunk = indices[start:start + model.batch_size]
+      # Fill the last batch up, counting its pairs once.
+      batch = model.get_batch(data_set, bucket_id,
+                              np.resize(chunk, model.batch_size))
+      total_loss += len(chunk) * model.eval_step(
+          sess, batch[0], batch[1], batch[2], bucket_id)
+      num_pairs += len(chunk)
+  loss = total_loss / max(num_pairs, 1)
+  return np.exp(loss) if loss < 300 else float("inf")
+
+
+def bench_losses(args):
+  import tensorflow as tf  # Only needed by this benchmark.
+  import seq2seq_model
+
+  scratch = tempfile.mkdtemp()
+  try:
+    data_set = _bucketed_pairs(args, scratch)
+    # Every 10th pair of every bucket is held out.
+    train_indices, dev_indices = [], []
+    for bucket in data_set:
+      indices = np.arange(len(bucket))
+      dev_indices.append(indices[::10])
+      train_indices.append(np.setdiff1d(indices, indices[::10]))
+    print("losses: %ds of training each, batch %d, %d layers of %d units, "
+          "%d dev pairs" % (args.seconds, args.batch_size, args.num_layers,
+                            args.size, sum(map(len, dev_indices))))
+    cutoffs = [int(cutoff) for cutoff in args.cutoffs.split(",")]
+    for option in args.losses.split(","):
+      loss, _, num_samples = option.partition(":")
+      num_samples = int(num_samples or 512)
+      with tf.Graph().as_default(), tf.Session() as sess:
+        tf.set_random_seed(0)
+        model = seq2seq_model.Seq2SeqModel(
+            args.vocab_size, args.vocab_size, _BUCKETS, args.size,
+            args.num_layers, 5.0, args.batch_size, 0.5, 0.99,
+            num_samples=num_samples, loss=loss, adaptive_cutoffs=cutoffs)
+        sess.run(tf.initialize_all_variables())
+        steps = _train_for(model, sess, data_set, train_indices,
+                           args.seconds, np.random.RandomState(0))
+        print("  %-20s: %6.2f steps/s, dev perplexity %8.2f"
+              % (option, steps / args.seconds,
+                 _dev_perplexity(model, sess, data_set, dev_indices)))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def _train_and_save(model, sess, batches, num_saves, steps, save=None):
+  """Runs `steps` training steps before each of num_saves calls of save.
+
+  Returns:
+    the total seconds, the mean seconds of a training step and the seconds
+    every save stalled training.
+  """
+  step_times, stalls = [], []
+  start_time = time.time()
+  for save_index in range(num_saves):
+    for step in range(steps):
+      bucket_id = step % len(batches)
+      batch = batches[bucket_id]
+      step_start = time.time()
+      model.step(sess, batch[0], batch[1], batch[2], bucket_id, False)
+      step_times.append(time.time() - step_start)
+    if save is not None:
+      save_start = time.time()
+      save(save_index)
+      stalls.append(time.time() - save_start)
+  return time.time() - start_time, float(np.mean(step_times)), stalls
+
+
+def bench_checkpoint(args):
+  import tensorflow as tf  # Only needed by this benchmark.
+  import checkpoints
+  import seq2seq_model
+
+  scratch = tempfile.mkdtemp()
+  try:
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = seq2seq_model.Seq2SeqModel(
+          args.vocab_size, args.vocab_size, _BUCKETS, args.size,
+          args.num_layers, 5.0, args.batch_size, 0.5, 0.99)
+      sess.run(tf.initialize_all_variables())
+      num_bytes = sum(np.prod(v.get_shape().as_list()) * v.dtype.size
+                      for v in tf.all_variables())
+      print("checkpoint: %.1f MB of variables, %d saves, %d training steps "
+            "before each" % (num_bytes / 2**20, args.saves, args.steps))
+      rng = np.random.RandomState(0)
+      low = len(data_utils._START_VOCAB)
+      data_set = [[(list(rng.randint(low, args.vocab_size, encoder_size - 1)),
+                    list(rng.randint(low, args.vocab_size, decoder_size - 2)))
+                   for _ in range(args.batch_size)]
+                  for encoder_size, decoder_size in _BUCKETS]
+      batches = [model.get_batch(data_set, bucket_id)
+                 for bucket_id in range(len(_BUCKETS))]
+      # Warm up, then the same training without any checkpoint.
+      _train_and_save(model, sess, batches, 1, len(_BUCKETS))
+      base_time, base_step, _ = _train_and_save(model, sess, batches,
+                                                args.saves, args.steps)
+      print("  none        : %7.2fs, %6.1f ms/step"
+            % (base_time, base_step * 1e3))
+
+      # A save stalls training until it returns.
+      sync_path = os.path.join(scratch, "sync")
+      os.mkdir(sync_path)
+      sync_time, sync_step, stalls = _train_and_save(
+          model, sess, batches, args.saves, args.steps,
+          lambda step: model.saver.save(
+              sess, os.path.join(sync_path, "seq2seq.ckpt"),
+              global_step=step))
+      print("  Saver.save  : %7.2fs (%+.2fs), %6.1f ms/step, %.2fs stall "
+            "per checkpoint" % (sync_time, sync_time - base_time,
+                                sync_step * 1e3, np.mean(stalls)))
+
+      # The asynchronous save returns before the write, which the next save
+      # (or close) waits for; meanwhile the write competes with the training
+      # steps for the cores and the disk, which slows them.
+      async_path = os.path.join(scratch, "async")
+      os.mkdir(async_path)
+      checkpointer = checkpoints.Checkpointer(tf.all_variables(), async_path)
+      async_time, async_step, stalls = _train_and_save(
+          model, sess, batches, args.saves, args.steps,
+          lambda step: checkpointer.save(sess, step))
+      close_start = time.time()
+      checkpointer.close()
+      close_time = time.time() - close_start
+      async_time += close_time
+      # The first save also builds the writer's graph.
+      print("  Checkpointer: %7.2fs (%+.2fs), %6.1f ms/step, %.2fs stall "
+            "per checkpoint (first %.2fs), %.2fs waiting for the last write"
+            % (async_time, async_time - base_time, async_step * 1e3,
+               np.mean(stalls[1:] or stalls), stalls[0], close_time))
+      print("  retained: %s" % sorted(os.listdir(async_path)))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def bench_distillation(args):
+  sentences, true_headlines = _test_split(args.config, args.lines)
+  print("distillation: %s, %d test sentences" % (args.config,
+                                                  len(sentences)))
+  reports = [(name, _decode_report(args.config, {}, sentences,
+                                   true_headlines, student=student))
+             for name, student in (("teacher", False), ("student", True))]
+  _, (_, teacher_latency, teacher_bleu) = reports[0]
+  for name, ((peak_growth, resident_growth), latency, bleu) in reports:
+    print("  %-7s: %6.1f ms/sentence (%6.1f sentences/s, x%.1f), "
+          "RSS +%7.1f MB (peak +%7.1f MB), BLEU %.4f (%+.4f)"
+          % (name, latency * 1e3, 1 / latency, teacher_latency / latency,
+             resident_growth / 2.0**20, peak_growth / 2.0**20, bleu,
+             bleu - teacher_bleu))
+
+
+def _coverage(vocab_path, data_path, tokenizer):
+  """Returns (UNK rate, mean tokens per line) of data_path under a vocab."""
+  ids = vocabulary.Vocabulary.load(vocab_path, tokenizer=tokenizer).encode(
+      _read_lines(data_path, 1))
+  num_tokens = sum(len(line) for line in ids)
+  num_unk = sum(int((line == data_utils.UNK_ID).sum()) for line in ids)
+  return num_unk / max(num_tokens, 1), num_tokens / max(len(ids), 1)
+
+
+def _model_timings(vocab_size, data_path, vocab_path, tokenizer, args):
+  """Returns (train step seconds, decode seconds) of a freshly built model."""
+  import tensorflow as tf  # Only needed by the --model measurements.
+  import seq2seq_model
+
+  buckets = [(50, 20)]
+  ids = vocabulary.Vocabulary.load(vocab_path, tokenizer=tokenizer).encode(
+      _read_lines(data_path, 1))
+  pairs = [[line.tolist()[:buckets[0][0] - 1],
+            line.tolist()[:buckets[0][1] - 2] + [data_utils.EOS_ID]]
+           for line in ids]
+  timings = []
+  for forward_only in (False, True):
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = seq2seq_model.Seq2SeqModel(
+          vocab_size, vocab_size, buckets, args.size, args.num_layers, 5.0,
+          args.batch_size if not forward_only else 1, 0.5, 0.99,
+          forward_only=forward_only)
+      sess.run(tf.global_variables_initializer())
+
+      def run():
+        batch = model.get_batch([pairs], 0)
+        model.step(sess, batch[0], batch[1], batch[2], 0, forward_only)
+      run()  # Warm-up.
+      timings.append(_best_time(run, args.steps)[0])
+  return timings
+
+
+def bench_bpe(args):
+  scratch = tempfile.mkdtemp()
+  try:
+    random.seed(0)
+    word_vocab = os.path.join(scratch, "word_vocab.txt")
+    data_utils.create_vocabulary(word_vocab, args.data, args.word_vocab_size)
+    codes_path = data_utils.bpe_codes_path(scratch, args.merges)
+    data_utils.learn_bpe(codes_path, [args.data], args.merges)
+    tokenizer = data_utils.load_bpe_tokenizer(codes_path)
+    bpe_vocab = os.path.join(scratch, "bpe_vocab.txt")
+    data_utils.create_vocabulary(bpe_vocab, args.data, args.bpe_vocab_size,
+                                 tokenizer=tokenizer)
+
+    print("bpe: learned on %s, %d merges, coverage of %s"
+          % (args.data, args.merges, args.eval))
+    rows = [("word", word_vocab, None), ("bpe", bpe_vocab, tokenizer)]
+    for name, vocab_path, vocab_tokenizer in rows:
+      vocab_size = len(vocabulary.Vocabulary.load(vocab_path))
+      unk_rate, mean_length = _coverage(vocab_path, args.eval, vocab_tokenizer)
+      print("  %-4s vocabulary %6d: UNK %6.2f%%, %6.1f tokens/line, "
+            "%5.1fM softmax+embedding params"
+            % (name, vocab_size, 100 * unk_rate, mean_length,
+               3 * vocab_size * args.size / 1e6))
+      if args.model:
+        step_time, decode_time = _model_timings(
+            vocab_size, args.data, vocab_path, vocab_tokenizer, args)
+        print("       train step %7.1f ms, decode %7.1f ms"
+              % (step_time * 1e3, decode_time * 1e3))
+  finally:
+    shutil.rmtree(scratch)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--repeat", type=int, default=3,
+                      help="runs per measurement, the best one is reported")
+  subparsers = parser.add_subparsers(dest="benchmark")
+  subparsers.required = True
+
+  tokenizer = subparsers.add_parser(
+      "tokenizer", help="BatchTokenizer vs. per-token sentence_to_token_ids")
+  tokenizer.add_argument("--data", default="dataset/article.txt")
+  tokenizer.add_argument("--copies", type=int, default=10,
+                         help="how many times the data is replicated")
+  tokenizer.add_argument("--vocab_size", type=int, default=40000)
+  tokenizer.set_defaults(func=bench_tokenizer)
+
+  vocabulary = subparsers.add_parser(
+      "vocabulary", help="create_vocabulary scaling with num_workers")
+  vocabulary.add_argument("--data", default="dataset/article.txt")
+  vocabulary.add_argument("--copies", type=int, default=20)
+  vocabulary.add_argument("--vocab_size", type=int, default=80000)
+  vocabulary.add_argument("--max_memory_mb", type=int, default=0,
+                          help="spill the counts to disk past this size")
+  vocabulary.set_defaults(func=bench_vocabulary)
+
+  prepare = subparsers.add_parser(
+      "prepare", help="prepare_custom_data scaling with num_workers")
+  prepare.add_argument("--enc", default="dataset/article.txt")
+  prepare.add_argument("--dec", default="dataset/headline.txt")
+  prepare.add_argument("--copies", type=int, default=20)
+  prepare.add_argument("--vocab_size", type=int, default=80000)
+  prepare.add_argument("--corpus_format", default="binary")
+  prepare.set_defaults(func=bench_prepare)
+
+  vocabulary_update = subparsers.add_parser(
+      "vocabulary_update", help="merging appended data vs. a full recount")
+  vocabulary_update.add_argument("--data", default="dataset/article.txt")
+  vocabulary_update.add_argument("--copies", type=int, default=20)
+  vocabulary_update.add_argument("--vocab_size", type=int, default=80000)
+  vocabulary_update.set_defaults(func=bench_vocabulary_update)
+
+  vocabulary_load = subparsers.add_parser(
+      "vocabulary_load", help="Vocabulary.load vs. initialize_vocabulary")
+  vocabulary_load.add_argument("--vocab", default=None,
+                               help="existing vocabulary file; by default one "
+                               "is built from --data")
+  vocabulary_load.add_argument("--data", default="dataset/article.txt")
+  vocabulary_load.add_argument("--vocab_size", type=int, default=80000)
+  vocabulary_load.set_defaults(func=bench_vocabulary_load)
+
+  read_data = subparsers.add_parser(
+      "read_data", help="array-backed vs. nested-list read_data")
+  read_data.add_argument("--enc", default="dataset/article.txt")
+  read_data.add_argument("--dec", default="dataset/headline.txt")
+  read_data.add_argument("--copies", type=int, default=20)
+  read_data.add_argument("--vocab_size", type=int, default=80000)
+  read_data.add_argument("--max_size", type=int, default=0)
+  read_data.set_defaults(func=bench_read_data)
+
+  buckets = subparsers.add_parser(
+      "buckets", help="padding of the default vs. planned buckets")
+  buckets.add_argument("--enc", default="dataset/article.txt")
+  buckets.add_argument("--dec", default="dataset/headline.txt")
+  buckets.add_argument("--vocab_size", type=int, default=80000)
+  buckets.add_argument("--num_buckets", type=int, default=5)
+  buckets.add_argument("--coverage", type=float, default=0.99)
+  buckets.set_defaults(func=bench_buckets)
+
+  get_batch = subparsers.add_parser(
+      "get_batch", help="array-indexed vs. list-based get_batch")
+  get_batch.add_argument("--enc", default="dataset/article.txt")
+  get_batch.add_argument("--dec", default="dataset/headline.txt")
+  get_batch.add_argument("--vocab_size", type=int, default=80000)
+  get_batch.add_argument("--batch_sizes", default="64,128,256,512,1024")
+  get_batch.set_defaults(func=bench_get_batch)
+
+  input_pipeline = subparsers.add_parser(
+      "input_pipeline", help="input queues vs. feed_dict training steps "
+      "(needs TF)")
+  input_pipeline.add_argument("--enc", default="dataset/article.txt")
+  input_pipeline.add_argument("--dec", default="dataset/headline.txt")
+  input_pipeline.add_argument("--vocab_size", type=int, default=40000)
+  input_pipeline.add_argument("--size", type=int, default=512)
+  input_pipeline.add_argument("--num_layers", type=int, default=3)
+  input_pipeline.add_argument("--batch_size", type=int, default=128)
+  input_pipeline.add_argument("--queue_capacity", type=int, default=4)
+  input_pipeline.add_argument("--warmup", type=int, default=5)
+  input_pipeline.add_argument("--steps", type=int, default=50)
+  input_pipeline.set_defaults(func=bench_input_pipeline)
+
+  model_graph = subparsers.add_parser(
+      "model_graph", help="dynamic vs. bucketed model graph (needs TF)")
+  model_graph.add_argument("--enc", default="dataset/article.txt")
+  model_graph.add_argument("--dec", default="dataset/headline.txt")
+  model_graph.add_argument("--vocab_size", type=int, default=40000)
+  model_graph.add_argument("--num_buckets", default="5,20",
+                           help="bucket counts, planned from the data")
+  model_graph.add_argument("--size", type=int, default=512)
+  model_graph.add_argument("--num_layers", type=int, default=3)
+  model_graph.add_argument("--batch_size", type=int, default=64)
+  model_graph.add_argument("--warmup", type=int, default=5)
+  model_graph.add_argument("--steps", type=int, default=50)
+  model_graph.set_defaults(func=bench_model_graph)
+
+  cold_start = subparsers.add_parser(
+      "cold_start", help="time to the first prediction from the checkpoint "
+      "vs. the frozen graph (needs TF and a trained model)")
+  cold_start.add_argument("--config", default="seq2seq.ini")
+  cold_start.add_argument("--frozen", default=None,
+                          help="frozen graph; by default frozen_model.pb in "
+                          "the working directory")
+  cold_start.set_defaults(func=bench_cold_start)
+
+  data_parallel = subparsers.add_parser(
+      "data_parallel", help="synchronous data-parallel training throughput "
+      "vs. local worker count (needs TF)")
+  data_parallel.add_argument("--enc", default="dataset/article.txt")
+  data_parallel.add_argument("--dec", default="dataset/headline.txt")
+  data_parallel.add_argument("--vocab_size", type=int, default=40000)
+  data_parallel.add_argument("--workers", default="1,2,4",
+                             help="worker counts; efficiency is relative "
+                             "to the first")
+  data_parallel.add_argument("--size", type=int, default=512)
+  data_parallel.add_argument("--num_layers", type=int, default=3)
+  data_parallel.add_argument("--batch_size", type=int, default=64)
+  data_parallel.add_argument("--warmup", type=int, default=5)
+  data_parallel.add_argument("--steps", type=int, default=30)
+  data_parallel.set_defaults(func=bench_data_parallel)
+
+  quantization = subparsers.add_parser(
+      "quantization", help="int8 vs. float32 frozen graph: size, memory, "
+      "latency and BLEU on the test split (needs TF, nltk and a trained "
+      "model)")
+  quantization.add_argument("--config", default="seq2seq.ini")
+  quantization.add_argument("--lines", type=int, default=400,
+                            help="test sentences decoded")
+  quantization.set_defaults(func=bench_quantization)
+
+  shortlist = subparsers.add_parser(
+      "shortlist", help="shortlist vs. full softmax decoding: latency and "
+      "BLEU on the test split (needs TF, nltk and a trained model)")
+  shortlist.add_argument("--config", default="seq2seq.ini")
+  shortlist.add_argument("--lines", type=int, default=400,
+                         help="test sentences decoded")
+  shortlist.add_argument("--sizes", default="0,2000,5000",
+                         help="frequent words of the shortlists; the first "
+                         "is the reference, 0 is the full softmax")
+  shortlist.set_defaults(func=bench_shortlist)
+
+  losses = subparsers.add_parser(
+      "losses", help="training losses: steps/s and dev perplexity after "
+      "the same training time (needs TF)")
+  losses.add_argument("--enc", default="dataset/article.txt")
+  losses.add_argument("--dec", default="dataset/headline.txt")
+  losses.add_argument("--vocab_size", type=int, default=40000)
+  losses.add_argument("--losses",
+                      default="sampled_softmax:512,sampled_softmax:64,"
+                      "nce:512,adaptive_softmax",
+                      help="loss[:num_samples] options")
+  losses.add_argument("--cutoffs", default="2000,10000",
+                      help="cluster cutoffs of adaptive_softmax")
+  losses.add_argument("--seconds", type=int, default=600,
+                      help="training time of every option")
+  losses.add_argument("--size", type=int, default=512)
+  losses.add_argument("--num_layers", type=int, default=3)
+  losses.add_argument("--batch_size", type=int, default=64)
+  losses.set_defaults(func=bench_losses)
+
+  checkpoint = subparsers.add_parser(
+      "checkpoint", help="training time and stalls with Saver.save vs. "
+      "background checkpoints (needs TF)")
+  checkpoint.add_argument("--vocab_size", type=int, default=40000)
+  checkpoint.add_argument("--size", type=int, default=512)
+  checkpoint.add_argument("--num_layers", type=int, default=3)
+  checkpoint.add_argument("--batch_size", type=int, default=64)
+  checkpoint.add_argument("--saves", type=int, default=5)
+  checkpoint.add_argument("--steps", type=int, default=50,
+                          help="training steps between checkpoints")
+  checkpoint.set_defaults(func=bench_checkpoint)
+
+  distillation = subparsers.add_parser(
+      "distillation", help="student of mode = distill vs. its teacher: "
+      "latency, throughput and BLEU on the test split (needs TF, nltk and "
+      "both trained models)")
+  distillation.add_argument("--config", default="seq2seq.ini")
+  distillation.add_argument("--lines", type=int, default=400,
+                            help="test sentences decoded")
+  distillation.set_defaults(func=bench_distillation)
+
+  bpe = subparsers.add_parser(
+      "bpe", help="coverage and model cost of word vs. BPE vocabularies")
+  bpe.add_argument("--data", default="dataset/article.txt")
+  bpe.add_argument("--eval", default="dataset/headline.txt",
+                   help="text the coverage is measured on")
+  bpe.add_argument("--merges", type=int, default=16000)
+  bpe.add_argument("--word_vocab_size", type=int, default=80000)
+  bpe.add_argument("--bpe_vocab_size", type=int, default=16000)
+  bpe.add_argument("--model", action="store_true",
+                   help="also time train steps and decoding (needs TF)")
+  bpe.add_argument("--size", type=int, default=512)
+  bpe.add_argument("--num_layers", type=int, default=3)
+  bpe.add_argument("--batch_size", type=int, default=64)
+  bpe.add_argument("--steps", type=int, default=10)
+  bpe.set_defaults(func=bench_bpe)
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == "__main__":
+  main()
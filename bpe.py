@@ -0,0 +1,171 @@
+"""Byte-pair-encoding subword tokenizer.
+
+Learns merge operations from word frequencies (Sennrich et al., 2016,
+http://arxiv.org/abs/1508.07909) and splits words into subword units, so a
+vocabulary of 8k-16k units covers the corpus with almost no UNK tokens.
+Every unit but the last one of a word carries the CONTINUATION marker,
+which lets detokenize rebuild the words:
+
+  "summarization" -> ["summar@@", "ization"]
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import heapq
+
+END_OF_WORD = "</w>"
+CONTINUATION = "@@"
+
+
+def _word_symbols(word):
+  """Initial segmentation: characters, the last one marking the word end."""
+  return tuple(word[:-1]) + (word[-1] + END_OF_WORD,)
+
+
+def _pairs(symbols):
+  return zip(symbols[:-1], symbols[1:])
+
+
+def _merge_symbols(symbols, pair, merged):
+  out, i = [], 0
+  while i < len(symbols):
+    if i < len(symbols) - 1 and (symbols[i], symbols[i + 1]) == pair:
+      out.append(merged)
+      i += 2
+    else:
+      out.append(symbols[i])
+      i += 1
+  return tuple(out)
+
+
+def learn_merges(word_counts, num_merges, min_frequency=2):
+  """Learns BPE merge operations.
+
+  Pair counts are maintained incrementally and the most frequent pair is
+  found with a lazily updated heap, so each merge only touches the words
+  that contain the merged pair.
+
+  Args:
+    word_counts: dict mapping words to their frequency.
+    num_merges: maximum number of merge operations to learn.
+    min_frequency: stop once the most frequent pair is rarer than this.
+
+  Returns:
+    the list of merged (left, right) symbol pairs, in merge order.
+  """
+  words = [_word_symbols(w) for w in word_counts if w]
+  counts = [word_counts[w] for w in word_counts if w]
+  pair_counts = collections.defaultdict(int)
+  pair_words = collections.defaultdict(set)
+  for index, symbols in enumerate(words):
+    for pair in _pairs(symbols):
+      pair_counts[pair] += counts[index]
+      pair_words[pair].add(index)
+  # Ties are broken by the pair itself so the merges are deterministic.
+  heap = [(-count, pair) for pair, count in pair_counts.items()]
+  heapq.heapify(heap)
+
+  merges = []
+  while heap and len(merges) < num_merges:
+    count, pair = heapq.heappop(heap)
+    if -count != pair_counts.get(pair, 0):
+      continue  # Stale entry, the pair count changed since it was pushed.
+    if -count < min_frequency:
+      break
+    merges.append(pair)
+    merged = pair[0] + pair[1]
+    changed = set()
+    for index in list(pair_words[pair]):
+      symbols = words[index]
+      new_symbols = _merge_symbols(symbols, pair, merged)
+      for old in _pairs(symbols):
+        pair_counts[old] -= counts[index]
+        changed.add(old)
+      for new in _pairs(new_symbols):
+        pair_counts[new] += counts[index]
+        pair_words[new].add(index)
+        changed.add(new)
+      words[index] = new_symbols
+    del pair_counts[pair]
+    del pair_words[pair]
+    changed.discard(pair)
+    for changed_pair in changed:
+      if pair_counts[changed_pair] > 0:
+        heapq.heappush(heap, (-pair_counts[changed_pair], changed_pair))
+  return merges
+
+
+def save_merges(path, merges):
+  with open(path, "w", encoding="utf-8") as f:
+    for left, right in merges:
+      f.write("%s %s\n" % (left, right))
+
+
+def load_merges(path):
+  with open(path, encoding="utf-8") as f:
+    return [tuple(line.rstrip("\n").split(" ")) for line in f if line.strip()]
+
+
+def detokenize(tokens):
+  """Joins subword units back into a space-separated sentence."""
+  text = " ".join(tokens).replace(CONTINUATION + " ", "")
+  if text.endswith(CONTINUATION):
+    text = text[:-len(CONTINUATION)]
+  return text
+
+
+class BPETokenizer(object):
+  """Splits sentences into BPE subword units.
+
+  Instances are callables taking a sentence and returning its units, so
+  they can be passed as the `tokenizer` of data_utils functions.
+  """
+
+  def __init__(self, merges, pre_tokenizer):
+    """Create the tokenizer.
+
+    Args:
+      merges: list of (left, right) pairs as returned by learn_merges.
+      pre_tokenizer: function splitting a sentence into words; it must be
+        the one whose words the merges were learned from.
+    """
+    self.merges = [tuple(pair) for pair in merges]
+    self.pre_tokenizer = pre_tokenizer
+    self._ranks = dict((pair, rank) for rank, pair in enumerate(self.merges))
+    self._cache = {}
+    digest = hashlib.sha1()
+    for left, right in self.merges:
+      digest.update(("%s %s\n" % (left, right)).encode("utf-8"))
+    self.fingerprint = "bpe-%s" % digest.hexdigest()
+
+  def __getstate__(self):
+    # The segmentation cache is rebuilt by every process that unpickles us.
+    state = self.__dict__.copy()
+    state["_cache"] = {}
+    return state
+
+  def segment(self, word):
+    """Returns the subword units of a single word."""
+    units = self._cache.get(word)
+    if units is not None:
+      return units
+    symbols = _word_symbols(word)
+    while len(symbols) > 1:
+      pair = min(_pairs(symbols),
+                 key=lambda p: self._ranks.get(p, len(self._ranks)))
+      if pair not in self._ranks:
+        break
+      symbols = _merge_symbols(symbols, pair, pair[0] + pair[1])
+    units = [s + CONTINUATION for s in symbols[:-1]]
+    units.append(symbols[-1][:-len(END_OF_WORD)])
+    self._cache[word] = units
+    return units
+
+  def __call__(self, sentence):
+    units = []
+    for word in self.pre_tokenizer(sentence):
+      units.extend(self.segment(word))
+    return units
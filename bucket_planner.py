@@ -0,0 +1,173 @@
+"""Derives the (input, output) bucket sizes from the corpus lengths.
+
+Every training step pads its batch to the sizes of the bucket it draws
+from, so the padded token slots of a bucket set are a direct measure of the
+computation it wastes. plan_buckets picks the buckets minimizing the padded
+slots of the training pairs, subject to a minimum fraction of pairs that
+must fit some bucket (the others are dropped by read_data).
+
+The buckets are searched among chains, i.e. sets where both the input and
+the output sizes grow from one bucket to the next. Then the pairs of bucket
+k are the pairs fitting bucket k minus those fitting bucket k - 1, which
+makes the cost of a chain a sum over consecutive buckets, minimized exactly
+by dynamic programming over a 2-D cumulative histogram of the lengths.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+import token_corpus
+
+BUCKETS_NAME = "buckets.json"
+# Candidate sizes per axis; longer length ranges are sampled at quantiles.
+_MAX_CANDIDATES = 64
+
+
+def _candidate_sizes(lengths, max_candidates):
+  """Sizes a bucket edge may take: one more than an observed length."""
+  sizes = np.unique(lengths) + 1
+  if len(sizes) > max_candidates:
+    quantiles = np.quantile(lengths, np.linspace(0, 1, max_candidates))
+    sizes = np.unique(np.append(np.ceil(quantiles).astype(np.int64) + 1,
+                                sizes[-1]))
+  return sizes
+
+
+def _cumulative_counts(source_lengths, target_lengths, input_sizes,
+                       output_sizes):
+  """counts[a, b]: number of pairs fitting (input_sizes[a], output_sizes[b])."""
+  a = np.searchsorted(input_sizes, source_lengths, side="right")
+  b = np.searchsorted(output_sizes, target_lengths, side="right")
+  histogram = np.zeros((len(input_sizes) + 1, len(output_sizes) + 1),
+                       dtype=np.int64)
+  np.add.at(histogram, (a, b), 1)
+  return histogram.cumsum(axis=0).cumsum(axis=1)[:-1, :-1]
+
+
+def plan_buckets(source_lengths, target_lengths, num_buckets, coverage=0.99,
+                 max_candidates=_MAX_CANDIDATES):
+  """Returns the chain of buckets with the fewest padded token slots.
+
+  Args:
+    source_lengths: array with the number of source tokens of every pair.
+    target_lengths: array with the number of target tokens of every pair,
+      including the appended EOS.
+    num_buckets: maximum number of buckets.
+    coverage: minimum fraction of the pairs that must fit a bucket.
+    max_candidates: number of sizes considered per axis.
+
+  Returns:
+    a sorted list of at most num_buckets (I, O) tuples.
+
+  Raises:
+    ValueError: if there are no pairs or num_buckets is not positive.
+  """
+  source_lengths = np.asarray(source_lengths, dtype=np.int64)
+  target_lengths = np.asarray(target_lengths, dtype=np.int64)
+  if not len(source_lengths) or num_buckets < 1:
+    raise ValueError("Need pairs and at least one bucket to plan buckets.")
+  input_sizes = _candidate_sizes(source_lengths, max_candidates)
+  output_sizes = _candidate_sizes(target_lengths, max_candidates)
+  counts = _cumulative_counts(source_lengths, target_lengths, input_sizes,
+                              output_sizes)
+  # Padded slots per pair of a bucket: its input plus its output size.
+  slots = input_sizes[:, None] + output_sizes[None, :]
+
+  # cost[a, b]: fewest slots of a chain ending with bucket (a, b), covering
+  # exactly the counts[a, b] pairs that fit it.
+  cost = slots * counts
+  parents = []
+  for _ in range(num_buckets - 1):
+    new_cost = np.empty_like(cost)
+    parent = np.empty(cost.shape, dtype=np.int64)
+    for a in range(cost.shape[0]):
+      for b in range(cost.shape[1]):
+        # Previous bucket (a', b') <= (a, b); (a, b) itself means the chain
+        # is one bucket shorter.
+        options = cost[:a + 1, :b + 1] - slots[a, b] * counts[:a + 1, :b + 1]
+        best = int(np.argmin(options))
+        parent[a, b] = np.ravel_multi_index(
+            np.unravel_index(best, options.shape), cost.shape)
+        new_cost[a, b] = options.flat[best] + slots[a, b] * counts[a, b]
+    cost = new_cost
+    parents.append(parent)
+
+  required = int(np.ceil(coverage * len(source_lengths)))
+  feasible = counts >= required
+  if not feasible.any():
+    feasible = counts == counts.max()
+  last = int(np.argmin(np.where(feasible, cost, np.iinfo(np.int64).max)))
+  chain = [last]
+  for parent in reversed(parents):
+    chain.append(int(parent.flat[chain[-1]]))
+  buckets = []
+  for point in reversed(chain):
+    a, b = np.unravel_index(point, cost.shape)
+    bucket = (int(input_sizes[a]), int(output_sizes[b]))
+    if not buckets or buckets[-1] != bucket:
+      buckets.append(bucket)
+  return buckets
+
+
+def bucket_report(source_lengths, target_lengths, buckets):
+  """Padding statistics of a bucket set on the given pairs.
+
+  Pairs are assigned like read_data does, to the first bucket they fit.
+
+  Returns:
+    a list with one dict per bucket (size, pairs, tokens, slots,
+    efficiency) and the number of pairs that fit no bucket.
+  """
+  source_lengths = np.asarray(source_lengths, dtype=np.int64)
+  target_lengths = np.asarray(target_lengths, dtype=np.int64)
+  bucket_ids = token_corpus.assign_buckets(source_lengths, target_lengths,
+                                           buckets)
+  stats = []
+  for bucket_id, (source_size, target_size) in enumerate(buckets):
+    fits = bucket_ids == bucket_id
+    pairs = int(fits.sum())
+    tokens = int(source_lengths[fits].sum() + target_lengths[fits].sum())
+    slots = pairs * (source_size + target_size)
+    stats.append({"size": [source_size, target_size], "pairs": pairs,
+                  "tokens": tokens, "slots": slots,
+                  "efficiency": tokens / slots if slots else 0.0})
+  return stats, int((bucket_ids < 0).sum())
+
+
+def format_report(stats, dropped):
+  """Formats the result of bucket_report as printable lines."""
+  lines = []
+  for bucket_id, bucket in enumerate(stats):
+    lines.append("  bucket %d %-10s: %8d pairs, %5.1f%% of the slots are "
+                 "tokens" % (bucket_id, tuple(bucket["size"]), bucket["pairs"],
+                             100 * bucket["efficiency"]))
+  tokens = sum(bucket["tokens"] for bucket in stats)
+  slots = sum(bucket["slots"] for bucket in stats)
+  pairs = sum(bucket["pairs"] for bucket in stats)
+  lines.append("  total: %d padded slots, %.1f%% tokens; %d of %d pairs "
+               "(%.2f%%) fit no bucket and are dropped"
+               % (slots, 100.0 * tokens / max(slots, 1), dropped,
+                  pairs + dropped, 100.0 * dropped / max(pairs + dropped, 1)))
+  return "\n".join(lines)
+
+
+def save_buckets(path, buckets, stats=None):
+  """Stores the buckets (and optionally their report) as JSON."""
+  tmp_path = "%s.tmp%d" % (path, os.getpid())
+  with open(tmp_path, "w") as f:
+    json.dump({"buckets": [list(bucket) for bucket in buckets],
+               "report": stats}, f, indent=1)
+  os.replace(tmp_path, path)
+
+
+def load_buckets(path):
+  """Returns the buckets stored at path, None if there are none."""
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return [tuple(bucket) for bucket in json.load(f)["buckets"]]
@@ -0,0 +1,109 @@
+"""Epoch-based sampling of training batches from buckets.
+
+Drawing every pair of a batch at random (with replacement) shows some pairs
+many times before others are seen once. EpochBucketSampler instead shuffles
+every bucket once per epoch and cuts the shuffled order into batches, so an
+epoch shows every pair once (the last batch of a bucket is completed with
+pairs from the start of its order). The batches of all buckets are
+interleaved in a random order, which draws the buckets in proportion to
+their sizes.
+
+The shuffles of an epoch only depend on the seed and the epoch number, so
+the position in an epoch is a couple of integers, saved next to the
+checkpoints to resume training where it stopped.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+
+STATE_NAME = "sampler.json"
+
+
+class EpochBucketSampler(object):
+  """Yields (bucket_id, pair indices) batches, every pair once per epoch."""
+
+  def __init__(self, bucket_sizes, batch_size, seed=0, state=None):
+    """Create the sampler.
+
+    Args:
+      bucket_sizes: number of pairs of every bucket.
+      batch_size: number of pairs of a batch.
+      seed: seed of the shuffles.
+      state: optional state() of a sampler to resume from; it is ignored,
+        with a message, if it was saved for other buckets or batch size.
+
+    Raises:
+      ValueError: if all buckets are empty.
+    """
+    self.bucket_sizes = [int(size) for size in bucket_sizes]
+    self.batch_size = batch_size
+    self.seed = seed
+    self._batches = [-(-size // batch_size) for size in self.bucket_sizes]
+    self.batches_per_epoch = sum(self._batches)
+    if not self.batches_per_epoch:
+      raise ValueError("Cannot sample batches from empty buckets.")
+    self.epoch, self.step = 0, 0
+    if state is not None:
+      if (state["bucket_sizes"] == self.bucket_sizes and
+          state["batch_size"] == batch_size):
+        self.seed, self.epoch, self.step = (state["seed"], state["epoch"],
+                                            state["step"])
+      else:
+        print("Sampler state is for other buckets or batch size, starting a "
+              "new epoch.")
+    self._start_epoch()
+
+  def _start_epoch(self):
+    random_state = np.random.RandomState([self.seed, self.epoch])
+    self._orders = [random_state.permutation(size)
+                    for size in self.bucket_sizes]
+    self._schedule = np.repeat(np.arange(len(self.bucket_sizes)),
+                               self._batches)
+    random_state.shuffle(self._schedule)
+    # Batches already drawn from every bucket in this epoch.
+    self._drawn = np.bincount(self._schedule[:self.step],
+                              minlength=len(self.bucket_sizes))
+
+  def next(self):
+    """Returns the bucket id and the pair indices of the next batch."""
+    if self.step == self.batches_per_epoch:
+      self.epoch += 1
+      self.step = 0
+      self._start_epoch()
+    bucket_id = int(self._schedule[self.step])
+    order = self._orders[bucket_id]
+    start = self._drawn[bucket_id] * self.batch_size
+    indices = order[(start + np.arange(self.batch_size)) % len(order)]
+    self._drawn[bucket_id] += 1
+    self.step += 1
+    return bucket_id, indices
+
+  def state(self):
+    """Position after the last batch, to resume from with the constructor."""
+    return {"seed": self.seed, "epoch": self.epoch, "step": self.step,
+            "batches_per_epoch": self.batches_per_epoch,
+            "bucket_sizes": self.bucket_sizes, "batch_size": self.batch_size}
+
+
+def save_state(path, state, global_step):
+  """Stores a sampler state with the global step of its checkpoint."""
+  tmp_path = "%s.tmp%d" % (path, os.getpid())
+  with open(tmp_path, "w") as f:
+    json.dump(dict(state, global_step=global_step), f)
+  os.replace(tmp_path, path)
+
+
+def load_state(path, global_step):
+  """Returns the state stored for global_step, None if there is none."""
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    state = json.load(f)
+  if state.pop("global_step") != global_step:
+    return None
+  return state
@@ -0,0 +1,192 @@
+"""Checkpoints written in the background, with a retention policy.
+
+tf.train.Saver.save blocks training while it writes every variable. A
+Checkpointer only fetches their values (one session run) and a background
+thread writes them, from a graph of its own holding a copy of the
+variables, while the training steps go on. At most one checkpoint is
+pending: saving again first waits for the previous write.
+
+A checkpoint is written to a temporary directory and moved into place
+before the checkpoint state file ("checkpoint", read by
+tf.train.get_checkpoint_state) is replaced, so after a crash the latest
+checkpoint is always complete. The state lists the retained checkpoints:
+the keep_last most recent ones and the keep_best ones of lowest dev loss;
+the others are deleted. Their steps and dev losses are kept in
+checkpoints.json, so the policy carries on when training resumes.
+Checkpoints written by other means are left alone.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import tensorflow as tf
+
+RECORDS_NAME = "checkpoints.json"
+_STATE_NAME = "checkpoint"
+_TMP_PREFIX = ".checkpoint-"
+
+
+class Checkpointer(object):
+  """Saves variables in the background and prunes the older checkpoints."""
+
+  def __init__(self, variables, directory, basename="seq2seq.ckpt",
+               keep_last=5, keep_best=1, asynchronous=True):
+    """Create the checkpointer.
+
+    Args:
+      variables: the variables to save, e.g. tf.all_variables(); they are
+        restored by a tf.train.Saver of the same variables.
+      directory: directory of the checkpoints.
+      basename: checkpoint file name, followed by -global_step.
+      keep_last: number of most recent checkpoints retained (at least 1).
+      keep_best: number of checkpoints of lowest dev loss retained.
+      asynchronous: if not set, save() writes the checkpoint itself.
+    """
+    self.variables = list(variables)
+    self.directory = directory
+    self.basename = basename
+    self.keep_last = max(keep_last, 1)
+    self.keep_best = keep_best
+    self.asynchronous = asynchronous
+    self._records_path = os.path.join(directory, RECORDS_NAME)
+    self._records = []
+    if os.path.exists(self._records_path):
+      with open(self._records_path) as f:
+        self._records = [record for record in json.load(f)
+                         if self._files(record["name"])]
+    # Leftovers of writes interrupted by a crash.
+    for name in os.listdir(directory):
+      if name.startswith(_TMP_PREFIX):
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    self._session = None
+    self._writer = None
+    self._error = None
+
+  def save(self, session, global_step, dev_loss=None, on_saved=None):
+    """Saves the variables' current values as checkpoint global_step.
+
+    Blocks until the previous checkpoint is written and the values are
+    fetched; the new checkpoint is written in the background.
+
+    Args:
+      session: session of the variables.
+      global_step: training step of the checkpoint.
+      dev_loss: loss on the dev set ranking the checkpoint for keep_best;
+        None if there is none.
+      on_saved: optional function called with global_step once the
+        checkpoint is in place (from the background thread).
+    """
+    self.wait()
+    values = session.run(self.variables)
+    if not self.asynchronous:
+      self._write(values, global_step, dev_loss, on_saved)
+      return
+    self._writer = threading.Thread(
+        target=self._write, args=(values, global_step, dev_loss, on_saved))
+    self._writer.daemon = True
+    self._writer.start()
+
+  def wait(self):
+    """Waits for the pending checkpoint; raises the error its write had."""
+    if self._writer is not None:
+      self._writer.join()
+      self._writer = None
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def close(self):
+    """Waits for the pending checkpoint and closes the writer's session."""
+    try:
+      self.wait()
+    finally:
+      if self._session is not None:
+        self._session.close()
+        self._session = None
+
+  def _build_writer(self):
+    """Graph of variables initialized from placeholders, and its saver."""
+    graph = tf.Graph()
+    with graph.as_default():
+      self._feeds, var_list = [], {}
+      for variable in self.variables:
+        feed = tf.placeholder(variable.dtype.base_dtype,
+                              variable.get_shape())
+        self._feeds.append(feed)
+        var_list[variable.op.name] = tf.Variable(feed, name=variable.op.name)
+      self._initializers = [v.initializer for v in var_list.values()]
+      # Pruning is ours: the saver keeps every checkpoint it writes.
+      self._saver = tf.train.Saver(var_list, max_to_keep=None)
+    self._session = tf.Session(graph=graph)
+
+  def _write(self, values, global_step, dev_loss, on_saved):
+    try:
+      if self._session is None:
+        self._build_writer()
+      self._session.run(self._initializers, dict(zip(self._feeds, values)))
+      name = "%s-%d" % (self.basename, global_step)
+      tmp_dir = tempfile.mkdtemp(prefix=_TMP_PREFIX, dir=self.directory)
+      try:
+        self._saver.save(self._session, os.path.join(tmp_dir, name),
+                         write_meta_graph=False)
+        for file_name in os.listdir(tmp_dir):
+          if file_name == name or file_name.startswith(name + "."):
+            os.replace(os.path.join(tmp_dir, file_name),
+                       os.path.join(self.directory, file_name))
+      finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+      self._records = [record for record in self._records
+                       if record["name"] != name]
+      self._records.append({
+          "name": name, "global_step": int(global_step),
+          "dev_loss": None if dev_loss is None else float(dev_loss)})
+      self._prune()
+      if on_saved is not None:
+        on_saved(global_step)
+    except Exception as e:  # pylint: disable=broad-except
+      if not self.asynchronous:
+        raise
+      self._error = e
+
+  def _retained(self):
+    """Records of the checkpoints kept, by global step."""
+    by_step = sorted(self._records, key=lambda record: record["global_step"])
+    kept = by_step[-self.keep_last:]
+    ranked = sorted((record for record in by_step
+                     if record["dev_loss"] is not None),
+                    key=lambda record: record["dev_loss"])
+    kept += [record for record in ranked[:self.keep_best]
+             if record not in kept]
+    return sorted(kept, key=lambda record: record["global_step"])
+
+  def _prune(self):
+    """Lists the retained checkpoints in the state, deletes the others."""
+    retained = self._retained()
+    paths = [os.path.join(self.directory, record["name"])
+             for record in retained]
+    latest = max(self._records, key=lambda record: record["global_step"])
+    tf.train.update_checkpoint_state(
+        self.directory, os.path.join(self.directory, latest["name"]), paths,
+        latest_filename=_STATE_NAME + ".tmp")
+    os.replace(os.path.join(self.directory, _STATE_NAME + ".tmp"),
+               os.path.join(self.directory, _STATE_NAME))
+    for record in self._records:
+      if record not in retained:
+        for file_name in self._files(record["name"]):
+          os.remove(os.path.join(self.directory, file_name))
+    self._records = retained
+    tmp_path = "%s.tmp%d" % (self._records_path, os.getpid())
+    with open(tmp_path, "w") as f:
+      json.dump(self._records, f, indent=1)
+    os.replace(tmp_path, self._records_path)
+
+  def _files(self, name):
+    """Files of checkpoint name in the directory."""
+    return [file_name for file_name in os.listdir(self.directory)
+            if file_name == name or file_name.startswith(name + ".")]
@@ -0,0 +1,184 @@
+"""Streaming reads and writes of compressed corpus files.
+
+Data files may be stored gzip, bzip2, xz or zstd compressed; the format is
+recognized by the file's magic bytes (or its extension, for files that do
+not exist yet). open_input decompresses in a background thread that keeps a
+few blocks ahead of the reader, so decompression overlaps tokenization
+instead of needing a decompressed copy on disk. The zstd format requires
+the optional `zstandard` package.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import threading
+
+from six.moves import queue
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+GZIP = "gzip"
+BZ2 = "bz2"
+XZ = "xz"
+ZSTD = "zstd"
+
+EXTENSIONS = {GZIP: ".gz", BZ2: ".bz2", XZ: ".xz", ZSTD: ".zst"}
+_MAGIC = ((b"\x1f\x8b", GZIP), (b"BZh", BZ2), (b"\xfd7zXZ\x00", XZ),
+          (b"\x28\xb5\x2f\xfd", ZSTD))
+
+_BLOCK_BYTES = 1 << 20
+# Decompressed blocks the background thread may hold ahead of the reader.
+_READ_AHEAD_BLOCKS = 8
+_GZIP_LEVEL = 6
+
+
+def compression(path):
+  """Returns the compression format of a file, None if it is not compressed."""
+  if os.path.isfile(path):
+    with open(path, "rb") as f:
+      head = f.read(6)
+    for magic, name in _MAGIC:
+      if head.startswith(magic):
+        return name
+    return None
+  for name, extension in EXTENSIONS.items():
+    if path.endswith(extension):
+      return name
+  return None
+
+
+def strip_extension(path):
+  """Removes the compression extension of a path, if it has one."""
+  for extension in EXTENSIONS.values():
+    if path.endswith(extension):
+      return path[:-len(extension)]
+  return path
+
+
+def _zstandard():
+  if zstandard is None:
+    raise ValueError("zstd compressed files require the zstandard package.")
+  return zstandard
+
+
+def _open_decompressed(path, name):
+  if name == GZIP:
+    return gzip.open(path, "rb")
+  if name == BZ2:
+    return bz2.open(path, "rb")
+  if name == XZ:
+    return lzma.open(path, "rb")
+  if name == ZSTD:
+    return _zstandard().ZstdDecompressor().stream_reader(
+        open(path, "rb"), closefd=True)
+  raise ValueError("Unknown compression %s." % name)
+
+
+class _ReadAheadStream(io.RawIOBase):
+  """Raw stream fed with the blocks a background thread reads from `stream`.
+
+  zlib, bz2, lzma and zstandard release the GIL while decompressing, so the
+  thread runs in parallel with the consumer.
+  """
+
+  def __init__(self, stream):
+    super(_ReadAheadStream, self).__init__()
+    self._stream = stream
+    self._blocks = queue.Queue(_READ_AHEAD_BLOCKS)
+    self._pending = b""
+    self._eof = False
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._read_ahead)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _read_ahead(self):
+    try:
+      while not self._stop.is_set():
+        block = self._stream.read(_BLOCK_BYTES)
+        self._put(block)
+        if not block:
+          return
+    except Exception as e:  # Re-raised in the consumer.
+      self._put(e)
+
+  def _put(self, item):
+    while not self._stop.is_set():
+      try:
+        self._blocks.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    if not self._pending and not self._eof:
+      block = self._blocks.get()
+      if isinstance(block, Exception):
+        raise block
+      self._eof = not block
+      self._pending = block
+    n = min(len(b), len(self._pending))
+    b[:n] = self._pending[:n]
+    self._pending = self._pending[n:]
+    return n
+
+  def close(self):
+    if not self.closed:
+      self._stop.set()
+      self._thread.join()
+      self._stream.close()
+    super(_ReadAheadStream, self).close()
+
+
+def open_input(path, text=False):
+  """Opens a data file for reading, decompressing it if it is compressed.
+
+  Args:
+    path: path of the file.
+    text: if true, returns a utf-8 text stream, otherwise a binary one.
+      Its lines end at "\n" only, like those of gfile and the binary
+      readers, so every reader counts the same lines.
+  """
+  name = compression(path)
+  if name is None:
+    if text:
+      return io.open(path, "r", encoding="utf-8", newline="\n")
+    return io.open(path, "rb")
+  stream = io.BufferedReader(
+      _ReadAheadStream(_open_decompressed(path, name)), _BLOCK_BYTES)
+  if text:
+    return io.TextIOWrapper(stream, encoding="utf-8", newline="\n")
+  return stream
+
+
+def open_output(path, name=None, text=True):
+  """Opens a file for writing, compressed with the format `name` if given."""
+  if name is None:
+    if text:
+      return io.open(path, "w", encoding="utf-8", newline="\n")
+    return io.open(path, "wb")
+  if name == GZIP:
+    stream = gzip.open(path, "wb", compresslevel=_GZIP_LEVEL)
+  elif name == BZ2:
+    stream = bz2.open(path, "wb")
+  elif name == XZ:
+    stream = lzma.open(path, "wb")
+  elif name == ZSTD:
+    stream = _zstandard().ZstdCompressor().stream_writer(
+        open(path, "wb"), closefd=True)
+  else:
+    raise ValueError("Unknown compression %s." % name)
+  if text:
+    return io.TextIOWrapper(stream, encoding="utf-8", newline="\n")
+  return stream
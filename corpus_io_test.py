@@ -0,0 +1,38 @@
+"""Tests for corpus_io."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import corpus_io
+
+
+class OpenInputTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def testTextLinesEndAtNewlineOnly(self):
+    data = b"carriage\rreturn\nwindows\r\nform\x0cfeed\n"
+    plain_path = os.path.join(self.scratch, "data.txt")
+    with open(plain_path, "wb") as f:
+      f.write(data)
+    gzip_path = os.path.join(self.scratch, "data.txt.gz")
+    with gzip.open(gzip_path, "wb") as f:
+      f.write(data)
+    for path in (plain_path, gzip_path):
+      with corpus_io.open_input(path, text=True) as f:
+        self.assertEqual(["carriage\rreturn\n", "windows\r\n",
+                          "form\x0cfeed\n"], list(f))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -18,13 +18,28 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import contextlib
+import functools
+import heapq
+import itertools
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
+import threading
 
 from six.moves import urllib
 
 from tensorflow.python.platform import gfile
 
+import artifact_cache
+import bpe
+import corpus_io
+import token_corpus
+import token_counts
+
 # Special vocabulary symbols - we always put them at the start.
 _PAD = "_PAD"
 _GO = "_GO"
@@ -37,55 +52,547 @@ GO_ID = 1
 EOS_ID = 2
 UNK_ID = 3
 
+# Suffix of the token counts saved next to a vocabulary file (a header with
+# the same name plus ".json" goes with them), see create_vocabulary.
+COUNTS_SUFFIX = ".counts"
+
 # Regular expressions used to tokenize.
 _WORD_SPLIT = re.compile("([.,!?\"':;)(])")
 _DIGIT_RE = re.compile("\d")
+# Single-pass equivalent of basic_tokenizer: a token is either one of the
+# _WORD_SPLIT punctuation marks or a maximal run of characters that are
+# neither punctuation nor whitespace.
+_TOKEN_RE = re.compile("[.,!?\"':;)(]|[^\\s.,!?\"':;)(]+")
 
+# Number of lines handed to the batch tokenizer at a time.
+_TOKENIZE_CHUNK_LINES = 10000
+# Approximate size of the chunks tokenized by each pool task.
+_TOKENIZE_CHUNK_BYTES = 4 << 20
 
 
+def _as_text(line):
+  """Decodes utf-8 bytes (as read from files opened in binary mode) to str."""
+  if isinstance(line, bytes):
+    return line.decode("utf-8")
+  return line
+
 def basic_tokenizer(sentence):
   """Very basic tokenizer: split the sentence into a list of tokens."""
-  words = []
-  for space_separated_fragment in sentence.strip().split():
-    words.extend(re.split(_WORD_SPLIT, space_separated_fragment))
-  return [w for w in words if w]
+  return _TOKEN_RE.findall(_as_text(sentence))
+
+
+class BatchTokenizer(object):
+  """Tokenizes batches of lines and maps them to token-ids.
+
+  This is the engine shared by vocabulary creation, data_to_token_ids and
+  the decoders. It yields exactly the tokens of basic_tokenizer and exactly
+  the ids of the historical per-token sentence_to_token_ids, but runs one
+  compiled pattern per line and normalizes digits once per line instead of
+  once per token. Custom tokenizers are still called as before, with digits
+  normalized per token since their splitting may depend on digits.
+  """
+
+  def __init__(self, vocabulary=None, tokenizer=None, normalize_digits=True):
+    """Create the tokenizer.
+
+    Args:
+      vocabulary: a dictionary mapping tokens to integers; only needed by
+        encode and encode_batch.
+      tokenizer: a function to use to tokenize each sentence;
+        if None, basic_tokenizer will be used.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    """
+    self.vocabulary = vocabulary
+    self.tokenizer = tokenizer
+    self.normalize_digits = normalize_digits
+
+  def tokenize(self, line):
+    """Returns the (digit-normalized) tokens of a single line."""
+    if self.tokenizer:
+      words = self.tokenizer(line)
+      if self.normalize_digits:
+        return [_DIGIT_RE.sub("0", w) for w in words]
+      return words
+    line = _as_text(line)
+    if self.normalize_digits:
+      line = _DIGIT_RE.sub("0", line)
+    return _TOKEN_RE.findall(line)
+
+  def tokenize_batch(self, lines):
+    """Returns a list with the tokens of every line in `lines`."""
+    if self.tokenizer:
+      return [self.tokenize(line) for line in lines]
+    findall = _TOKEN_RE.findall
+    if self.normalize_digits:
+      sub = _DIGIT_RE.sub
+      return [findall(sub("0", _as_text(line))) for line in lines]
+    return [findall(_as_text(line)) for line in lines]
+
+  def encode(self, line):
+    """Returns the token-ids of a single line."""
+    get = self.vocabulary.get
+    return [get(w, UNK_ID) for w in self.tokenize(line)]
+
+  def encode_batch(self, lines):
+    """Returns a list with the token-ids of every line in `lines`.
+
+    Args:
+      lines: a list or any other iterable of str or utf-8 bytes lines.
+    """
+    get = self.vocabulary.get
+    return [[get(w, UNK_ID) for w in words]
+            for words in self.tokenize_batch(lines)]
+
+
+def _open_data(data_path, mode="rb"):
+  """Opens a data file, decompressing it in the background if compressed."""
+  if corpus_io.compression(data_path):
+    return corpus_io.open_input(data_path, text="b" not in mode)
+  return gfile.GFile(data_path, mode=mode)
+
+
+def _line_chunks(data_path, num_lines=_TOKENIZE_CHUNK_LINES):
+  """Yields the lines of a (possibly compressed) file in lists of num_lines."""
+  with _open_data(data_path) as f:
+    while True:
+      lines = list(itertools.islice(f, num_lines))
+      if not lines:
+        return
+      yield lines
+
+
+def _imap_bounded(pool, func, tasks, max_pending):
+  """Like pool.imap, but consumes `tasks` only max_pending ahead of results.
+
+  pool.imap reads its whole input up front, which for the chunks of a
+  decompressed stream would hold the file in memory.
+  """
+  pending = collections.deque()
+  for task in tasks:
+    pending.append(pool.apply_async(func, (task,)))
+    if len(pending) >= max_pending:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+
+def _resolve_num_workers(num_workers):
+  """Maps a num_workers setting of 0 (or less) to the number of CPU cores."""
+  if num_workers > 0:
+    return num_workers
+  return multiprocessing.cpu_count()
+
+
+def _shard_ranges(data_path, num_shards, start=0):
+  """Splits a file into at most num_shards byte ranges of similar size.
+
+  Every range starts at the beginning of a line and ends right after a
+  newline (or at the end of the file), so each line belongs to exactly one
+  range and the ranges, read in order, reproduce the file.
+
+  Args:
+    data_path: path of the file.
+    num_shards: maximum number of ranges.
+    start: offset of the first range, which must be the start of a line.
+
+  Returns:
+    a list of (start, end) byte offsets.
+  """
+  size = os.path.getsize(data_path)
+  bounds = [start]
+  with open(data_path, "rb") as f:
+    for i in range(1, num_shards):
+      offset = max(start + (size - start) * i // num_shards, bounds[-1])
+      if offset >= size:
+        break
+      if offset > 0:
+        # Move the boundary past the end of the line containing offset - 1.
+        f.seek(offset - 1)
+        f.readline()
+        offset = f.tell()
+      if offset > bounds[-1] and offset < size:
+        bounds.append(offset)
+  bounds.append(size)
+  return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def _count_shard(args):
+  """Pool worker: counts the tokens in one byte range of a file.
+
+  The returned Counter keeps its keys in order of first appearance, so
+  merging the shard counters in shard order yields the same key order as
+  counting the whole file serially.
+  """
+  data_path, start, end, tokenizer, normalize_digits = args
+  engine = BatchTokenizer(tokenizer=tokenizer,
+                          normalize_digits=normalize_digits)
+  counts = collections.Counter()
+  with open(data_path, "rb") as f:
+    f.seek(start)
+    position = start
+    while position < end:
+      line = f.readline()
+      if not line:
+        break
+      position += len(line)
+      counts.update(engine.tokenize(line))
+  return counts
+
+
+def _count_lines(args):
+  """Pool worker: counts the tokens of a list of lines."""
+  lines, tokenizer, normalize_digits = args
+  engine = BatchTokenizer(tokenizer=tokenizer,
+                          normalize_digits=normalize_digits)
+  counts = collections.Counter()
+  for line in lines:
+    counts.update(engine.tokenize(line))
+  return counts
+
+
+@contextlib.contextmanager
+def _worker_pool(num_workers, pool=None):
+  """Yields `pool` if given, otherwise a new pool that is closed afterwards."""
+  if pool is not None:
+    yield pool
+    return
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    yield pool
+  finally:
+    pool.close()
+    pool.join()
+
+
+def _count_tokens_parallel(data_path, num_workers, tokenizer,
+                           normalize_digits, pool=None):
+  """Counts tokens of a local file with one pool worker per byte range.
+
+  Compressed files cannot be split into byte ranges; their decompressed
+  lines are handed to the pool in chunks instead.
+  """
+  if corpus_io.compression(data_path):
+    print("  counting chunks of %d lines with %d workers"
+          % (_TOKENIZE_CHUNK_LINES, num_workers))
+    tasks = ((lines, tokenizer, normalize_digits)
+             for lines in _line_chunks(data_path))
+    with _worker_pool(num_workers, pool) as pool:
+      vocab = collections.Counter()
+      for counts in _imap_bounded(pool, _count_lines, tasks, 2 * num_workers):
+        vocab.update(counts)
+    return vocab
+  shards = _shard_ranges(data_path, num_workers)
+  tasks = [(data_path, start, end, tokenizer, normalize_digits)
+           for start, end in shards]
+  print("  counting %d shards with %d workers" % (len(tasks), num_workers))
+  with _worker_pool(min(num_workers, len(tasks)), pool) as pool:
+    vocab = collections.Counter()
+    # imap returns the shards in order, which keeps the merge deterministic.
+    for counts in pool.imap(_count_shard, tasks):
+      vocab.update(counts)
+  return vocab
+
+
+def _count_tokens(data_path, tokenizer=None, normalize_digits=True,
+                  num_workers=1, pool=None):
+  """Returns a dict of token counts, in order of first appearance."""
+  num_workers = _resolve_num_workers(num_workers)
+  if num_workers > 1:
+    return _count_tokens_parallel(data_path, num_workers, tokenizer,
+                                  normalize_digits, pool)
+  vocab = {}
+  engine = BatchTokenizer(tokenizer=tokenizer,
+                          normalize_digits=normalize_digits)
+  with _open_data(data_path) as f:
+    counter = 0
+    for line in f:
+      counter += 1
+      if counter % 1000 == 0:
+        print("  processing line %d" % counter)
+      for word in engine.tokenize(line):
+        if word in vocab:
+          vocab[word] += 1
+        else:
+          vocab[word] = 1
+  return vocab
+
+
+def _is_start_symbol(word):
+  """Whether a counted token is one of _START_VOCAB.
+
+  The data can contain them (e.g. "_UNK" in the text of decoded headlines):
+  they already have their ids and must not get a second, later one.
+  """
+  return _as_text(word) in _START_VOCAB
+
+
+def _top_vocabulary(vocab, max_vocabulary_size):
+  """Returns _START_VOCAB followed by the most frequent words of vocab.
+
+  Uses a partial selection instead of a full sort. Ties are broken by the
+  order of the keys of vocab (order of first appearance in the data), which
+  matches what a stable sort by descending count produces. The _START_VOCAB
+  symbols counted in the data are left out.
+  """
+  num_words = max(max_vocabulary_size - len(_START_VOCAB), 0)
+  return _START_VOCAB + heapq.nlargest(
+      num_words, (w for w in vocab if not _is_start_symbol(w)),
+      key=vocab.get)
+
+
+def _count_shard_bounded(args):
+  """Pool worker: counts one byte range of a file with a SpillingCounter.
+
+  An `end` of None counts the whole file, decompressing it if needed; the
+  positions are then offsets in the decompressed data.
+
+  Returns:
+    the run files, the counts high-water mark and the worker's peak RSS.
+  """
+  (data_path, start, end, tokenizer, normalize_digits, max_memory_bytes,
+   spill_dir, block_entries) = args
+  engine = BatchTokenizer(tokenizer=tokenizer,
+                          normalize_digits=normalize_digits)
+  counter = token_counts.SpillingCounter(max_memory_bytes, spill_dir,
+                                         block_entries)
+  if end is None:
+    data_file, end = _open_data(data_path), float("inf")
+  else:
+    data_file = open(data_path, "rb")
+    data_file.seek(start)
+  with data_file as f:
+    position = start
+    while position < end:
+      line = f.readline()
+      if not line:
+        break
+      counter.update(engine.tokenize(line), position)
+      position += len(line)
+  return (counter.finish(), counter.peak_memory_bytes,
+          token_counts.peak_rss_bytes())
+
+
+def _count_runs(data_path, tokenizer, normalize_digits, num_workers, pool,
+                max_memory_mb, spill_dir, budget, start=0):
+  """Counts a local file from byte `start` into token-sorted run files.
+
+  Every byte-range shard spills its counts to spill_dir once they exceed
+  its share of max_memory_mb (never, if it is 0), in runs of the blocks of
+  budget, a token_counts.RunBudget.
+
+  Returns:
+    the paths of the runs, the sum of the shards' counts high-water marks
+    and the peak RSS of the workers (None if it cannot be measured).
+  """
+  num_workers = _resolve_num_workers(num_workers)
+  if corpus_io.compression(data_path):
+    # A compressed stream can only be read from its start, by one counter.
+    shards = [(0, None)]
+  else:
+    shards = _shard_ranges(data_path, num_workers, start)
+  if max_memory_mb > 0:
+    max_memory_bytes = max_memory_mb * (1 << 20) // len(shards)
+  else:
+    max_memory_bytes = float("inf")
+  tasks = [(data_path, shard_start, end, tokenizer, normalize_digits,
+            max_memory_bytes, spill_dir, budget.block_entries)
+           for shard_start, end in shards]
+  if len(tasks) > 1:
+    print("  counting %d shards with %d workers" % (len(tasks), num_workers))
+    with _worker_pool(min(num_workers, len(tasks)), pool) as pool:
+      results = pool.map(_count_shard_bounded, tasks)
+  else:
+    results = [_count_shard_bounded(tasks[0])]
+  runs = [path for shard_runs, _, _ in results for path in shard_runs]
+  # The shards may all count at the same time, so their peaks add up.
+  peak_counts = sum(peak for _, peak, _ in results)
+  peak_rss = [rss for _, _, rss in results if rss is not None]
+  return runs, peak_counts, max(peak_rss) if peak_rss else None
+
+
+def _report_count_memory(num_runs, peak_counts, worker_rss, budget,
+                         max_memory_mb):
+  """Prints the high-water marks of counting, merging and selection."""
+  peak_rss = [rss for rss in (worker_rss, token_counts.peak_rss_bytes())
+              if rss is not None]
+  print("  %d spilled runs; high-water mark %.1f MB of %d MB (counting %.1f "
+        "MB, merging and selection %.1f MB), peak RSS %s"
+        % (num_runs, max(peak_counts, budget.peak_memory_bytes) / 2.0**20,
+           max_memory_mb, peak_counts / 2.0**20,
+           budget.peak_memory_bytes / 2.0**20,
+           "%.1f MB" % (max(peak_rss) / 2.0**20) if peak_rss else "unknown"))
+
+
+def _counts_header(data_path, tokenizer, normalize_digits):
+  data_bytes = os.path.getsize(data_path)
+  return {"data_bytes": data_bytes,
+          "data_sha256": token_counts.prefix_digest(data_path, data_bytes),
+          "tokenizer": _tokenizer_name(tokenizer),
+          "normalize_digits": normalize_digits}
+
+
+def _reusable_counts(vocabulary_path, data_path, tokenizer, normalize_digits):
+  """Returns how many bytes of data_path the saved counts cover.
+
+  The counts saved next to vocabulary_path can be reused if they were made
+  with the same tokenization from a prefix of data_path whose bytes are
+  unchanged (same sha256), i.e. data was only appended since. Returns None
+  if they cannot be reused.
+  """
+  header = token_counts.load_header(vocabulary_path + COUNTS_SUFFIX)
+  if header is None:
+    return None
+  if corpus_io.compression(data_path):
+    print("  %s is compressed, appended data cannot be located" % data_path)
+    return None
+  data_bytes = header["data_bytes"]
+  if (header["tokenizer"] != _tokenizer_name(tokenizer) or
+      header["normalize_digits"] != normalize_digits):
+    print("  saved counts of %s used another tokenization" % vocabulary_path)
+    return None
+  if (os.path.getsize(data_path) < data_bytes or
+      token_counts.prefix_digest(data_path, data_bytes) !=
+      header["data_sha256"]):
+    print("  %s was modified, not only appended to" % data_path)
+    return None
+  return data_bytes
+
+
+def _report_id_shift(previous_vocabulary_path, vocab_list):
+  """Prints how many ids of a previous vocabulary map to another word now.
+
+  Returns:
+    the number of ids of the previous vocabulary whose word changed.
+  """
+  with gfile.GFile(previous_vocabulary_path, mode="rb") as f:
+    previous = [_as_text(line.strip()) for line in f]
+  current = [_as_text(w) for w in vocab_list]
+  shifted = sum(1 for old, new in zip(previous, current) if old != new)
+  shifted += max(len(previous) - len(current), 0)
+  added = len(set(current) - set(previous))
+  print("  %d of %d ids now map to another word (%d words added, %d dropped)"
+        % (shifted, len(previous), added, len(set(previous) - set(current))))
+  if shifted:
+    print("  checkpoints trained with %s are NOT compatible"
+          % previous_vocabulary_path)
+  else:
+    print("  checkpoints trained with %s remain compatible"
+          % previous_vocabulary_path)
+  return shifted
 
 
 def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
-                      tokenizer=None, normalize_digits=True):
-    
+                      tokenizer=None, normalize_digits=True, num_workers=1,
+                      pool=None, max_memory_mb=0, previous_vocabulary=None):
+  """Create vocabulary file (if it does not exist yet) from data file.
+
+  The token counts are saved next to the vocabulary (see COUNTS_SUFFIX).
+
+  Args:
+    vocabulary_path: path where the vocabulary will be created.
+    data_path: data file that will be used to create vocabulary.
+    max_vocabulary_size: limit on the size of the created vocabulary.
+    tokenizer: a function to use to tokenize each data sentence;
+      if None, basic_tokenizer will be used.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    num_workers: number of processes counting byte-range shards of
+      data_path in parallel; 1 counts in this process and 0 uses all cores.
+      The vocabulary file is identical for every setting.
+    pool: optional multiprocessing.Pool to run the shards on.
+    max_memory_mb: if positive, bounds the memory used by the token counts:
+      past it, partial counts are spilled to a temporary directory next to
+      vocabulary_path and merged at the end. The vocabulary is still exact
+      and identical.
+    previous_vocabulary: optional path of a vocabulary created earlier from
+      data_path. If data was only appended to data_path since, its saved
+      counts are reused and just the appended data is counted; how many ids
+      changed compared to it is reported either way.
+  """
   if not gfile.Exists(vocabulary_path):
     print("Creating vocabulary %s from %s" % (vocabulary_path, data_path))
-    vocab = {}
-    with gfile.GFile(data_path, mode="rb") as f:
-      counter = 0
-      for line in f:
-        counter += 1
-        if counter % 1000 == 0:
-          print("  processing line %d" % counter)
-        tokens = tokenizer(line) if tokenizer else basic_tokenizer(line)
-        for w in tokens:
-          word = re.sub(_DIGIT_RE, "0", w) if normalize_digits else w
-          if word in vocab:
-            vocab[word] += 1
-          else:
-            vocab[word] = 1
-      vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
-      print('>> Full Vocabulary Size :',len(vocab_list))
-      if len(vocab_list) > max_vocabulary_size:
-        vocab_list = vocab_list[:max_vocabulary_size]
-      with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
-        for w in vocab_list:
-          vocab_file.write(w + "\n")
+    counts_path = vocabulary_path + COUNTS_SUFFIX
+    header = _counts_header(data_path, tokenizer, normalize_digits)
+    header["token_sorted"] = True
+    start = None
+    if previous_vocabulary:
+      start = _reusable_counts(previous_vocabulary, data_path, tokenizer,
+                               normalize_digits)
+    num_words = max(max_vocabulary_size - len(_START_VOCAB), 0)
+    if start is not None or max_memory_mb > 0:
+      spill_dir = tempfile.mkdtemp(
+          prefix=".counts", dir=os.path.dirname(os.path.abspath(vocabulary_path)))
+      # The merges, sorts and selection after the counting keep to the
+      # whole budget: they run once the counting shards are done.
+      budget = token_counts.RunBudget(
+          max_memory_mb * (1 << 20) if max_memory_mb > 0 else float("inf"))
+      try:
+        runs, peak_counts, worker_rss = _count_runs(
+            data_path, tokenizer, normalize_digits, num_workers, pool,
+            max_memory_mb, spill_dir, budget, start or 0)
+        if start is not None:
+          print("  merging the counts of %d appended bytes with the %d bytes "
+                "counted for %s" % (header["data_bytes"] - start, start,
+                                    previous_vocabulary))
+          runs.extend(token_counts.sorted_runs(
+              previous_vocabulary + COUNTS_SUFFIX, spill_dir, budget))
+        token_counts.write_counts(
+            counts_path, token_counts.merge_runs(runs, spill_dir, budget),
+            budget.block_entries)
+        header["block_entries"] = budget.block_entries
+      finally:
+        shutil.rmtree(spill_dir)
+      words, num_distinct = token_counts.most_common(
+          (entry for entry in token_counts.read_counts(counts_path)
+           if not _is_start_symbol(entry[0])), num_words, budget)
+      if max_memory_mb > 0:
+        _report_count_memory(len(runs), peak_counts, worker_rss, budget,
+                             max_memory_mb)
+      vocab_list = _START_VOCAB + words
+    else:
+      vocab = _count_tokens(data_path, tokenizer, normalize_digits,
+                            num_workers, pool)
+      num_distinct = sum(1 for w in vocab if not _is_start_symbol(w))
+      vocab_list = _top_vocabulary(vocab, max_vocabulary_size)
+      # Only the order of the first appearances is known here, not their
+      # byte offsets: key them (0, rank), which still sorts them before any
+      # data appended later. They are saved in that order, not sorted by
+      # token: only reusing them needs that (token_counts.sorted_runs).
+      # The smallest blocks let any memory budget read them back.
+      token_counts.write_counts(
+          counts_path,
+          ((w, count, 0, rank)
+           for rank, (w, count) in enumerate(vocab.items())),
+          token_counts.MIN_BLOCK_ENTRIES)
+      header["token_sorted"] = False
+      header["block_entries"] = token_counts.MIN_BLOCK_ENTRIES
+    token_counts.save_header(counts_path, header)
+    print('>> Full Vocabulary Size : %d' % (len(_START_VOCAB) + num_distinct))
+    with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
+      for w in vocab_list:
+        vocab_file.write((_as_text(w) + "\n").encode("utf-8"))
+    if previous_vocabulary and gfile.Exists(previous_vocabulary):
+      _report_id_shift(previous_vocabulary, vocab_list)
 
 
 def initialize_vocabulary(vocabulary_path):
+  """Initialize vocabulary from file.
+
+  Words are returned as str (the file is utf-8), matching the str tokens
+  that sentence_to_token_ids looks up. For decoding, vocabulary.Vocabulary
+  offers the same mapping without building the dict in every process.
+
+  Returns:
+    a pair: the vocabulary (a dictionary mapping string to integers), and
+    the reversed vocabulary (a list, which reverses the vocabulary mapping).
 
+  Raises:
+    ValueError: if the provided vocabulary_path does not exist.
+  """
   if gfile.Exists(vocabulary_path):
     rev_vocab = []
     with gfile.GFile(vocabulary_path, mode="rb") as f:
       rev_vocab.extend(f.readlines())
-    rev_vocab = [line.strip() for line in rev_vocab]
+    rev_vocab = [_as_text(line.strip()) for line in rev_vocab]
     vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
     return vocab, rev_vocab
   else:
@@ -94,53 +601,389 @@ def initialize_vocabulary(vocabulary_path):
 
 def sentence_to_token_ids(sentence, vocabulary, tokenizer=None, normalize_digits=True):
 
-  if tokenizer:
-    words = tokenizer(sentence)
-  else:
-    words = basic_tokenizer(sentence)
-  if not normalize_digits:
-    return [vocabulary.get(w, UNK_ID) for w in words]
   # Normalize digits by 0 before looking words up in the vocabulary.
-  return [vocabulary.get(re.sub(_DIGIT_RE, "0", w), UNK_ID) for w in words]
+  return BatchTokenizer(vocabulary, tokenizer, normalize_digits).encode(sentence)
+
+
+def _ids_path(working_directory, data_path, vocabulary_size, corpus_format,
+              compression=None):
+  """Path of the token-ids produced from data_path in the given format.
+
+  They are written in working_directory, whose vocabulary they depend on,
+  not next to the data: working directories sharing data files (e.g. a
+  distillation student and its teacher) would overwrite each other's.
+  Text token-ids compressed with `compression` get its extension; binary
+  corpora are memory-mapped and cannot be compressed.
+  """
+  data_path = os.path.join(
+      working_directory,
+      os.path.basename(corpus_io.strip_extension(data_path)))
+  if corpus_format == "binary":
+    if compression:
+      raise ValueError("Binary corpora cannot be compressed.")
+    return data_path + (".bin%d" % vocabulary_size)
+  if corpus_format == "text":
+    return data_path + (".ids%d" % vocabulary_size) + (
+        corpus_io.EXTENSIONS[compression] if compression else "")
+  raise ValueError("Unknown corpus format %s." % corpus_format)
+
+
+def _ids_exist(target_path, corpus_format):
+  if corpus_format == "binary":
+    return token_corpus.exists(target_path)
+  return gfile.Exists(target_path)
+
+
+# Per-process cache of the vocabularies used by _tokenize_chunk.
+_worker_vocabularies = {}
+
+
+def _tokenize_chunk(args):
+  """Pool worker: converts one byte range of a file to token-ids.
+
+  Returns the serialized chunk, ready to be appended to the target: the
+  text lines for the "text" format, (lengths, tokens) arrays for "binary".
+  """
+  (data_path, start, end, vocabulary_path, tokenizer, normalize_digits,
+   corpus_format) = args
+  with open(data_path, "rb") as f:
+    f.seek(start)
+    # Lines end at "\n" only, as in the serial path (splitlines would also
+    # break them at "\r", "\x0c", ...).
+    lines = f.read(end - start).split(b"\n")
+  if lines[-1] == b"":
+    lines.pop()  # The chunk ends with a line break.
+  return _tokenize_lines((lines, vocabulary_path, tokenizer, normalize_digits,
+                          corpus_format))
+
+
+def _tokenize_lines(args):
+  """Pool worker: converts a list of lines to token-ids, see _tokenize_chunk."""
+  lines, vocabulary_path, tokenizer, normalize_digits, corpus_format = args
+  if vocabulary_path not in _worker_vocabularies:
+    _worker_vocabularies[vocabulary_path] = initialize_vocabulary(
+        vocabulary_path)[0]
+  vocab = _worker_vocabularies[vocabulary_path]
+  token_ids = BatchTokenizer(vocab, tokenizer,
+                             normalize_digits).encode_batch(lines)
+  if corpus_format == "binary":
+    return token_corpus.to_arrays(token_ids, len(vocab))
+  return "".join(" ".join([str(tok) for tok in ids]) + "\n"
+                 for ids in token_ids)
+
+
+def _open_token_ids(target_path, vocabulary_path, corpus_format, compression):
+  """Opens the writer of a token-ids file."""
+  if corpus_format == "binary":
+    vocab_size = len(initialize_vocabulary(vocabulary_path)[1])
+    return token_corpus.TokenCorpusWriter(target_path, vocab_size)
+  if compression:
+    return corpus_io.open_output(target_path, compression)
+  return gfile.GFile(target_path, mode="w")
+
+
+def _data_to_token_ids_parallel(data_path, target_path, vocabulary_path,
+                                tokenizer, normalize_digits, corpus_format,
+                                num_workers, pool=None, compression=None):
+  """Converts byte-range chunks of data_path on a pool, in line order.
+
+  Compressed files are decompressed here and their lines handed to the
+  pool in chunks of _TOKENIZE_CHUNK_LINES.
+  """
+  if corpus_io.compression(data_path):
+    tasks = ((lines, vocabulary_path, tokenizer, normalize_digits,
+              corpus_format) for lines in _line_chunks(data_path))
+    worker, num_tasks = _tokenize_lines, None
+  else:
+    num_chunks = max(num_workers,
+                     os.path.getsize(data_path) // _TOKENIZE_CHUNK_BYTES)
+    tasks = [(data_path, start, end, vocabulary_path, tokenizer,
+              normalize_digits, corpus_format)
+             for start, end in _shard_ranges(data_path, num_chunks)]
+    worker, num_tasks = _tokenize_chunk, len(tasks)
+  tokens_file = _open_token_ids(target_path, vocabulary_path, corpus_format,
+                                compression)
+  with _worker_pool(num_workers, pool) as pool:
+    with tokens_file:
+      # The chunks come back in submission order, i.e. line order.
+      chunks = _imap_bounded(pool, worker, tasks, 2 * num_workers)
+      for counter, chunk in enumerate(chunks, 1):
+        if corpus_format == "binary":
+          tokens_file.write_arrays(*chunk)
+        else:
+          tokens_file.write(chunk)
+        print("  tokenized chunk %d%s of %s"
+              % (counter, "/%d" % num_tasks if num_tasks else "", data_path))
 
 
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True,
+                      corpus_format="text", num_workers=1, pool=None,
+                      compression=None):
+  """Tokenize data file and turn into token-ids using given vocabulary file.
 
-  if not gfile.Exists(target_path):
+  Args:
+    data_path: path to the data file in one-sentence-per-line format; it
+      may be gzip, bzip2, xz or zstd compressed.
+    target_path: path where the file with token-ids will be created.
+    vocabulary_path: path to the vocabulary file.
+    tokenizer: a function to use to tokenize each sentence;
+      if None, basic_tokenizer will be used.
+    normalize_digits: Boolean; if true, all digits are replaced by 0s.
+    corpus_format: "text" writes one line of space-separated ids per
+      sentence, "binary" writes a memory-mappable token_corpus.
+    num_workers: number of processes tokenizing chunks of data_path in
+      parallel; 1 tokenizes in this process and 0 uses all cores. The
+      output is identical for every setting.
+    pool: optional multiprocessing.Pool to run the chunks on.
+    compression: optional format ("gzip", "bz2", "xz" or "zstd") the text
+      token-ids are compressed with.
+  """
+  if not _ids_exist(target_path, corpus_format):
     print("Tokenizing data in %s" % data_path)
+    num_workers = _resolve_num_workers(num_workers)
+    if num_workers > 1:
+      _data_to_token_ids_parallel(data_path, target_path, vocabulary_path,
+                                  tokenizer, normalize_digits, corpus_format,
+                                  num_workers, pool, compression)
+      return
     vocab, _ = initialize_vocabulary(vocabulary_path)
-    with gfile.GFile(data_path, mode="r") as data_file:
-      with gfile.GFile(target_path, mode="w") as tokens_file:
+    engine = BatchTokenizer(vocab, tokenizer, normalize_digits)
+    with _open_data(data_path, mode="r") as data_file:
+      tokens_file = _open_token_ids(target_path, vocabulary_path,
+                                    corpus_format, compression)
+      with tokens_file:
         counter = 0
-        for line in data_file:
-          counter += 1
-          if counter % 1000 == 0:
-            print("  tokenizing line %d" % counter)
-          token_ids = sentence_to_token_ids(line, vocab, tokenizer,
-                                            normalize_digits)
-          tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
+        while True:
+          lines = list(itertools.islice(data_file, _TOKENIZE_CHUNK_LINES))
+          if not lines:
+            break
+          counter += len(lines)
+          print("  tokenizing line %d" % counter)
+          if corpus_format == "binary":
+            tokens_file.write_batch(engine.encode_batch(lines))
+          else:
+            tokens_file.writelines(
+                " ".join([str(tok) for tok in token_ids]) + "\n"
+                for token_ids in engine.encode_batch(lines))
+
+
+def _run_in_threads(functions):
+  """Runs the given functions in parallel threads, re-raising any error."""
+  errors = []
+
+  def run(function):
+    try:
+      function()
+    except BaseException as e:  # pylint: disable=broad-except
+      errors.append(e)
+  threads = [threading.Thread(target=run, args=(f,)) for f in functions]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
+
+
+def _tokenizer_name(tokenizer):
+  if tokenizer is None:
+    return "basic_tokenizer"
+  # BPE tokenizers are identified by their merges.
+  return getattr(tokenizer, "fingerprint",
+                 getattr(tokenizer, "__name__", type(tokenizer).__name__))
+
+
+def bpe_codes_path(working_directory, num_merges):
+  return os.path.join(working_directory, "bpe%d.codes" % num_merges)
+
+
+def learn_bpe(codes_path, data_paths, num_merges, normalize_digits=True,
+              num_workers=1, pool=None):
+  """Learns BPE merges from the words of data_paths and saves them."""
+  print("Learning %d BPE merges from %s" % (num_merges, ", ".join(data_paths)))
+  word_counts = collections.Counter()
+  for data_path in data_paths:
+    word_counts.update(_count_tokens(data_path, None, normalize_digits,
+                                     num_workers, pool))
+  bpe.save_merges(codes_path, bpe.learn_merges(word_counts, num_merges))
+
+
+def load_bpe_tokenizer(codes_path, normalize_digits=True):
+  """Returns the bpe.BPETokenizer of a codes file written by learn_bpe."""
+  return bpe.BPETokenizer(
+      bpe.load_merges(codes_path),
+      BatchTokenizer(normalize_digits=normalize_digits).tokenize)
+
+
+def _cached_bpe(cache, codes_path, data_paths, num_merges, num_workers=1,
+                pool=None):
+  """learn_bpe, skipped if the manifest says the codes are up to date."""
+  params = {"artifact": "bpe", "num_merges": num_merges,
+            "normalize_digits": True}
+  inputs = cache.fingerprints(data_paths)
+  if cache.is_fresh(codes_path, inputs, params, [codes_path]):
+    print("BPE codes %s are up to date" % codes_path)
+    return
+  tmp_path = cache.temp_path(codes_path)
+  with _removed_on_error([tmp_path]):
+    learn_bpe(tmp_path, data_paths, num_merges, num_workers=num_workers,
+              pool=pool)
+  cache.commit(codes_path, inputs, params, [(tmp_path, codes_path)])
+
 
+@contextlib.contextmanager
+def _removed_on_error(paths):
+  """Deletes the (partially written) files in paths if the body raises."""
+  try:
+    yield
+  except BaseException:
+    for path in paths:
+      if os.path.exists(path):
+        os.remove(path)
+    raise
 
 
-def prepare_custom_data(working_directory, train_enc, train_dec, test_enc, test_dec, enc_vocabulary_size, dec_vocabulary_size, tokenizer=None):
+def _cached_vocabulary(cache, vocabulary_path, data_path, max_vocabulary_size,
+                       tokenizer, num_workers=1, pool=None, max_memory_mb=0):
+  """create_vocabulary, skipped if the manifest says it is up to date.
 
+  A stale vocabulary is handed to create_vocabulary as the previous one, so
+  its saved counts are reused when data_path was only appended to.
+  """
+  # max_memory_mb is not a build parameter: it does not change the result.
+  params = {"artifact": "vocabulary",
+            "max_vocabulary_size": max_vocabulary_size,
+            "tokenizer": _tokenizer_name(tokenizer), "normalize_digits": True}
+  inputs = cache.fingerprints([data_path])
+  # The vocabulary goes last, after the counts it was selected from.
+  suffixes = [COUNTS_SUFFIX, COUNTS_SUFFIX + ".json", ""]
+  if cache.is_fresh(vocabulary_path, inputs, params,
+                    [vocabulary_path + suffix for suffix in suffixes]):
+    print("Vocabulary %s is up to date" % vocabulary_path)
+    return
+  tmp_path = cache.temp_path(vocabulary_path)
+  previous = vocabulary_path if os.path.exists(vocabulary_path) else None
+  with _removed_on_error([tmp_path + suffix for suffix in suffixes]):
+    create_vocabulary(tmp_path, data_path, max_vocabulary_size, tokenizer,
+                      num_workers=num_workers, pool=pool,
+                      max_memory_mb=max_memory_mb, previous_vocabulary=previous)
+  cache.commit(vocabulary_path, inputs, params,
+               [(tmp_path + suffix, vocabulary_path + suffix)
+                for suffix in suffixes])
+
+
+def _cached_token_ids(cache, data_path, target_path, vocabulary_path,
+                      tokenizer, corpus_format, num_workers=1, pool=None,
+                      compression=None):
+  """data_to_token_ids, skipped if the manifest says it is up to date."""
+  params = {"artifact": "token_ids", "corpus_format": corpus_format,
+            "tokenizer": _tokenizer_name(tokenizer), "normalize_digits": True,
+            "compression": compression}
+  inputs = cache.fingerprints([data_path, vocabulary_path])
+  # The binary header goes last: it marks the corpus as complete.
+  suffixes = [".tokens", ".offsets", ".json"] if corpus_format == "binary" else [""]
+  if cache.is_fresh(target_path, inputs, params,
+                    [target_path + suffix for suffix in suffixes]):
+    print("Token-ids %s are up to date" % target_path)
+    return
+  tmp_path = cache.temp_path(target_path)
+  with _removed_on_error([tmp_path + suffix for suffix in suffixes]):
+    data_to_token_ids(data_path, tmp_path, vocabulary_path, tokenizer,
+                      corpus_format=corpus_format, num_workers=num_workers,
+                      pool=pool, compression=compression)
+  cache.commit(target_path, inputs, params,
+               [(tmp_path + suffix, target_path + suffix)
+                for suffix in suffixes])
+
+
+def _prepare_side_parallel(cache, pool, num_workers, vocab_path,
+                           vocabulary_size, train_path, conversions, tokenizer,
+                           corpus_format, max_memory_mb=0, compression=None):
+  """Builds one vocabulary, then converts its files concurrently on pool."""
+  _cached_vocabulary(cache, vocab_path, train_path, vocabulary_size, tokenizer,
+                     num_workers, pool, max_memory_mb)
+  _run_in_threads([
+      functools.partial(_cached_token_ids, cache, data_path, ids_path,
+                        vocab_path, tokenizer, corpus_format, num_workers, pool,
+                        compression)
+      for data_path, ids_path in conversions])
+
+
+def prepare_custom_data(working_directory, train_enc, train_dec, test_enc, test_dec, enc_vocabulary_size, dec_vocabulary_size, tokenizer=None, num_workers=1, corpus_format="text", bpe_merges=0, count_memory_mb=0, ids_compression=None):
+    """Create vocabularies and token-ids, rebuilding only stale artifacts.
+
+    Which artifacts are up to date is decided by the content-fingerprinted
+    manifest of artifact_cache, held under an exclusive lock on
+    working_directory for the duration of the preparation.
+
+    With bpe_merges > 0, BPE merges are first learned from train_enc and
+    train_dec (see bpe_codes_path) and the BPE subword units replace words
+    everywhere; tokenizer is ignored then.
+
+    count_memory_mb bounds the memory of the vocabulary token counts (see
+    create_vocabulary); with two sides built concurrently each gets half.
+
+    The data files may be gzip, bzip2, xz or zstd compressed; they are
+    decompressed while being read. The token-ids are written in
+    working_directory, named after the data files; text token-ids are
+    compressed with ids_compression if it is set.
+
+    Raises:
+      ValueError: if two different data files have the same name.
+    """
     # Create vocabularies of the appropriate sizes.
     enc_vocab_path = os.path.join(working_directory, "vocab%d_enc.txt" % enc_vocabulary_size)
     dec_vocab_path = os.path.join(working_directory, "vocab%d_dec.txt" % dec_vocabulary_size)
-    create_vocabulary(enc_vocab_path, train_enc, enc_vocabulary_size, tokenizer)
-    create_vocabulary(dec_vocab_path, train_dec, dec_vocabulary_size, tokenizer)
-
-    # Create token ids for the training data.
-    enc_train_ids_path = train_enc + (".ids%d" % enc_vocabulary_size)
-    dec_train_ids_path = train_dec + (".ids%d" % dec_vocabulary_size)
-    data_to_token_ids(train_enc, enc_train_ids_path, enc_vocab_path, tokenizer)
-    data_to_token_ids(train_dec, dec_train_ids_path, dec_vocab_path, tokenizer)
-
-    # Create token ids for the development data.
-    enc_dev_ids_path = test_enc + (".ids%d" % enc_vocabulary_size)
-    dec_dev_ids_path = test_dec + (".ids%d" % dec_vocabulary_size)
-    data_to_token_ids(test_enc, enc_dev_ids_path, enc_vocab_path, tokenizer)
-    data_to_token_ids(test_dec, dec_dev_ids_path, dec_vocab_path, tokenizer)
+
+    enc_train_ids_path = _ids_path(working_directory, train_enc, enc_vocabulary_size, corpus_format, ids_compression)
+    dec_train_ids_path = _ids_path(working_directory, train_dec, dec_vocabulary_size, corpus_format, ids_compression)
+    enc_dev_ids_path = _ids_path(working_directory, test_enc, enc_vocabulary_size, corpus_format, ids_compression)
+    dec_dev_ids_path = _ids_path(working_directory, test_dec, dec_vocabulary_size, corpus_format, ids_compression)
+    sources = {}
+    for data_path, ids_path in [(train_enc, enc_train_ids_path), (train_dec, dec_train_ids_path),
+                                (test_enc, enc_dev_ids_path), (test_dec, dec_dev_ids_path)]:
+      if sources.setdefault(ids_path, os.path.abspath(data_path)) != os.path.abspath(data_path):
+        raise ValueError("%s and %s would both be converted to %s; rename one of them."
+                         % (sources[ids_path], data_path, ids_path))
+
+    num_workers = _resolve_num_workers(num_workers)
+    with artifact_cache.ArtifactCache(working_directory) as cache:
+      if bpe_merges > 0:
+        codes_path = bpe_codes_path(working_directory, bpe_merges)
+        _cached_bpe(cache, codes_path, [train_enc, train_dec], bpe_merges,
+                    num_workers)
+        tokenizer = load_bpe_tokenizer(codes_path)
+      if num_workers > 1:
+        # The encoder and decoder sides are independent: each builds its
+        # vocabulary and then converts its train and dev files concurrently,
+        # all of them sharing one pool of tokenizer processes.
+        # The sides share the count memory; a positive budget stays positive
+        # (0 would mean no limit).
+        side_memory_mb = (max(count_memory_mb // 2, 1) if count_memory_mb > 0
+                          else 0)
+        with _worker_pool(num_workers) as pool:
+          _run_in_threads([
+              functools.partial(
+                  _prepare_side_parallel, cache, pool, num_workers,
+                  enc_vocab_path, enc_vocabulary_size, train_enc,
+                  [(train_enc, enc_train_ids_path), (test_enc, enc_dev_ids_path)],
+                  tokenizer, corpus_format, side_memory_mb, ids_compression),
+              functools.partial(
+                  _prepare_side_parallel, cache, pool, num_workers,
+                  dec_vocab_path, dec_vocabulary_size, train_dec,
+                  [(train_dec, dec_train_ids_path), (test_dec, dec_dev_ids_path)],
+                  tokenizer, corpus_format, side_memory_mb, ids_compression)])
+      else:
+        _cached_vocabulary(cache, enc_vocab_path, train_enc, enc_vocabulary_size, tokenizer, max_memory_mb=count_memory_mb)
+        _cached_vocabulary(cache, dec_vocab_path, train_dec, dec_vocabulary_size, tokenizer, max_memory_mb=count_memory_mb)
+
+        # Create token ids for the training data.
+        _cached_token_ids(cache, train_enc, enc_train_ids_path, enc_vocab_path, tokenizer, corpus_format, compression=ids_compression)
+        _cached_token_ids(cache, train_dec, dec_train_ids_path, dec_vocab_path, tokenizer, corpus_format, compression=ids_compression)
+
+        # Create token ids for the development data.
+        _cached_token_ids(cache, test_enc, enc_dev_ids_path, enc_vocab_path, tokenizer, corpus_format, compression=ids_compression)
+        _cached_token_ids(cache, test_dec, dec_dev_ids_path, dec_vocab_path, tokenizer, corpus_format, compression=ids_compression)
 
     return (enc_train_ids_path, dec_train_ids_path, enc_dev_ids_path, dec_dev_ids_path, enc_vocab_path, dec_vocab_path)
@@ -0,0 +1,182 @@
+"""Tests for data_utils."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import data_utils
+import token_counts
+
+
+class DataToTokenIdsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def testParallelLinesEndAtNewlineOnly(self):
+    # "\r" and "\x0c" are not line breaks: every worker count must give one
+    # line of token-ids per "\n"-terminated input line.
+    data_path = os.path.join(self.scratch, "data.txt")
+    lines = [b"plain line %d" % i for i in range(200)]
+    lines[3] = b"carriage\rreturn"
+    lines[150] = b"form\x0cfeed\x0band\x1cmore"
+    with open(data_path, "wb") as f:
+      f.write(b"\n".join(lines) + b"\n")
+    vocab_path = os.path.join(self.scratch, "vocab.txt")
+    data_utils.create_vocabulary(vocab_path, data_path, 100)
+
+    outputs = []
+    for num_workers in (1, 2, 4):
+      ids_path = os.path.join(self.scratch, "data.ids%d" % num_workers)
+      data_utils.data_to_token_ids(data_path, ids_path, vocab_path,
+                                   num_workers=num_workers)
+      with open(ids_path, "rb") as f:
+        outputs.append(f.read())
+    self.assertEqual(len(lines), outputs[0].count(b"\n"))
+    self.assertEqual(outputs[0], outputs[1])
+    self.assertEqual(outputs[0], outputs[2])
+
+
+class StartSymbolsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def testDistilledUnkMapsToUnkId(self):
+    # Headlines decoded by a teacher spell its unknown words "_UNK", often
+    # enough to rank among the most frequent tokens.
+    data_path = os.path.join(self.scratch, "distilled_dec.txt")
+    with open(data_path, "wb") as f:
+      f.write(b"the _UNK fox _UNK\n_UNK jumps over the _UNK\n")
+    for max_memory_mb in (0, 1):
+      vocab_path = os.path.join(self.scratch, "vocab%d.txt" % max_memory_mb)
+      data_utils.create_vocabulary(vocab_path, data_path, 100,
+                                   max_memory_mb=max_memory_mb)
+      vocab, rev_vocab = data_utils.initialize_vocabulary(vocab_path)
+      self.assertEqual(1, rev_vocab.count(data_utils._UNK))
+      self.assertEqual(len(data_utils._START_VOCAB) + 4, len(rev_vocab))
+
+      ids_path = os.path.join(self.scratch, "ids%d.txt" % max_memory_mb)
+      data_utils.data_to_token_ids(data_path, ids_path, vocab_path)
+      with open(ids_path) as f:
+        ids = [[int(i) for i in line.split()] for line in f]
+      unk = data_utils.UNK_ID
+      self.assertEqual([vocab["the"], unk, vocab["fox"], unk], ids[0])
+      self.assertEqual([unk, vocab["jumps"], vocab["over"], vocab["the"],
+                        unk], ids[1])
+
+
+class PrepareCustomDataTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def _prepare(self, working_directory, train_dec):
+    os.mkdir(working_directory)
+    data_dir = os.path.join(self.scratch, "dataset")
+    return data_utils.prepare_custom_data(
+        working_directory, os.path.join(data_dir, "train_enc.txt"), train_dec,
+        os.path.join(data_dir, "eval_enc.txt"),
+        os.path.join(data_dir, "eval_dec.txt"), 100, 100)
+
+  def testWorkingDirectoriesKeepTheirOwnIds(self):
+    # A distillation student shares the teacher's data files but for its
+    # headlines, and builds vocabularies of the same sizes from other text.
+    data_dir = os.path.join(self.scratch, "dataset")
+    os.mkdir(data_dir)
+    for name, text in (("train_enc", b"a b c\n"), ("train_dec", b"x y\n"),
+                       ("eval_enc", b"c b a\n"), ("eval_dec", b"y x\n")):
+      with open(os.path.join(data_dir, name + ".txt"), "wb") as f:
+        f.write(text)
+    teacher = self._prepare(os.path.join(self.scratch, "teacher"),
+                            os.path.join(data_dir, "train_dec.txt"))
+    with open(teacher[3], "rb") as f:
+      teacher_dev_ids = f.read()
+    distilled_path = os.path.join(self.scratch, "distilled_dec.txt")
+    with open(distilled_path, "wb") as f:
+      f.write(b"y y z x\n")
+    student = self._prepare(os.path.join(self.scratch, "student"),
+                            distilled_path)
+
+    for teacher_ids_path, student_ids_path in zip(teacher[:4], student[:4]):
+      self.assertEqual(os.path.join(self.scratch, "teacher"),
+                       os.path.dirname(teacher_ids_path))
+      self.assertEqual(os.path.join(self.scratch, "student"),
+                       os.path.dirname(student_ids_path))
+    with open(teacher[3], "rb") as f:
+      self.assertEqual(teacher_dev_ids, f.read())
+    with open(student[3], "rb") as f:
+      self.assertNotEqual(teacher_dev_ids, f.read())
+    self.assertEqual([], [name for name in os.listdir(data_dir)
+                          if not name.endswith(".txt")])
+
+
+class ReusableCountsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def testEditBeforeTheEndIsDetected(self):
+    # 2 MB of data: an edit at the start of the counted bytes, keeping their
+    # size, then appended data.
+    data_path = os.path.join(self.scratch, "data.txt")
+    with open(data_path, "wb") as f:
+      f.write(b"the quick brown fox\n" * 100000)
+    vocab_path = os.path.join(self.scratch, "vocab.txt")
+    data_utils.create_vocabulary(vocab_path, data_path, 100)
+    data_bytes = os.path.getsize(data_path)
+    self.assertEqual(data_bytes, data_utils._reusable_counts(
+        vocab_path, data_path, None, True))
+
+    with open(data_path, "r+b") as f:
+      f.write(b"the quick brown cat\n")
+    with open(data_path, "ab") as f:
+      f.write(b"jumps over\n")
+    self.assertIsNone(data_utils._reusable_counts(vocab_path, data_path,
+                                                  None, True))
+
+
+  def testReusedInMemoryCountsMatchARecount(self):
+    # The in-memory path saves its counts unsorted; reusing them sorts them
+    # in chunks (several here) before the merge with the appended data.
+    data_path = os.path.join(self.scratch, "data.txt")
+    with open(data_path, "wb") as f:
+      f.write(b"b a c d\ne f a g\nh b i\n")
+    vocab_path = os.path.join(self.scratch, "vocab.txt")
+    data_utils.create_vocabulary(vocab_path, data_path, 100)
+    with open(data_path, "ab") as f:
+      f.write(b"i i j a\nk c c\n")
+
+    sort_chunk_entries = token_counts._SORT_CHUNK_ENTRIES
+    token_counts._SORT_CHUNK_ENTRIES = 3
+    try:
+      reused_path = os.path.join(self.scratch, "reused.txt")
+      data_utils.create_vocabulary(reused_path, data_path, 100,
+                                   previous_vocabulary=vocab_path)
+    finally:
+      token_counts._SORT_CHUNK_ENTRIES = sort_chunk_entries
+    recounted_path = os.path.join(self.scratch, "recounted.txt")
+    data_utils.create_vocabulary(recounted_path, data_path, 100)
+    with open(reused_path, "rb") as reused, \
+        open(recounted_path, "rb") as recounted:
+      self.assertEqual(recounted.read(), reused.read())
+
+
+if __name__ == "__main__":
+  unittest.main()
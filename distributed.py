@@ -0,0 +1,256 @@
+"""Synchronous data-parallel training on a TensorFlow cluster.
+
+Every worker process builds the same graph (between-graph replication):
+the variables live on the parameter servers (tf.train.replica_device_setter)
+and every worker computes the gradients of its own batch. SyncReplicas
+averages them before a single update per global step, so N workers train
+like one process with N times the batch.
+
+tf.train.SyncReplicasOptimizer does the same for a single update op; a
+bucketed model has one per bucket, so SyncReplicas shares the gradient
+accumulators, the local step and the chief's update between all the update
+ops it returns.
+
+The cluster is a tf.train.ClusterSpec with "ps" and "worker" jobs; the
+servers talk over TCP (gRPC), whether on one host (local_cluster) or on
+several.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import multiprocessing
+import queue
+import socket
+
+import tensorflow as tf
+
+# Times start_local starts a cluster on new ports when a server cannot bind
+# its port, and how long it waits for every server to be up.
+_START_ATTEMPTS = 3
+_START_TIMEOUT_SECS = 60
+
+
+def cluster_spec(ps_hosts, worker_hosts):
+  """ClusterSpec of comma-separated host:port lists."""
+  return tf.train.ClusterSpec({"ps": ps_hosts.split(","),
+                               "worker": worker_hosts.split(",")})
+
+
+def local_cluster(num_workers, num_ps=1):
+  """ClusterSpec of processes on this host, on free local ports.
+
+  The ports are released before the servers bind them, so another process
+  can take one in between; start_local then retries on other ports.
+  """
+  ports = []
+  for _ in range(num_ps + num_workers):
+    with contextlib.closing(socket.socket()) as s:
+      s.bind(("localhost", 0))
+      ports.append(s.getsockname()[1])
+  hosts = ["localhost:%d" % port for port in ports]
+  return tf.train.ClusterSpec({"ps": hosts[:num_ps],
+                               "worker": hosts[num_ps:]})
+
+
+def num_workers(cluster):
+  return len(cluster.as_dict()["worker"])
+
+
+def worker_device(task_index):
+  return "/job:worker/task:%d" % task_index
+
+
+def run_ps(cluster, task_index, config=None):
+  """Serves the variables of parameter server task_index; never returns."""
+  server = tf.train.Server(cluster, job_name="ps", task_index=task_index,
+                           config=config)
+  server.join()
+
+
+def _run_task(cluster, job_name, task_index, config, ready, go, worker_fn):
+  """Process of a task of start_local: starts its server, then serves."""
+  try:
+    server = tf.train.Server(cluster, job_name=job_name,
+                             task_index=task_index, config=config)
+  except tf.errors.OpError as e:  # E.g. its port was taken.
+    ready.put((job_name, task_index, str(e)))
+    return
+  ready.put((job_name, task_index, None))
+  go.wait()
+  if job_name == "ps":
+    server.join()
+  else:
+    worker_fn(cluster, task_index, server)
+
+
+def start_local(num_workers, worker_fn, num_ps=1, config=None,
+                worker_config=None):
+  """Starts a cluster of tasks on this host, each in a forked process.
+
+  Every task first starts its server. If one fails, e.g. because another
+  process took the port local_cluster found free, all the tasks are stopped
+  and the cluster is started again on new ports, up to _START_ATTEMPTS
+  times. The workers only run worker_fn once every server is up.
+
+  Args:
+    num_workers: number of worker tasks.
+    worker_fn: function run by the process of every worker, with the
+      cluster, its task index and its tf.train.Server.
+    num_ps: number of parameter server tasks.
+    config: tf.ConfigProto of the parameter servers.
+    worker_config: tf.ConfigProto of the workers' servers.
+
+  Returns:
+    the ClusterSpec, the parameter server processes and the worker
+    processes. The parameter servers never exit; terminate them once the
+    workers are done.
+
+  Raises:
+    RuntimeError: if no attempt started every server.
+  """
+  # The children must not inherit a TF runtime: fork before any session.
+  context = multiprocessing.get_context("fork")
+  tasks = ([("ps", i, config) for i in range(num_ps)] +
+           [("worker", i, worker_config) for i in range(num_workers)])
+  for _ in range(_START_ATTEMPTS):
+    cluster = local_cluster(num_workers, num_ps)
+    ready, go = context.Queue(), context.Event()
+    processes = [context.Process(target=_run_task,
+                                 args=(cluster, job_name, task_index,
+                                       task_config, ready, go, worker_fn))
+                 for job_name, task_index, task_config in tasks]
+    for process in processes[:num_ps]:
+      process.daemon = True
+    for process in processes:
+      process.start()
+    errors = []
+    try:
+      for _ in tasks:
+        job_name, task_index, error = ready.get(timeout=_START_TIMEOUT_SECS)
+        if error is not None:
+          errors.append("/job:%s/task:%d: %s" % (job_name, task_index, error))
+    except queue.Empty:
+      errors.append("a server did not start within %ds" % _START_TIMEOUT_SECS)
+    if not errors:
+      go.set()
+      return cluster, processes[:num_ps], processes[num_ps:]
+    for process in processes:
+      process.terminate()
+    print("Could not start the local cluster %s: %s"
+          % (cluster.as_dict(), "; ".join(errors)))
+  raise RuntimeError("Could not start a local cluster in %d attempts."
+                     % _START_ATTEMPTS)
+
+
+class SyncReplicas(object):
+  """Optimizer wrapper averaging the gradients of num_replicas workers.
+
+  Every update op returned by apply_gradients puts the worker's gradients
+  into accumulators (one per variable, on its parameter server) and waits
+  for a token of the chief; the chief_queue_runner, run by the chief only,
+  takes the average of num_replicas gradients from the accumulators,
+  applies it, increments the global step and hands out the tokens of the
+  next step. Gradients computed for an older global step are dropped.
+  """
+
+  def __init__(self, optimizer, num_replicas, global_step):
+    self.optimizer = optimizer
+    self.num_replicas = num_replicas
+    self.global_step = global_step
+    # The local step must stay on the worker, where the no_op is placed.
+    with tf.colocate_with(tf.no_op()):
+      self.local_step = tf.Variable(
+          0, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES],
+          name="sync_local_step")
+    self.local_step_init_op = self.local_step.assign(global_step)
+    self._accumulators = None
+
+  def _build_sync(self, grads_and_vars):
+    """Creates the accumulators and the chief's update."""
+    self._accumulators, averages = [], []
+    for grad, var in grads_and_vars:
+      with tf.device(var.device):
+        if isinstance(grad, tf.IndexedSlices):  # Embeddings.
+          accumulator = tf.SparseConditionalAccumulator(
+              grad.dtype, shape=(), shared_name=var.name + "/grad_accum")
+          averages.append(accumulator.take_indexed_slices_grad(
+              self.num_replicas))
+        else:
+          accumulator = tf.ConditionalAccumulator(
+              grad.dtype, shape=var.get_shape(),
+              shared_name=var.name + "/grad_accum")
+          averages.append(accumulator.take_grad(self.num_replicas))
+      self._accumulators.append(accumulator)
+
+    with tf.device(self.global_step.device):
+      update = self.optimizer.apply_gradients(
+          zip(averages, [var for _, var in grads_and_vars]),
+          global_step=self.global_step)
+      self._tokens = tf.FIFOQueue(-1, self.global_step.dtype.base_dtype,
+                                  shapes=(), shared_name="sync_tokens")
+      with tf.control_dependencies([update]):
+        sync = self._tokens.enqueue_many(
+            [tf.fill([self.num_replicas], self.global_step.ref())])
+      # A QueueRunner repeats its op until the session stops.
+      self.chief_queue_runner = tf.train.QueueRunner(
+          tf.FIFOQueue(1, tf.int32, shapes=(), shared_name="sync_dummy"),
+          [sync])
+      self.init_tokens_op = self._tokens.enqueue_many(
+          [tf.fill([self.num_replicas], self.global_step.ref())])
+    self.chief_init_op = tf.group(*[
+        accumulator.set_global_step(self.global_step)
+        for accumulator in self._accumulators])
+
+  def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+    """Returns the update op of one set of gradients (e.g. of a bucket).
+
+    All calls must pass the same variables in the same order; the global
+    step is the one given to the constructor.
+    """
+    grads_and_vars = list(grads_and_vars)
+    if self._accumulators is None:
+      self._build_sync(grads_and_vars)
+    apply_ops = []
+    for (grad, var), accumulator in zip(grads_and_vars, self._accumulators):
+      with tf.device(var.device):
+        if isinstance(grad, tf.IndexedSlices):
+          apply_ops.append(accumulator.apply_indexed_slices_grad(
+              grad, local_step=self.local_step))
+        else:
+          apply_ops.append(accumulator.apply_grad(
+              grad, local_step=self.local_step))
+    with tf.device(self.global_step.device):
+      with tf.control_dependencies(apply_ops):
+        token = self._tokens.dequeue()
+    return self.local_step.assign(token, name=name)
+
+
+def replica_session(server, model, is_chief, init_fn=None, config=None):
+  """Returns a session of a worker, once the model is ready to train.
+
+  The chief initializes the variables (then calls init_fn(session), e.g. to
+  restore a checkpoint) and runs the synchronization; the other workers
+  wait for it.
+
+  Args:
+    server: the worker's tf.train.Server.
+    model: the model, built with sync_replicas under the worker's
+      tf.train.replica_device_setter.
+    is_chief: whether the worker is the chief (task 0).
+    init_fn: optional function completing the chief's initialization.
+    config: tf.ConfigProto of the session.
+  """
+  supervisor = tf.train.Supervisor(
+      is_chief=is_chief, init_op=tf.initialize_all_variables(),
+      local_init_op=model.sync.local_step_init_op, init_fn=init_fn,
+      summary_op=None, saver=model.saver, global_step=model.global_step,
+      recovery_wait_secs=1)
+  session = supervisor.prepare_or_wait_for_session(server.target,
+                                                   config=config)
+  if is_chief:
+    session.run(model.sync.chief_init_op)
+    session.run(model.sync.init_tokens_op)
+    supervisor.start_queue_runners(session, [model.sync.chief_queue_runner])
+  return session
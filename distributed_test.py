@@ -0,0 +1,121 @@
+"""Smoke tests of distributed: one parameter server and two workers."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import functools
+import multiprocessing
+import socket
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import distributed
+import seq2seq_model
+
+_TIMEOUT_SECS = 120
+
+
+class _ToyModel(object):
+  """The attributes of a model replica_session uses."""
+
+  def __init__(self, task_index):
+    self.global_step = tf.Variable(0, trainable=False, name="global_step")
+    self.w = tf.Variable([1.0, 2.0], name="w")
+    self.embedding = tf.Variable(tf.zeros([3, 2]), name="embedding")
+    # Worker i has gradient i + 1 for w and a row of ones for row i of the
+    # embedding.
+    loss = (float(task_index + 1) * tf.reduce_sum(self.w) +
+            tf.reduce_sum(tf.gather(self.embedding, [task_index])))
+    self.sync = distributed.SyncReplicas(
+        tf.train.GradientDescentOptimizer(1.0), 2, self.global_step)
+    self.update = self.sync.apply_gradients(
+        self.sync.optimizer.compute_gradients(loss))
+    self.saver = tf.train.Saver()
+
+
+def _toy_worker(results, cluster, task_index, server):
+  with tf.device(tf.train.replica_device_setter(
+      worker_device=distributed.worker_device(task_index), cluster=cluster)):
+    model = _ToyModel(task_index)
+  sess = distributed.replica_session(server, model, task_index == 0)
+  sess.run(model.update)
+  results.put((task_index,) + tuple(
+      sess.run([model.global_step, model.w, model.embedding])))
+
+
+def _seq2seq_worker(results, cluster, task_index, server):
+  buckets = [(5, 5)]
+  with tf.device(tf.train.replica_device_setter(
+      worker_device=distributed.worker_device(task_index), cluster=cluster)):
+    model = seq2seq_model.Seq2SeqModel(
+        20, 20, buckets, 8, 1, 5.0, 4, 0.5, 0.99, sync_replicas=2)
+  sess = distributed.replica_session(server, model, task_index == 0)
+  rng = np.random.RandomState(task_index)
+  pairs = [[(list(rng.randint(4, 20, 4)), list(rng.randint(4, 20, 3)))
+            for _ in range(8)]]
+  losses = []
+  for _ in range(3):
+    batch = model.get_batch(pairs, 0)
+    _, loss, _ = model.step(sess, batch[0], batch[1], batch[2], 0, False)
+    losses.append(loss)
+  results.put((task_index, sess.run(model.global_step), losses))
+
+
+class LocalClusterTest(unittest.TestCase):
+
+  def _run(self, worker_fn):
+    results = multiprocessing.get_context("fork").Queue()
+    _, ps_processes, worker_processes = distributed.start_local(
+        2, functools.partial(worker_fn, results))
+    try:
+      return sorted(results.get(timeout=_TIMEOUT_SECS) for _ in range(2))
+    finally:
+      for process in ps_processes + worker_processes:
+        process.terminate()
+
+  def testSyncReplicasAveragesTheGradients(self):
+    reports = self._run(_toy_worker)
+    for task_index, (report_index, global_step, w, embedding) in enumerate(
+        reports):
+      self.assertEqual(task_index, report_index)
+      self.assertEqual(1, global_step)
+      # The mean gradient of w is 1.5.
+      np.testing.assert_allclose([-0.5, 0.5], w)
+      self.assertTrue(np.all(embedding[:2] < 0))
+      np.testing.assert_array_equal([0.0, 0.0], embedding[2])
+
+  def testSeq2SeqModelTrainsInSync(self):
+    for task_index, global_step, losses in self._run(_seq2seq_worker):
+      self.assertEqual(3, global_step)
+      self.assertTrue(np.all(np.isfinite(losses)), (task_index, losses))
+
+  def testTakenPortIsRetried(self):
+    local_cluster = distributed.local_cluster
+    with contextlib.closing(socket.socket()) as taken:
+      taken.bind(("localhost", 0))
+      taken.listen(1)
+      clusters = []
+
+      def first_cluster_taken(num_workers, num_ps=1):
+        cluster = local_cluster(num_workers, num_ps)
+        if not clusters:
+          spec = cluster.as_dict()
+          spec["ps"] = ["localhost:%d" % taken.getsockname()[1]]
+          cluster = tf.train.ClusterSpec(spec)
+        clusters.append(cluster)
+        return cluster
+
+      distributed.local_cluster = first_cluster_taken
+      try:
+        reports = self._run(_toy_worker)
+      finally:
+        distributed.local_cluster = local_cluster
+    self.assertEqual(2, len(clusters))
+    self.assertEqual([1, 1], [report[1] for report in reports])
+
+
+if __name__ == "__main__":
+  unittest.main()
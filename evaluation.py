@@ -1,26 +1,20 @@
 import nltk
-import re
 import pandas as pd
 
-_WORD_SPLIT = re.compile("([.,!?\"':;)(])")
+import data_utils
+
+# Headlines are scored on their raw tokens, digits are left untouched.
+_tokenizer = data_utils.BatchTokenizer(normalize_digits=False)
 
 
 def tokenizer(sentence):
     """Very basic tokenizer: split the sentence into a list of tokens."""
-    words = []
-    for space_separated_fragment in sentence.strip().split():
-      words.extend(re.split(_WORD_SPLIT, space_separated_fragment))
-    return [w for w in words if w]
+    return _tokenizer.tokenize(sentence)
 
 def getBLEUscore(true_headline, predicted_headline):
 
-    token_true_headline = []
-    for sentence in true_headline:
-        token_true_headline.append(tokenizer(sentence))
-
-    token_predicted_headline = []
-    for sentence in predicted_headline:
-        token_predicted_headline.append(tokenizer(sentence))
+    token_true_headline = _tokenizer.tokenize_batch(true_headline)
+    token_predicted_headline = _tokenizer.tokenize_batch(predicted_headline)
 
     BLEUscore = []
     weights = [1, 0, 0, 0]  # param weights: weights for unigrams, bigrams, trigrams and so on
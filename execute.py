@@ -17,6 +17,10 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import functools
+import io
+import itertools
+import json
 import math
 import os
 import random
@@ -27,8 +31,20 @@ import numpy as np
 # from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
+import batch_prefetcher
+import bpe
+import bucket_planner
+import bucket_sampler
+import checkpoints
+import corpus_io
 import data_utils
+import distributed
+import frozen_model
 import seq2seq_model
+import session_tuning
+import shortlist
+import token_corpus
+import vocabulary
 
 from configparser import ConfigParser # In Python 3, ConfigParser has been renamed to configparser for PEP 8 compliance.
 
@@ -59,221 +75,676 @@ def read_data(source_path, target_path, max_size=None):
       if 0 or None, data files will be read completely (no limit).
 
   Returns:
-    data_set: a list of length len(_buckets); data_set[n] contains a list of
+    data_set: a list of length len(_buckets); data_set[n] contains the
       (source, target) pairs read from the provided data files that fit
       into the n-th bucket, i.e., such that len(source) < _buckets[n][0] and
       len(target) < _buckets[n][1]; source and target are lists of token-ids.
+      data_set[n] is a token_corpus.PairBucket: it behaves like a list of
+      pairs but only stores their line numbers; the token-ids are kept in
+      flat arrays (memory-mapped for binary corpora).
   """
-  data_set = [[] for _ in _buckets]
-  with tf.gfile.GFile(source_path, mode="r") as source_file:
-    with tf.gfile.GFile(target_path, mode="r") as target_file:
-      source, target = source_file.readline(), target_file.readline()
-      counter = 0
-      while source and target and (not max_size or counter < max_size):
-        counter += 1
-        if counter % 1000 == 0:
-          print("  reading data line %d" % counter)
-          sys.stdout.flush()
-        source_ids = [int(x) for x in source.split()]
-        target_ids = [int(x) for x in target.split()]
-        target_ids.append(data_utils.EOS_ID)
-        for bucket_id, (source_size, target_size) in enumerate(_buckets):
-          if len(source_ids) < source_size and len(target_ids) < target_size:
-            data_set[bucket_id].append([source_ids, target_ids])
-            break
-        source, target = source_file.readline(), target_file.readline()
-  return data_set
+  if token_corpus.exists(source_path) and token_corpus.exists(target_path):
+    return token_corpus.bucket_pairs(
+        token_corpus.TokenCorpus(source_path),
+        token_corpus.TokenCorpus(target_path), _buckets, max_size,
+        target_suffix=[data_utils.EOS_ID])
+  return token_corpus.read_text_pairs(source_path, target_path, _buckets,
+                                      max_size,
+                                      target_suffix=[data_utils.EOS_ID])
 
 
-def create_model(session, forward_only):
+def _ids_compression():
+  """Compression of the text token-ids set in seq2seq.ini, None for none."""
+  compression = gConfig.get('ids_compression', 'none')
+  return None if compression == 'none' else compression
 
-  """Create model and initialize or load parameters"""
-  model = seq2seq_model.Seq2SeqModel( gConfig['enc_vocab_size'], gConfig['dec_vocab_size'], _buckets, gConfig['hidden_units'], gConfig['num_layers'], gConfig['max_gradient_norm'], gConfig['batch_size'], gConfig['learning_rate'], gConfig['learning_rate_decay_factor'], forward_only=forward_only)
 
-  if 'pretrained_model' in gConfig:
-      model.saver.restore(session,gConfig['pretrained_model'])
-      return model
+def _bpe_merges():
+  """Number of BPE merges when tokenizer = bpe in seq2seq.ini, else 0."""
+  if gConfig.get('tokenizer', 'word') == 'bpe':
+    return gConfig['bpe_merges']
+  return 0
+
+
+def _load_tokenizer():
+  """Returns the configured tokenizer; None stands for basic_tokenizer."""
+  if _bpe_merges():
+    return data_utils.load_bpe_tokenizer(data_utils.bpe_codes_path(
+        gConfig['working_directory'], _bpe_merges()))
+  return None
+
+
+def _join_tokens(words):
+  """Turns decoded tokens into the text of a headline."""
+  if _bpe_merges():
+    return bpe.detokenize(words)
+  return " ".join(words)
+
+
+def _input_queue_capacity():
+  """Batches held by each input queue of the model, 0 to feed the inputs."""
+  if gConfig.get('input_pipeline', 'feed_dict') == 'queue':
+    if gConfig.get('model', 'bucketed') != 'bucketed':
+      raise ValueError("input_pipeline = queue needs model = bucketed.")
+    return max(gConfig.get('prefetch_queue_depth', 4), 1)
+  return 0
+
+
+def _shortlist_size():
+  """Frequent words of the decoding shortlist, 0 for the full softmax."""
+  size = gConfig.get('decode_shortlist', 0)
+  if size and gConfig.get('model', 'bucketed') != 'bucketed':
+    raise ValueError("decode_shortlist needs model = bucketed.")
+  return size
+
 
+def _setup_buckets(source_path=None, target_path=None):
+  """Sets _buckets to the ones stored with the model.
+
+  When training (the training token-ids are given) without stored buckets,
+  they are planned from the training set lengths if num_buckets > 0 in
+  seq2seq.ini, otherwise the default _buckets are kept; either way they are
+  stored in the working directory, so decoding uses the same buckets.
+  Delete buckets.json there to plan them again.
+  """
+  global _buckets
+  buckets_path = os.path.join(gConfig['working_directory'],
+                              bucket_planner.BUCKETS_NAME)
+  stored = bucket_planner.load_buckets(buckets_path)
+  if stored:
+    _buckets = stored
+  if source_path is None:
+    return
+  source_lengths = token_corpus.line_lengths(source_path)
+  target_lengths = token_corpus.line_lengths(target_path) + 1  # EOS_ID
+  num_lines = min(len(source_lengths), len(target_lengths))
+  source_lengths = source_lengths[:num_lines]
+  target_lengths = target_lengths[:num_lines]
+  if not stored and gConfig.get('num_buckets', 0) > 0:
+    default_stats, default_dropped = bucket_planner.bucket_report(
+        source_lengths, target_lengths, _buckets)
+    print("Default buckets %s:" % _buckets)
+    print(bucket_planner.format_report(default_stats, default_dropped))
+    _buckets = bucket_planner.plan_buckets(
+        source_lengths, target_lengths, gConfig['num_buckets'],
+        gConfig.get('bucket_coverage', 0.99))
+  stats, dropped = bucket_planner.bucket_report(source_lengths,
+                                                target_lengths, _buckets)
+  print("Buckets %s:" % _buckets)
+  print(bucket_planner.format_report(stats, dropped))
+  if not stored:
+    bucket_planner.save_buckets(buckets_path, _buckets, stats)
+
+
+def _session_config(purpose):
+  """tf.ConfigProto of the sessions for purpose, 'train' or 'decode'.
+
+  The threading settings of seq2seq.ini are overridden by the ones mode =
+  autotune stored for the purpose in the working directory; delete
+  session_profile.json there to use seq2seq.ini again.
+  """
+  settings = {'intra_op_threads': gConfig.get('intra_op_threads', 0),
+              'inter_op_threads': gConfig.get('inter_op_threads', 0),
+              'optimizer': gConfig.get('graph_optimizer', 'L1')}
+  profile = session_tuning.load_profile(os.path.join(
+      gConfig['working_directory'], session_tuning.PROFILE_NAME))
+  settings.update(profile.get(purpose, {}))
+  config = session_tuning.session_config(settings)
+  # use the BFC allocator
+  config.gpu_options.allocator_type = 'BFC'
+  return config
+
+
+def _adaptive_cutoffs():
+  """Cluster cutoffs of the adaptive softmax, from seq2seq.ini."""
+  cutoffs = gConfig.get('adaptive_cutoffs', '2000,10000')
+  return [int(cutoff) for cutoff in cutoffs.split(',')]
+
+
+def _new_model(forward_only, sync_replicas=0):
+  """Builds the model set in seq2seq.ini, without initializing it."""
+  if gConfig.get('model', 'bucketed') == 'dynamic':
+    return seq2seq_model.DynamicSeq2SeqModel( gConfig['enc_vocab_size'], gConfig['dec_vocab_size'], _buckets, gConfig['hidden_units'], gConfig['num_layers'], gConfig['max_gradient_norm'], gConfig['batch_size'], gConfig['learning_rate'], gConfig['learning_rate_decay_factor'], num_samples=gConfig.get('num_samples', 512), forward_only=forward_only, sync_replicas=sync_replicas, loss=gConfig.get('loss', 'sampled_softmax'))
+  return seq2seq_model.Seq2SeqModel( gConfig['enc_vocab_size'], gConfig['dec_vocab_size'], _buckets, gConfig['hidden_units'], gConfig['num_layers'], gConfig['max_gradient_norm'], gConfig['batch_size'], gConfig['learning_rate'], gConfig['learning_rate_decay_factor'], num_samples=gConfig.get('num_samples', 512), forward_only=forward_only, input_queue_capacity=0 if forward_only else _input_queue_capacity(), sync_replicas=sync_replicas, shortlist=forward_only and _shortlist_size() > 0, loss=gConfig.get('loss', 'sampled_softmax'), adaptive_cutoffs=_adaptive_cutoffs())
+
+
+def _checkpoint_path():
+  """Parameters to load: the pretrained model, else the latest checkpoint."""
+  if 'pretrained_model' in gConfig:
+      return gConfig['pretrained_model']
   ckpt = tf.train.get_checkpoint_state(gConfig['working_directory'])
   if ckpt and tf.gfile.Exists(ckpt.model_checkpoint_path):
-    print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-    model.saver.restore(session, ckpt.model_checkpoint_path)
+    return ckpt.model_checkpoint_path
+  return None
+
+
+def create_model(session, forward_only):
+
+  """Create model and initialize or load parameters"""
+  model = _new_model(forward_only)
+  checkpoint_path = _checkpoint_path()
+  if checkpoint_path:
+    print("Reading model parameters from %s" % checkpoint_path)
+    model.saver.restore(session, checkpoint_path)
   else:
     print("Created model with fresh parameters.")
     session.run(tf.initialize_all_variables())
   return model
 
 
-def train():
-  # prepare dataset
+def _create_replica(cluster, task_index, server=None):
+  """Starts worker task_index of the cluster and builds its model.
+
+  server is the worker's tf.train.Server if it is already started.
+
+  Returns:
+    the worker's session, once the model is initialized or restored by the
+    chief (task 0), and the model.
+  """
+  config = _session_config('train')
+  if server is None:
+    server = tf.train.Server(cluster, job_name='worker',
+                             task_index=task_index, config=config)
+  with tf.device(tf.train.replica_device_setter(
+      worker_device=distributed.worker_device(task_index), cluster=cluster)):
+    model = _new_model(False, sync_replicas=distributed.num_workers(cluster))
+  checkpoint_path = _checkpoint_path()
+  init_fn = None
+  if checkpoint_path:
+    print("Reading model parameters from %s" % checkpoint_path)
+    init_fn = lambda sess: model.saver.restore(sess, checkpoint_path)
+  sess = distributed.replica_session(server, model, task_index == 0,
+                                     init_fn=init_fn, config=config)
+  return sess, model
+
+
+def _prepare_data():
   print("Preparing data in %s" % gConfig['working_directory'])
-  enc_train, dec_train, enc_dev, dec_dev, _, _ = data_utils.prepare_custom_data(gConfig['working_directory'], gConfig['train_enc'],gConfig['train_dec'],gConfig['eval_enc'],gConfig['eval_dec'],gConfig['enc_vocab_size'],gConfig['dec_vocab_size'])
+  return data_utils.prepare_custom_data(gConfig['working_directory'], gConfig['train_enc'],gConfig['train_dec'],gConfig['eval_enc'],gConfig['eval_dec'],gConfig['enc_vocab_size'],gConfig['dec_vocab_size'], num_workers=gConfig.get('prepare_workers', 1), corpus_format=gConfig.get('corpus_format', 'text'), bpe_merges=_bpe_merges(), count_memory_mb=gConfig.get('vocab_memory_mb', 0), ids_compression=_ids_compression())
 
-  # setup config to use BFC allocator
-  config = tf.ConfigProto()  
-  config.gpu_options.allocator_type = 'BFC'
 
-  with tf.Session(config=config) as sess:
+def train(cluster=None, task_index=0, server=None):
+  """Trains the model, alone or as worker task_index of a cluster.
+
+  In a cluster (a tf.train.ClusterSpec) every worker trains on its own
+  share of the batches of a common bucket schedule and the workers average
+  their gradients at every step (distributed.SyncReplicas); only the chief
+  (task 0) decays the learning rate, saves checkpoints and runs the evals.
+  server is the worker's tf.train.Server if it is already started.
+  """
+  # prepare dataset
+  enc_train, dec_train, enc_dev, dec_dev, _, _ = _prepare_data()
+  _setup_buckets(enc_train, dec_train)
+  num_workers = distributed.num_workers(cluster) if cluster else 1
+  is_chief = task_index == 0
+
+  print("Creating %d layers of %d units." % (gConfig['num_layers'], gConfig['hidden_units']))
+  if cluster:
+    sess, model = _create_replica(cluster, task_index, server)
+  else:
+    sess = tf.Session(config=_session_config('train'))
     # Create model.
-    print("Creating %d layers of %d units." % (gConfig['num_layers'], gConfig['hidden_units']))
     model = create_model(sess, False)
 
+  with sess:
     # Read data into buckets and compute their sizes.
     print ("Reading development and training data (limit: %d)."
            % gConfig['max_train_data_size'])
     dev_set = read_data(enc_dev, dec_dev)
     train_set = read_data(enc_train, dec_train, gConfig['max_train_data_size'])
     train_bucket_sizes = [len(train_set[b]) for b in range(len(_buckets))]
-    train_total_size = float(sum(train_bucket_sizes))
 
-    # A bucket scale is a list of increasing numbers from 0 to 1 that we'll use
-    # to select a bucket. Length of [scale[i], scale[i+1]] is proportional to
-    # the size if i-th training bucket, as used later.
-    train_buckets_scale = [sum(train_bucket_sizes[:i + 1]) / train_total_size
-                           for i in range(len(train_bucket_sizes))]
+    # Every epoch shows each training pair once: the buckets are shuffled
+    # and cut into batches, drawn in proportion to the bucket sizes. The
+    # position in the epoch is saved with the checkpoints and resumed here.
+    # In a cluster, all workers draw the same batches of num_workers *
+    # batch_size pairs and each trains on its own slice.
+    sampler_path = os.path.join(gConfig['working_directory'],
+                                bucket_sampler.STATE_NAME)
+    sampler = bucket_sampler.EpochBucketSampler(
+        train_bucket_sizes, num_workers * gConfig['batch_size'],
+        state=bucket_sampler.load_state(sampler_path,
+                                        int(model.global_step.eval())))
+    print("Epoch %d, batch %d of %d." % (sampler.epoch + 1, sampler.step,
+                                         sampler.batches_per_epoch))
+    batch_slice = slice(task_index * gConfig['batch_size'],
+                        (task_index + 1) * gConfig['batch_size'])
+
+    def get_batch(bucket_id, indices):
+      return model.get_batch(train_set, bucket_id, indices[batch_slice])
+
+    # Batches are prepared by background threads while the steps run.
+    batches = batch_prefetcher.BatchPrefetcher(
+        get_batch, sampler,
+        queue_depth=gConfig.get('prefetch_queue_depth', 4),
+        num_workers=gConfig.get('prefetch_workers', 1))
+    inputs = batches
+    if _input_queue_capacity():
+      # A feeder thread moves the batches into the input queues of the graph.
+      inputs = batch_prefetcher.InputFeeder(
+          batches, functools.partial(model.enqueue, sess))
+
+    if is_chief:
+      # Checkpoints are written in the background while training goes on.
+      checkpointer = checkpoints.Checkpointer(
+          tf.all_variables(), gConfig['working_directory'],
+          keep_last=gConfig.get('keep_checkpoints', 5),
+          keep_best=gConfig.get('keep_best_checkpoints', 1),
+          asynchronous=gConfig.get('async_checkpoints', 1) > 0)
 
     # This is the training loop.
-    step_time, loss = 0.0, 0.0
+    step_time, wait_time, loss = 0.0, 0.0, 0.0
     current_step = 0
     previous_losses = []
     while True:
-      # Choose a bucket according to data distribution. We pick a random number
-      # in [0, 1] and use the corresponding interval in train_buckets_scale.
-      random_number_01 = np.random.random_sample()
-      bucket_id = min([i for i in range(len(train_buckets_scale))
-                       if train_buckets_scale[i] > random_number_01])
-
       # Get a batch and make a step.
       start_time = time.time()
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          train_set, bucket_id)
-      _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                   target_weights, bucket_id, False)
+      if inputs is batches:
+        bucket_id, batch, batch_wait = batches.get()
+        encoder_inputs, decoder_inputs, target_weights = batch
+        _, step_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
+                                     target_weights, bucket_id, False)
+      else:
+        bucket_id, batch_wait = inputs.get()
+        _, step_loss = model.queued_step(sess, bucket_id)
       step_time += (time.time() - start_time) / gConfig['steps_per_checkpoint']
+      wait_time += batch_wait / gConfig['steps_per_checkpoint']
       loss += step_loss / gConfig['steps_per_checkpoint']
       current_step += 1
+      if inputs.state['step'] == inputs.state['batches_per_epoch']:
+        print("Finished epoch %d." % (inputs.state['epoch'] + 1))
 
-      # Once in a while, we save checkpoint, print statistics, and run evals.
+      # Once in a while, we save checkpoint, print statistics, and run evals
+      # (the other workers of a cluster only print statistics).
       if current_step % gConfig['steps_per_checkpoint'] == 0:
         # Print statistics for the previous epoch.
         perplexity = math.exp(loss) if loss < 300 else float('inf')
-        print ("global step %d learning rate %.4f step-time %.2f perplexity "
-               "%.2f" % (model.global_step.eval(), model.learning_rate.eval(),
-                         step_time, perplexity))
+        # The wait for batches is part of the step time; when it is a large
+        # share, the input pipeline is the bottleneck.
+        print ("global step %d epoch %d (batch %d of %d) learning rate %.4f "
+               "step-time %.2f (batch wait %.2f, compute %.2f) perplexity %.2f"
+               % (model.global_step.eval(), inputs.state['epoch'] + 1,
+                  inputs.state['step'], inputs.state['batches_per_epoch'],
+                  model.learning_rate.eval(), step_time, wait_time,
+                  step_time - wait_time, perplexity))
+        sys.stdout.flush()
+        if not is_chief:
+          step_time, wait_time, loss = 0.0, 0.0, 0.0
+          continue
         # Decrease learning rate if no improvement was seen over last 3 times.
         if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
           sess.run(model.learning_rate_decay_op)
         previous_losses.append(loss)
-        # Save checkpoint and zero timer and loss.
-        checkpoint_path = os.path.join(gConfig['working_directory'], "seq2seq.ckpt")
-        model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-        step_time, loss = 0.0, 0.0
-        # Run evals on development set and print their perplexity.
+        # Zero timer and loss.
+        step_time, wait_time, loss = 0.0, 0.0, 0.0
+        # Run evals on development set and print their perplexity, with the
+        # full softmax whatever the training loss.
+        eval_losses = []
         for bucket_id in range(len(_buckets)):
           if len(dev_set[bucket_id]) == 0:
             print("  eval: empty bucket %d" % (bucket_id))
             continue
           encoder_inputs, decoder_inputs, target_weights = model.get_batch(
               dev_set, bucket_id)
-          _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs,
-                                       target_weights, bucket_id, True)
+          eval_loss = model.eval_step(sess, encoder_inputs, decoder_inputs,
+                                      target_weights, bucket_id)
+          eval_losses.append(eval_loss)
           eval_ppx = math.exp(eval_loss) if eval_loss < 300 else float('inf')
           print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+        # Save checkpoint, ranked by the evals for keep_best_checkpoints;
+        # the sampler state follows once the checkpoint is written.
+        start_time = time.time()
+        checkpointer.save(
+            sess, int(model.global_step.eval()),
+            dev_loss=np.mean(eval_losses) if eval_losses else None,
+            on_saved=functools.partial(bucket_sampler.save_state,
+                                       sampler_path, dict(inputs.state)))
+        print("  checkpoint: training stalled %.2fs" % (time.time() - start_time))
         sys.stdout.flush()
 
 
-def decode():
-  with tf.Session() as sess:
-    # Create model and load parameters.
-    model = create_model(sess, True)
-    model.batch_size = 1  # We decode one sentence at a time.
-
-    # Load vocabularies.
-    enc_vocab_path = os.path.join(gConfig['working_directory'],"vocab%d_enc.txt" % gConfig['enc_vocab_size'])
-    dec_vocab_path = os.path.join(gConfig['working_directory'],"vocab%d_dec.txt" % gConfig['dec_vocab_size'])
-
-    enc_vocab, _ = data_utils.initialize_vocabulary(enc_vocab_path)
-    _, rev_dec_vocab = data_utils.initialize_vocabulary(dec_vocab_path)
-
-
-
-    # Decode sentence and store it
-    with open(gConfig["test_enc"], 'r') as test_enc:
-        with open(gConfig["output"], 'w') as predicted_headline:
-            sentence_count = 0
-            for sentence in test_enc:
-                # Get token-ids for the input sentence.
-                token_ids = data_utils.sentence_to_token_ids(sentence, enc_vocab)
-                # Which bucket does it belong to? And place the sentence to the last bucket if its token length is larger then X.
-                bucket_id = min([b for b in range(len(_buckets)) if _buckets[b][0] > len(token_ids)] + [len(_buckets)-1])
-                # Get a 1-element batch to feed the sentence to the model.
-                encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-                {bucket_id: [(token_ids, [])]}, bucket_id)
-                # Get output logits for the sentence.
-                _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
-                                           target_weights, bucket_id, True)
-
-                # This is a greedy decoder - outputs are just argmaxes of output_logits.
-                outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
-
-                # If there is an EOS symbol in outputs, cut them at that point.
-                if data_utils.EOS_ID in outputs:
-                    outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-                # Write predicted headline corresponding to article.
-                predicted_headline.write(" ".join([tf.compat.as_str(rev_dec_vocab[output]) for output in outputs])+'\n')
-                sentence_count += 1
-                if sentence_count % 100 == 0:
-                    print("predicted data line %d" % sentence_count)
-                    sys.stdout.flush()
-
-        predicted_headline.close()
-    test_enc.close()
-
-    print("Finished decoding and stored predicted results in %s!" % gConfig["output"])
+def train_task(job_name, task_index):
+  """Runs a task, ps or worker, of the cluster set in seq2seq.ini."""
+  cluster = distributed.cluster_spec(gConfig['ps_hosts'],
+                                     gConfig['worker_hosts'])
+  if job_name == 'ps':
+    distributed.run_ps(cluster, task_index)
+  else:
+    train(cluster, task_index)
 
-def decode_input():
-  with tf.Session() as sess:
-    # Create model and load parameters.
-    model = create_model(sess, True)
-    model.batch_size = 1  # We decode one sentence at a time.
 
-    # Load vocabularies.
-    enc_vocab_path = os.path.join(gConfig['working_directory'],"vocab%d_enc.txt" % gConfig['enc_vocab_size'])
-    dec_vocab_path = os.path.join(gConfig['working_directory'],"vocab%d_dec.txt" % gConfig['dec_vocab_size'])
+def train_local(num_workers):
+  """Trains with num_workers workers and a parameter server on this host."""
+  # Prepare the data and plan the buckets once, before the workers start.
+  enc_train, dec_train, _, _, _, _ = _prepare_data()
+  _setup_buckets(enc_train, dec_train)
+  cluster, ps_processes, worker_processes = distributed.start_local(
+      num_workers, train, worker_config=_session_config('train'))
+  print("Started local cluster %s" % cluster.as_dict())
+  try:
+    for process in worker_processes:
+      process.join()
+  finally:
+    for process in ps_processes + worker_processes:
+      process.terminate()
 
-    enc_vocab, _ = data_utils.initialize_vocabulary(enc_vocab_path)
-    _, rev_dec_vocab = data_utils.initialize_vocabulary(dec_vocab_path)
 
+def _frozen_model_path():
+  """Path of the frozen inference graph set in seq2seq.ini, None for none."""
+  path = gConfig.get('frozen_model', 'none')
+  return None if path == 'none' else path
 
-    # Decode from standard input.
-    sys.stdout.write("> ")
-    sys.stdout.flush()
-    sentence = sys.stdin.readline()
 
-    while sentence:
-      # Get token-ids for the input sentence.
-      token_ids = data_utils.sentence_to_token_ids(sentence, enc_vocab)
-      # Which bucket does it belong to? And place the sentence to the last bucket if its token length is larger then the bucket length.
-      bucket_id = min([b for b in range(len(_buckets)) if _buckets[b][0] > len(token_ids)] + [len(_buckets)-1])
-      # Get a 1-element batch to feed the sentence to the model.
-      encoder_inputs, decoder_inputs, target_weights = model.get_batch(
-          {bucket_id: [(token_ids, [])]}, bucket_id)
+def _bucket_of(token_ids):
+  """Bucket of a source to decode."""
+  # Which bucket does it belong to? And place the sentence to the last bucket if its token length is larger then the bucket length.
+  return min([b for b in range(len(_buckets)) if _buckets[b][0] > len(token_ids)] + [len(_buckets)-1])
+
+
+def _load_predictor(config=None):
+  """Returns a function mapping source token-ids to greedy output ids.
+
+  Serves from the frozen graph when one is set in seq2seq.ini, otherwise
+  builds the forward_only model and restores its checkpoint. The function's
+  close attribute closes its session. config defaults to the decoding
+  session settings.
+  """
+  if config is None:
+    config = _session_config('decode')
+  candidates_of = None
+  if _shortlist_size():
+    candidates_of = shortlist.Shortlist(*_load_vocabularies(),
+                                        num_frequent=_shortlist_size())
+  if _frozen_model_path():
+    return frozen_model.FrozenModel(_frozen_model_path(), config,
+                                    shortlist=candidates_of)
+  sess = tf.Session(config=config)
+  # Create model and load parameters.
+  model = create_model(sess, True)
+  model.batch_size = 1  # We decode one sentence at a time.
+
+  def predict(token_ids):
+    bucket_id = _bucket_of(token_ids)
+    # Get a 1-element batch to feed the sentence to the model.
+    encoder_inputs, decoder_inputs, target_weights = model.get_batch(
+        {bucket_id: [(token_ids, [])]}, bucket_id)
+    if candidates_of is None:
       # Get output logits for the sentence.
       _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
                                        target_weights, bucket_id, True)
       # This is a greedy decoder - outputs are just argmaxes of output_logits.
-      outputs = [int(np.argmax(logit, axis=1)) for logit in output_logits]
+      return [int(np.argmax(logit, axis=1)) for logit in output_logits]
+    # The logits are those of the sentence's candidates only.
+    candidates = candidates_of(token_ids)
+    _, _, output_logits = model.step(sess, encoder_inputs, decoder_inputs,
+                                     target_weights, bucket_id, True,
+                                     candidates=candidates)
+    return [int(candidates[np.argmax(logit, axis=1)])
+            for logit in output_logits]
+  predict.close = sess.close
+  return predict
+
+
+def _report_cold_start(start_time):
+  print("First prediction %.2fs after start (%s)."
+        % (time.time() - start_time,
+           "frozen graph" if _frozen_model_path() else "checkpoint"))
+  sys.stdout.flush()
+
+
+def _load_vocabularies():
+  """Returns the source and target vocabularies of the working directory."""
+  enc_vocab_path = os.path.join(gConfig['working_directory'],"vocab%d_enc.txt" % gConfig['enc_vocab_size'])
+  dec_vocab_path = os.path.join(gConfig['working_directory'],"vocab%d_dec.txt" % gConfig['dec_vocab_size'])
+  return (vocabulary.Vocabulary.load(enc_vocab_path,
+                                     tokenizer=_load_tokenizer()),
+          vocabulary.Vocabulary.load(dec_vocab_path))
+
+
+def _decode_headline(predict, enc_vocab, dec_vocab, sentence):
+  """Returns the greedy headline of a sentence."""
+  # Get token-ids for the input sentence.
+  token_ids = enc_vocab.encode([sentence])[0].tolist()
+  return _headline_text(dec_vocab, predict(token_ids))
+
+
+def _headline_text(dec_vocab, outputs):
+  """Text of the output ids of the decoder."""
+  # If there is an EOS symbol in outputs, cut them at that point.
+  if data_utils.EOS_ID in outputs:
+    outputs = outputs[:outputs.index(data_utils.EOS_ID)]
+  return _join_tokens(dec_vocab.decode(outputs)) if outputs else ""
+
+
+def decode():
+  start_time = time.time()
+  _setup_buckets()
+  predict = _load_predictor()
+
+  # Load vocabularies.
+  enc_vocab, dec_vocab = _load_vocabularies()
+
+
+
+  # Decode sentence and store it
+  with open(gConfig["test_enc"], 'r') as test_enc:
+      with open(gConfig["output"], 'w') as predicted_headline:
+          sentence_count = 0
+          for sentence in test_enc:
+              headline = _decode_headline(predict, enc_vocab, dec_vocab,
+                                          sentence)
+              if sentence_count == 0:
+                  _report_cold_start(start_time)
+
+              # Write predicted headline corresponding to article.
+              predicted_headline.write(headline+'\n')
+              sentence_count += 1
+              if sentence_count % 100 == 0:
+                  print("predicted data line %d" % sentence_count)
+                  sys.stdout.flush()
+
+      predicted_headline.close()
+  test_enc.close()
 
+  print("Finished decoding and stored predicted results in %s!" % gConfig["output"])
 
-      # If there is an EOS symbol in outputs, cut them at that point.
-      if data_utils.EOS_ID in outputs:
-        outputs = outputs[:outputs.index(data_utils.EOS_ID)]
-      # Print out French sentence corresponding to outputs.
-      print(" ".join([tf.compat.as_str(rev_dec_vocab[output]) for output in outputs]))
+def decode_input():
+  start_time = time.time()
+  _setup_buckets()
+  predict = _load_predictor()
+
+  # Load vocabularies.
+  enc_vocab, dec_vocab = _load_vocabularies()
+  # Time to the first prediction, without the wait for the first input.
+  predict(enc_vocab.encode([""])[0].tolist())
+  _report_cold_start(start_time)
+
+
+  # Decode from standard input.
+  sys.stdout.write("> ")
+  sys.stdout.flush()
+  sentence = sys.stdin.readline()
+
+  while sentence:
+    # Print out the headline of the sentence.
+    print(_decode_headline(predict, enc_vocab, dec_vocab, sentence))
+
+    print("> ", end="")
+    sys.stdout.flush()
+    sentence = sys.stdin.readline()
 
-      print("> ", end="")
+def export():
+  """Writes the frozen inference graph of the latest checkpoint."""
+  _setup_buckets()
+  path = _frozen_model_path() or os.path.join(gConfig['working_directory'],
+                                              "frozen_model.pb")
+  with tf.Session(config=_session_config('decode')) as sess:
+    model = create_model(sess, True)
+    num_nodes = frozen_model.export(
+        sess, model, path, weights=gConfig.get('frozen_weights', 'float32'))
+  print("Exported the frozen inference graph (%d nodes, %.1f MB) to %s; set "
+        "frozen_model = %s in seq2seq.ini to decode from it."
+        % (num_nodes, os.path.getsize(path) / 2.0**20, path, path))
+
+def _student_overrides():
+  """Settings of seq2seq.ini that make the model the student's."""
+  directory = gConfig['student_directory']
+  return {'working_directory': directory,
+          'train_dec': os.path.join(directory, "distilled_dec.txt"),
+          'num_layers': gConfig['student_num_layers'],
+          'hidden_units': gConfig['student_hidden_units'],
+          'enc_vocab_size': gConfig['student_enc_vocab_size'],
+          'dec_vocab_size': gConfig['student_dec_vocab_size'],
+          'frozen_model': gConfig.get('student_frozen_model', 'none')}
+
+
+def _use_student():
+  """Makes the student of mode = distill the model of gConfig."""
+  gConfig.update(_student_overrides())
+
+
+def _distill_targets(path):
+  """Writes the teacher's greedy headline of every training source to path.
+
+  The sources of each bucket are decoded in batches of distill_batch_size.
+  The headlines are kept, and path.json records the teacher checkpoint and
+  the sources they come from, until either changes.
+  """
+  teacher_path = _checkpoint_path()
+  if teacher_path is None:
+    raise ValueError("mode = distill needs a teacher trained in %s."
+                     % gConfig['working_directory'])
+  source = os.stat(gConfig['train_enc'])
+  record = {'teacher': teacher_path, 'source': gConfig['train_enc'],
+            'source_size': source.st_size,
+            'source_mtime_ns': source.st_mtime_ns}
+  record_path = path + ".json"
+  if os.path.exists(path) and os.path.exists(record_path):
+    with open(record_path) as f:
+      if json.load(f) == record:
+        print("Reusing the teacher's headlines in %s." % path)
+        return
+
+  enc_vocab, dec_vocab = _load_vocabularies()
+  batch_size = gConfig.get('distill_batch_size', 256)
+  # The batches are decoded with the full softmax.
+  gConfig['decode_shortlist'] = 0
+  print("Decoding the training sources with the teacher %s." % teacher_path)
+  start_time = time.time()
+  num_lines = 0
+  tmp_path = "%s.tmp%d" % (path, os.getpid())
+  with tf.Graph().as_default(), \
+      tf.Session(config=_session_config('decode')) as sess, \
+      corpus_io.open_input(gConfig['train_enc'], text=True) as sources, \
+      io.open(tmp_path, "w", encoding="utf-8") as headlines:
+    model = create_model(sess, True)
+    while True:
+      lines = list(itertools.islice(sources, 64 * batch_size))
+      if not lines:
+        break
+      token_ids = [ids.tolist() for ids in enc_vocab.encode(lines)]
+      bucket_ids = [_bucket_of(ids) for ids in token_ids]
+      texts = [None] * len(lines)
+      for bucket_id in range(len(_buckets)):
+        indices = [i for i, b in enumerate(bucket_ids) if b == bucket_id]
+        for start in range(0, len(indices), batch_size):
+          batch = indices[start:start + batch_size]
+          model.batch_size = len(batch)
+          encoder_inputs, decoder_inputs, target_weights = model.get_batch(
+              {bucket_id: [(token_ids[i], []) for i in batch]}, bucket_id,
+              np.arange(len(batch)))
+          # Greedy decoding; only the ids leave the graph, not the logits.
+          outputs = model.decode_step(sess, encoder_inputs, decoder_inputs,
+                                      target_weights, bucket_id).T
+          for i, output in zip(batch, outputs):
+            texts[i] = _headline_text(dec_vocab, output.tolist())
+      for text in texts:
+        headlines.write(text + "\n")
+      num_lines += len(lines)
+      print("  decoded %d sources (%.1f/s)"
+            % (num_lines, num_lines / (time.time() - start_time)))
       sys.stdout.flush()
-      sentence = sys.stdin.readline()
+  os.replace(tmp_path, path)
+  tmp_path = "%s.tmp%d" % (record_path, os.getpid())
+  with open(tmp_path, "w") as f:
+    json.dump(record, f, indent=1)
+  os.replace(tmp_path, record_path)
+
+
+def distill():
+  """Trains the student of seq2seq.ini on the headlines of the teacher.
+
+  The teacher is the model trained in the working directory. Its greedy
+  headlines of the training sources (sequence-level knowledge
+  distillation) replace the true ones as the targets of the student, a
+  model of its own size and vocabularies trained in student_directory like
+  mode = train does. Set serve_student = 1 to decode with the student.
+  """
+  _setup_buckets()
+  overrides = _student_overrides()
+  if not os.path.exists(overrides['working_directory']):
+    os.makedirs(overrides['working_directory'])
+  _distill_targets(overrides['train_dec'])
+  gConfig.update(overrides)
+  train()
+
+
+def autotune():
+  """Stores the fastest session settings for training and for decoding.
+
+  Short runs of train steps and of greedy predictions (on the first test
+  sentences) are timed for every thread counts of a grid bounded by the
+  cores of each of workers_per_host processes.
+  """
+  enc_train, dec_train, _, _, _, _ = _prepare_data()
+  _setup_buckets(enc_train, dec_train)
+  train_set = read_data(enc_train, dec_train, gConfig['max_train_data_size'])
+  train_bucket_sizes = [len(train_set[b]) for b in range(len(_buckets))]
+  enc_vocab, _ = _load_vocabularies()
+  with open(gConfig['test_enc'], 'r') as test_enc:
+    sentences = [sentence for _, sentence in zip(range(100), test_enc)]
+  test_ids = [ids.tolist() for ids in enc_vocab.encode(sentences)] or [[]]
+  steps = gConfig.get('autotune_steps', 20)
+  grid = session_tuning.thread_grid(gConfig.get('workers_per_host', 1),
+                                    gConfig.get('graph_optimizer', 'L1'))
+
+  def train_trial(config):
+    sess = tf.Session(config=config)
+    model = create_model(sess, False)
+    # The batches are assembled beforehand: only the session runs are timed.
+    sampler = bucket_sampler.EpochBucketSampler(train_bucket_sizes,
+                                                gConfig['batch_size'])
+    batches = []
+    for _ in range(steps + 1):
+      bucket_id, indices = sampler.next()
+      batches.append((bucket_id, model.get_batch(train_set, bucket_id,
+                                                 indices)))
+    batches = iter(batches)
+
+    def step():
+      bucket_id, batch = next(batches)
+      model.step(sess, batch[0], batch[1], batch[2], bucket_id, False)
+    return step, sess.close
+
+  def decode_trial(config):
+    predict = _load_predictor(config)
+    token_ids = iter(test_ids * (steps // len(test_ids) + 1) + test_ids)
+    return lambda: predict(next(token_ids)), predict.close
+
+  profiles = {}
+  print("Timing %d train steps per setting." % steps)
+  profiles['train'], _ = session_tuning.tune(train_trial, grid, steps)
+  print("Timing %d predictions per setting." % steps)
+  profiles['decode'], _ = session_tuning.tune(decode_trial, grid, steps)
+  path = os.path.join(gConfig['working_directory'],
+                      session_tuning.PROFILE_NAME)
+  session_tuning.save_profile(path, profiles)
+  for purpose in ('train', 'decode'):
+    print("%s: intra_op_threads %d, inter_op_threads %d"
+          % (purpose, profiles[purpose]['intra_op_threads'],
+             profiles[purpose]['inter_op_threads']))
+  print("Stored in %s; training and decoding use these settings from now "
+        "on." % path)
 
 if __name__ == '__main__':
     # get configuration from seq2seq.ini
@@ -281,13 +752,32 @@ if __name__ == '__main__':
 
     print('\n>> Mode : %s\n' %(gConfig['mode']))
 
+    if gConfig.get('serve_student', 0) and gConfig['mode'] in ('test', 'interactive', 'export'):
+        # decode with the student trained by mode = distill
+        _use_student()
+
     if gConfig['mode'] == 'train':
         # start training
-        train()
+        if len(sys.argv) > 2:
+            # a task of the cluster: python execute.py ps|worker task_index
+            train_task(sys.argv[1], int(sys.argv[2]))
+        elif gConfig.get('local_workers', 1) > 1:
+            train_local(gConfig['local_workers'])
+        else:
+            train()
     elif gConfig['mode'] == 'test':
         # start testing
         decode()
     elif gConfig['mode'] == 'interactive':
         # start interactive decoding
         decode_input()
+    elif gConfig['mode'] == 'export':
+        # write the frozen inference graph
+        export()
+    elif gConfig['mode'] == 'autotune':
+        # time the session threading settings
+        autotune()
+    elif gConfig['mode'] == 'distill':
+        # train the student on the headlines of the trained model
+        distill()
 
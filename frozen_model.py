@@ -0,0 +1,275 @@
+"""Frozen inference graphs of the seq2seq models.
+
+Decoding from a checkpoint builds the whole forward_only model in Python
+(an unrolled subgraph per bucket) before restoring its variables. export
+writes instead a single GraphDef with the variables folded into constants,
+pruned to the ops computing the logits of the buckets decoding can pick;
+FrozenModel imports it and serves greedy predictions without building or
+restoring anything.
+
+With weights = "int8", the embeddings (tables sized by the vocabularies)
+are stored as int8 with a float scale per row (quantize_table), and their
+lookups gather int8 rows and only scale those. Only tables used by nothing
+but lookups are quantized. The output projection proj_w stays float32:
+without an int8 matmul, a quantized one would have to be dequantized whole,
+which constant folding keeps as a float32 constant next to the int8 one,
+and which every run repeats when graph_optimizer = L0 disables folding.
+
+A JSON file next to the graph records the exported buckets and the names
+of their input and output tensors.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.framework import attr_value_pb2
+from tensorflow.core.framework import node_def_pb2
+from tensorflow.python.framework import graph_util
+from tensorflow.python.framework import tensor_util
+
+import data_utils
+import token_corpus
+
+_META_SUFFIX = ".json"
+# Tables quantized by export with weights = "int8", by the last component of
+# their name, with the axis their scales are taken over (rows, as gathered).
+_QUANTIZED_AXES = {"embedding": 1}
+_GATHER_OPS = ("Gather", "GatherV2")
+
+
+def decoding_buckets(buckets):
+  """Ids of the buckets execute.decode can pick for a source.
+
+  decode picks the first bucket whose input size exceeds the source length,
+  else the last one, so only the first bucket of every input size is used.
+  """
+  used = []
+  for bucket_id, (encoder_size, _) in enumerate(buckets):
+    if not used or buckets[used[-1]][0] != encoder_size:
+      used.append(bucket_id)
+  if used[-1] != len(buckets) - 1:
+    used.append(len(buckets) - 1)
+  return used
+
+
+def quantize_table(values, axis):
+  """Symmetric int8 quantization with a scale per slice across axis.
+
+  Returns:
+    the int8 array and the float32 scales (values ~ int8 * scales), with
+    axis kept as a dimension of size 1 so they broadcast.
+  """
+  scales = np.abs(values).max(axis=axis, keepdims=True) / 127.0
+  scales[scales == 0] = 1.0
+  return (np.round(values / scales).astype(np.int8),
+          scales.astype(np.float32))
+
+
+def _node(op, name, inputs, **attrs):
+  node = node_def_pb2.NodeDef(op=op, name=name, input=inputs)
+  for key, value in attrs.items():
+    if isinstance(value, tf.DType):
+      node.attr[key].CopyFrom(attr_value_pb2.AttrValue(
+          type=value.as_datatype_enum))
+    else:
+      node.attr[key].CopyFrom(attr_value_pb2.AttrValue(
+          tensor=tensor_util.make_tensor_proto(value)))
+  return node
+
+
+def _dequantize(name, quantized, scales):
+  """Nodes computing `name` = float(quantized) * scales."""
+  return [_node("Cast", name + "/to_float", [quantized], SrcT=tf.int8,
+                DstT=tf.float32),
+          _node("Mul", name, [name + "/to_float", scales], T=tf.float32)]
+
+
+def _quantize_graph(graph_def, output_nodes):
+  """Replaces the tables of _QUANTIZED_AXES of a frozen graph by int8 ones.
+
+  A table is only quantized if all its uses are lookups: any other use
+  would need the whole table dequantized.
+
+  Returns:
+    the new GraphDef and the names of the quantized tables.
+  """
+  nodes = dict((node.name, node) for node in graph_def.node)
+  consumers = {}
+  for node in graph_def.node:
+    for name in node.input:
+      consumers.setdefault(name.lstrip("^").split(":")[0], []).append(node)
+
+  def only_gathered(name):
+    """Whether every use of name, through identities, is a lookup in it."""
+    for node in consumers.get(name, []):
+      if node.op == "Identity":
+        if not only_gathered(node.name):
+          return False
+      elif (node.op not in _GATHER_OPS or
+            node.input[0].split(":")[0] != name):
+        return False
+    return True
+
+  tables = [node.name for node in graph_def.node
+            if node.op == "Const" and
+            node.name.split("/")[-1] in _QUANTIZED_AXES and
+            node.attr["dtype"].type == tf.float32.as_datatype_enum and
+            len(node.attr["value"].tensor.tensor_shape.dim) == 2 and
+            only_gathered(node.name)]
+
+  def table_of(node):
+    """The table a lookup gathers from, through identities, else None."""
+    name = node.input[0].split(":")[0]
+    while nodes[name].op == "Identity":
+      name = nodes[name].input[0].split(":")[0]
+    return name if name in tables else None
+
+  colocations = dict(("loc:@" + table, "loc:@%s/int8" % table)
+                     for table in tables)
+  quantized = tf.GraphDef()
+  for node in graph_def.node:
+    if node.name in tables:
+      values, scales = quantize_table(
+          tensor_util.MakeNdarray(node.attr["value"].tensor),
+          _QUANTIZED_AXES[node.name.split("/")[-1]])
+      quantized.node.extend(
+          [_node("Const", node.name + "/int8", [], dtype=tf.int8,
+                 value=values),
+           _node("Const", node.name + "/scales", [], dtype=tf.float32,
+                 value=scales)] +
+          _dequantize(node.name, node.name + "/int8", node.name + "/scales"))
+      continue
+    new_node = quantized.node.add()
+    new_node.CopyFrom(node)
+    # Colocation with a table moves to its int8 values.
+    if "_class" in node.attr:
+      new_node.attr["_class"].list.s[:] = [
+          colocations.get(location.decode(), location.decode()).encode()
+          for location in node.attr["_class"].list.s]
+    table = table_of(node) if node.op in _GATHER_OPS else None
+    if table:
+      # Gather the int8 rows and their scales, then scale only those rows.
+      new_node.name = node.name + "/int8"
+      new_node.input[0] = table + "/int8"
+      new_node.attr["Tparams"].type = tf.int8.as_datatype_enum
+      scales = quantized.node.add()
+      scales.CopyFrom(new_node)
+      scales.attr["Tparams"].type = tf.float32.as_datatype_enum
+      scales.name = node.name + "/scales"
+      scales.input[0] = table + "/scales"
+      quantized.node.extend(_dequantize(node.name, new_node.name,
+                                        scales.name))
+  # Drop the dequantized tables (and the identities leading to them): the
+  # lookups are all that used them.
+  return graph_util.extract_sub_graph(quantized, output_nodes), tables
+
+
+def export(session, model, path, weights="float32"):
+  """Writes the frozen forward_only `model` restored in `session` to path.
+
+  Args:
+    session: session the model's variables are restored in.
+    model: the forward_only Seq2SeqModel or DynamicSeq2SeqModel.
+    path: file the graph is written to.
+    weights: "float32", or "int8" to quantize the embeddings.
+
+  Returns:
+    the number of nodes of the frozen graph.
+  """
+  if isinstance(model.outputs, list):  # Seq2SeqModel: a subgraph per bucket.
+    exported, output_nodes = [], []
+    for bucket_id in decoding_buckets(model.buckets):
+      encoder_size, decoder_size = model.buckets[bucket_id]
+      logits = tf.pack(model.outputs[bucket_id][:decoder_size],
+                       name="frozen/logits%d" % bucket_id)
+      exported.append({
+          "size": [encoder_size, decoder_size],
+          "encoder_inputs": [t.name for t in
+                             model.encoder_inputs[:encoder_size]],
+          "decoder_input": model.decoder_inputs[0].name,
+          "logits": logits.name})
+      output_nodes.append(logits.op.name)
+    meta = {"model": "bucketed", "buckets": exported}
+    if hasattr(model, "candidates"):  # Logits of a shortlist.
+      meta["candidates"] = model.candidates.name
+  else:  # DynamicSeq2SeqModel: one graph for any size.
+    logits = tf.identity(model.outputs, name="frozen/logits")
+    meta = {"model": "dynamic",
+            "buckets": [{"size": list(bucket)} for bucket in model.buckets],
+            "encoder_inputs": model.encoder_inputs.name,
+            "decoder_input": model.decoder_inputs.name,
+            "logits": logits.name}
+    output_nodes = [logits.op.name]
+
+  frozen = graph_util.convert_variables_to_constants(
+      session, session.graph.as_graph_def(), output_nodes)
+  meta["weights"] = weights
+  if weights == "int8":
+    frozen, meta["quantized"] = _quantize_graph(frozen, output_nodes)
+  elif weights != "float32":
+    raise ValueError("Unknown weights %s, use float32 or int8." % weights)
+  tmp_path = "%s.tmp%d" % (path, os.getpid())
+  with open(tmp_path, "wb") as f:
+    f.write(frozen.SerializeToString())
+  os.replace(tmp_path, path)
+  with open(path + _META_SUFFIX, "w") as f:
+    json.dump(meta, f, indent=1)
+  return len(frozen.node)
+
+
+class FrozenModel(object):
+  """Greedy decoder serving from a graph written by export.
+
+  A graph of a shortlist model needs the shortlist.Shortlist giving the
+  candidates of every source.
+  """
+
+  def __init__(self, path, config=None, shortlist=None):
+    with open(path + _META_SUFFIX) as f:
+      self.meta = json.load(f)
+    self.buckets = [tuple(bucket["size"]) for bucket in self.meta["buckets"]]
+    if "candidates" in self.meta and shortlist is None:
+      raise ValueError("%s was exported with a shortlist; set "
+                       "decode_shortlist in seq2seq.ini." % path)
+    self.shortlist = shortlist if "candidates" in self.meta else None
+    graph_def = tf.GraphDef()
+    with open(path, "rb") as f:
+      graph_def.ParseFromString(f.read())
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      tf.import_graph_def(graph_def, name="")
+    self.session = tf.Session(graph=self.graph, config=config)
+
+  def __call__(self, token_ids):
+    """Returns the greedy output ids for the source token-ids."""
+    index = min([i for i in range(len(self.buckets))
+                 if self.buckets[i][0] > len(token_ids)] +
+                [len(self.buckets) - 1])
+    encoder_size, decoder_size = self.buckets[index]
+    encoder_inputs, decoder_inputs, _ = token_corpus.time_major_batch(
+        token_corpus.PairBucket.from_pairs([(token_ids, [])]), [0],
+        encoder_size, decoder_size, data_utils.GO_ID, data_utils.PAD_ID)
+    if self.meta["model"] == "dynamic":
+      feed = {self.meta["encoder_inputs"]: encoder_inputs,
+              self.meta["decoder_input"]: decoder_inputs}
+      logits_name = self.meta["logits"]
+    else:
+      bucket = self.meta["buckets"][index]
+      feed = dict(zip(bucket["encoder_inputs"], encoder_inputs))
+      feed[bucket["decoder_input"]] = decoder_inputs[0]
+      logits_name = bucket["logits"]
+    if self.shortlist is None:
+      logits = self.session.run(logits_name, feed)
+      return [int(i) for i in np.argmax(logits[:, 0], axis=1)]
+    candidates = self.shortlist(token_ids)
+    feed[self.meta["candidates"]] = candidates
+    logits = self.session.run(logits_name, feed)
+    return [int(candidates[i]) for i in np.argmax(logits[:, 0], axis=1)]
+
+  def close(self):
+    self.session.close()
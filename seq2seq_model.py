@@ -19,14 +19,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import random
-
 import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
 from tensorflow.models.rnn.translate import data_utils
-from tensorflow.python.ops.rnn_cell import GRUCell, DropoutWrapper, MultiRNNCell, BasicLSTMCell
+from tensorflow.python.ops.rnn_cell import GRUCell, DropoutWrapper, MultiRNNCell, BasicLSTMCell, RNNCell
+
+import distributed
+import token_corpus
+
 
 class Seq2SeqModel(object):
   """Sequence-to-sequence model with attention and for multiple buckets.
@@ -46,7 +48,9 @@ class Seq2SeqModel(object):
   def __init__(self, source_vocab_size, target_vocab_size, buckets, size,
                num_layers, max_gradient_norm, batch_size, learning_rate,
                learning_rate_decay_factor, use_lstm=True,
-               num_samples=512, forward_only=False):
+               num_samples=512, forward_only=False, input_queue_capacity=0,
+               sync_replicas=0, shortlist=False, loss="sampled_softmax",
+               adaptive_cutoffs=(2000, 10000)):
     """Create the model.
 
     Args:
@@ -66,8 +70,32 @@ class Seq2SeqModel(object):
       learning_rate: learning rate to start with.
       learning_rate_decay_factor: decay learning rate by this much when needed.
       use_lstm: if true, we use LSTM cells instead of GRU cells.
-      num_samples: number of samples for sampled softmax.
+      num_samples: number of samples for sampled softmax and NCE; with 0 or
+        at least target_vocab_size, the full softmax is used instead.
       forward_only: if set, we do not construct the backward pass in the model.
+      input_queue_capacity: if > 0, the inputs of every bucket are dequeued
+        in the graph from a queue holding that many batches, filled with
+        enqueue(), and training steps are run with queued_step() without
+        feeding the inputs; step() can still feed them. Only used for
+        training (not forward_only).
+      sync_replicas: if > 0, the model is one of that many workers of a
+        cluster, built under its tf.train.replica_device_setter: the update
+        ops average the gradients of all workers (self.sync, a
+        distributed.SyncReplicas) before applying them.
+      shortlist: if set (forward_only, with sampled softmax or NCE), the
+        outputs are the logits of the target ids fed to self.candidates
+        with every step (see shortlist.Shortlist), in their order, and the
+        previous output fed back while decoding is picked among them.
+      loss: training loss: "sampled_softmax", "nce" (noise-contrastive
+        estimation, with num_samples noise words) or "adaptive_softmax"
+        (see _AdaptiveSoftmax). Evals (eval_step) use the exact softmax.
+      adaptive_cutoffs: increasing target ids ending the head cluster and
+        the tail clusters but the last of the adaptive softmax; target ids
+        must be sorted by frequency, as the vocabularies are.
+
+    Raises:
+      ValueError: if loss is unknown, or shortlist is set without
+        forward_only or with the full or adaptive softmax.
     """
     self.source_vocab_size = source_vocab_size
     self.target_vocab_size = target_vocab_size
@@ -78,22 +106,53 @@ class Seq2SeqModel(object):
         self.learning_rate * learning_rate_decay_factor)
     self.global_step = tf.Variable(0, trainable=False)
 
+    if loss not in ("sampled_softmax", "nce", "adaptive_softmax"):
+      raise ValueError("Unknown loss %s." % loss)
     # If we use sampled softmax, we need an output projection.
     output_projection = None
     softmax_loss_function = None
+    # The evals use the exact loss instead of its sampled estimate.
+    eval_loss_function = None
+    # Scores decoding takes the argmax of, when they are not a projection
+    # embedding_attention_seq2seq can apply itself.
+    decode_projection = None
+    if loss == "adaptive_softmax":
+      adaptive_softmax = _AdaptiveSoftmax(size, self.target_vocab_size,
+                                          adaptive_cutoffs)
+      softmax_loss_function = adaptive_softmax.loss
+      decode_projection = adaptive_softmax.log_probs
     # Sampled softmax only makes sense if we sample less than vocabulary size.
-    if num_samples > 0 and num_samples < self.target_vocab_size:
+    elif num_samples > 0 and num_samples < self.target_vocab_size:
       w = tf.get_variable("proj_w", [size, self.target_vocab_size])
       w_t = tf.transpose(w)
       b = tf.get_variable("proj_b", [self.target_vocab_size])
       output_projection = (w, b)
+      sampled_loss_function = (tf.nn.nce_loss if loss == "nce" else
+                               tf.nn.sampled_softmax_loss)
 
       def sampled_loss(inputs, labels):
         labels = tf.reshape(labels, [-1, 1])
-        return tf.nn.sampled_softmax_loss(w_t, b, inputs, labels, num_samples,
+        return sampled_loss_function(w_t, b, inputs, labels, num_samples,
                 self.target_vocab_size)
       softmax_loss_function = sampled_loss
 
+      def eval_loss_function(inputs, labels):
+        return tf.nn.sparse_softmax_cross_entropy_with_logits(
+            logits=tf.matmul(inputs, w) + b, labels=labels)
+
+    if shortlist:
+      if not forward_only or output_projection is None:
+        raise ValueError("A shortlist needs forward_only and sampled softmax "
+                         "or NCE.")
+      # Target ids the outputs are projected onto, fed with every step.
+      self.candidates = tf.placeholder(tf.int32, shape=[None],
+                                       name="candidates")
+      # The candidates' columns of the projection, gathered once per run.
+      w_candidates = tf.transpose(tf.gather(w_t, self.candidates))
+      b_candidates = tf.gather(b, self.candidates)
+      decode_projection = lambda output: (
+          tf.matmul(output, w_candidates) + b_candidates)
+
     # Create the internal multi-layer cell for our RNN.
     output_keep_prob = tf.constant(0.8)
     single_cell = GRUCell(size)
@@ -108,6 +167,12 @@ class Seq2SeqModel(object):
 
     # The seq2seq function: we use embedding for the input and attention.
     def seq2seq_f(encoder_inputs, decoder_inputs, do_decode):
+      if decode_projection is not None:
+        return _projected_seq2seq(
+            encoder_inputs, decoder_inputs, cell, source_vocab_size,
+            target_vocab_size, size,
+            decode_projection if do_decode else None,
+            self.candidates if shortlist else None)
       return tf.nn.seq2seq.embedding_attention_seq2seq(
           encoder_inputs, decoder_inputs, cell,
           num_encoder_symbols=source_vocab_size,
@@ -116,6 +181,47 @@ class Seq2SeqModel(object):
           output_projection=output_projection,
           feed_previous=do_decode)
 
+    # If we use output projection, we need to project outputs for decoding.
+    project = decode_projection
+    if project is None and output_projection is not None:
+      project = lambda output: (
+          tf.matmul(output, output_projection[0]) + output_projection[1])
+    if input_queue_capacity > 0 and not forward_only:
+      self._build_queued_model(buckets, seq2seq_f, softmax_loss_function,
+                               eval_loss_function, input_queue_capacity)
+    else:
+      self._build_fed_model(buckets, seq2seq_f, softmax_loss_function,
+                            eval_loss_function, project, forward_only)
+    if forward_only:
+      # Greedy output ids, so decoding fetches them instead of the logits.
+      self.output_ids = []
+      for outputs in self.outputs:
+        output_ids = tf.to_int32(tf.argmax(tf.pack(outputs), 2))
+        if shortlist:
+          output_ids = tf.gather(self.candidates, output_ids)
+        self.output_ids.append(output_ids)
+
+    # Gradients and SGD update operation for training the model.
+    params = tf.trainable_variables()
+    if not forward_only:
+      self.gradient_norms = []
+      self.updates = []
+      opt = _optimizer(self, sync_replicas)
+      for b in xrange(len(buckets)):
+        gradients = tf.gradients(self.losses[b], params)
+        clipped_gradients, norm = tf.clip_by_global_norm(gradients,
+                                                         max_gradient_norm)
+        self.gradient_norms.append(norm)
+        self.updates.append(opt.apply_gradients(
+            zip(clipped_gradients, params), global_step=self.global_step))
+
+    self.saver = tf.train.Saver(tf.all_variables())
+    # Can add max_to_keep as argument to tf.train.Saver()
+    # max_to_keep: Maximum number of recent checkpoints to keep. Defaults to 5.
+
+  def _build_fed_model(self, buckets, seq2seq_f, softmax_loss_function,
+                       eval_loss_function, project, forward_only):
+    """Builds the buckets on placeholders fed by step()."""
     # Feeds for inputs.
     self.encoder_inputs = []
     self.decoder_inputs = []
@@ -139,40 +245,64 @@ class Seq2SeqModel(object):
           self.encoder_inputs, self.decoder_inputs, targets,
           self.target_weights, buckets, lambda x, y: seq2seq_f(x, y, True),
           softmax_loss_function=softmax_loss_function)
-      # If we use output projection, we need to project outputs for decoding.
-      if output_projection is not None:
+      if project is not None:
         for b in xrange(len(buckets)):
-          self.outputs[b] = [
-              tf.matmul(output, output_projection[0]) + output_projection[1]
-              for output in self.outputs[b]
-          ]
+          self.outputs[b] = [project(output) for output in self.outputs[b]]
     else:
       self.outputs, self.losses = tf.nn.seq2seq.model_with_buckets(
           self.encoder_inputs, self.decoder_inputs, targets,
           self.target_weights, buckets,
           lambda x, y: seq2seq_f(x, y, False),
           softmax_loss_function=softmax_loss_function)
-
-    # Gradients and SGD update operation for training the model.
-    params = tf.trainable_variables()
-    if not forward_only:
-      self.gradient_norms = []
-      self.updates = []
-      opt = tf.train.GradientDescentOptimizer(self.learning_rate)
-      for b in xrange(len(buckets)):
-        gradients = tf.gradients(self.losses[b], params)
-        clipped_gradients, norm = tf.clip_by_global_norm(gradients,
-                                                         max_gradient_norm)
-        self.gradient_norms.append(norm)
-        self.updates.append(opt.apply_gradients(
-            zip(clipped_gradients, params), global_step=self.global_step))
-
-    self.saver = tf.train.Saver(tf.all_variables())
-    # Can add max_to_keep as argument to tf.train.Saver()
-    # max_to_keep: Maximum number of recent checkpoints to keep. Defaults to 5.
+      self.eval_losses = [
+          _eval_loss(self.outputs[b], targets, self.target_weights,
+                     eval_loss_function, self.losses[b])
+          for b in xrange(len(buckets))]
+    self.input_feeds = [(self.encoder_inputs, self.decoder_inputs,
+                         self.target_weights)] * len(buckets)
+
+  def _build_queued_model(self, buckets, seq2seq_f, softmax_loss_function,
+                          eval_loss_function, capacity):
+    """Builds every bucket on the batches dequeued from its own queue.
+
+    A queue holds time-major [length, batch_size] arrays, as returned by
+    get_batch, so a batch is enqueued with a 3-entry feed instead of one
+    entry per time step. The buckets share their variables with the
+    buckets of _build_fed_model, so checkpoints work with both models.
+    """
+    self.enqueue_ops, self._enqueue_feeds, self.input_feeds = [], [], []
+    self.outputs, self.losses, self.eval_losses = [], [], []
+    for b, (encoder_size, decoder_size) in enumerate(buckets):
+      shapes = [[encoder_size, self.batch_size],
+                [decoder_size, self.batch_size],
+                [decoder_size, self.batch_size]]
+      dtypes = [tf.int32, tf.int32, tf.float32]
+      queue = tf.FIFOQueue(capacity, dtypes, shapes=shapes,
+                           name="input_queue{0}".format(b))
+      feeds = [tf.placeholder(dtype, shape=shape)
+               for dtype, shape in zip(dtypes, shapes)]
+      self._enqueue_feeds.append(feeds)
+      self.enqueue_ops.append(queue.enqueue(feeds))
+      encoder_inputs, decoder_inputs, target_weights = [
+          tf.unpack(tensor) for tensor in queue.dequeue()]
+      self.input_feeds.append((encoder_inputs, decoder_inputs,
+                               target_weights))
+      # Our targets are decoder inputs shifted by one.
+      targets = decoder_inputs[1:] + [tf.zeros_like(decoder_inputs[0])]
+      with tf.variable_scope(tf.get_variable_scope(),
+                             reuse=True if b > 0 else None):
+        outputs, losses = tf.nn.seq2seq.model_with_buckets(
+            encoder_inputs, decoder_inputs, targets, target_weights,
+            [(encoder_size, decoder_size)],
+            lambda x, y: seq2seq_f(x, y, False),
+            softmax_loss_function=softmax_loss_function)
+      self.outputs.append(outputs[0])
+      self.losses.append(losses[0])
+      self.eval_losses.append(_eval_loss(outputs[0], targets, target_weights,
+                                         eval_loss_function, losses[0]))
 
   def step(self, session, encoder_inputs, decoder_inputs, target_weights,
-           bucket_id, forward_only):
+           bucket_id, forward_only, candidates=None):
     """Run a step of the model feeding the given inputs.
 
     Args:
@@ -182,11 +312,67 @@ class Seq2SeqModel(object):
       target_weights: list of numpy float vectors to feed as target weights.
       bucket_id: which bucket of the model to use.
       forward_only: whether to do the backward step or only forward.
+      candidates: int32 vector of the target ids the logits are computed
+        for, with a shortlist model.
 
     Returns:
       A triple consisting of gradient norm (or None if we did not do backward),
       average perplexity, and the outputs.
 
+    Raises:
+      ValueError: if length of encoder_inputs, decoder_inputs, or
+        target_weights disagrees with bucket size for the specified bucket_id.
+    """
+    input_feed = self._input_feed(encoder_inputs, decoder_inputs,
+                                  target_weights, bucket_id)
+    if candidates is not None:
+      input_feed[self.candidates.name] = candidates
+    decoder_size = self.buckets[bucket_id][1]
+
+    # Output feed: depends on whether we do a backward step or not.
+    if not forward_only:
+      output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
+                     self.gradient_norms[bucket_id],  # Gradient norm.
+                     self.losses[bucket_id]]  # Loss for this batch.
+    else:
+      output_feed = [self.losses[bucket_id]]  # Loss for this batch.
+      for l in xrange(decoder_size):  # Output logits.
+        output_feed.append(self.outputs[bucket_id][l])
+
+    outputs = session.run(output_feed, input_feed)
+    if not forward_only:
+      return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+    else:
+      return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
+
+  def decode_step(self, session, encoder_inputs, decoder_inputs,
+                  target_weights, bucket_id, candidates=None):
+    """Returns the greedy output ids of a batch of a forward_only model.
+
+    Takes the arguments of step; only the int32 [decoder_size, batch] ids
+    (target ids, with a shortlist too) are fetched, not the logits.
+    """
+    input_feed = self._input_feed(encoder_inputs, decoder_inputs,
+                                  target_weights, bucket_id)
+    if candidates is not None:
+      input_feed[self.candidates.name] = candidates
+    return session.run(self.output_ids[bucket_id], input_feed)
+
+  def eval_step(self, session, encoder_inputs, decoder_inputs,
+                target_weights, bucket_id):
+    """Returns the exact (full softmax) loss of a batch of a training model.
+
+    Unlike step(..., forward_only=True), whose loss is the training loss,
+    e.g. an estimate from sampled words; takes the arguments of step.
+    """
+    input_feed = self._input_feed(encoder_inputs, decoder_inputs,
+                                  target_weights, bucket_id)
+    return session.run(self.eval_losses[bucket_id], input_feed)
+
+  def _input_feed(self, encoder_inputs, decoder_inputs, target_weights,
+                  bucket_id):
+    """Feed of the placeholders of a bucket.
+
     Raises:
       ValueError: if length of encoder_inputs, decoder_inputs, or
         target_weights disagrees with bucket size for the specified bucket_id.
@@ -204,89 +390,449 @@ class Seq2SeqModel(object):
                        " %d != %d." % (len(target_weights), decoder_size))
 
     # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
+    encoder_feeds, decoder_feeds, weight_feeds = self.input_feeds[bucket_id]
     input_feed = {}
     for l in xrange(encoder_size):
-      input_feed[self.encoder_inputs[l].name] = encoder_inputs[l]
+      input_feed[encoder_feeds[l].name] = encoder_inputs[l]
     for l in xrange(decoder_size):
-      input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-      input_feed[self.target_weights[l].name] = target_weights[l]
+      input_feed[decoder_feeds[l].name] = decoder_inputs[l]
+      input_feed[weight_feeds[l].name] = target_weights[l]
 
-    # Since our targets are decoder inputs shifted by one, we need one more.
-    last_target = self.decoder_inputs[decoder_size].name
-    input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
+    # Since our targets are decoder inputs shifted by one, we need one more
+    # (the queued model makes it itself).
+    if len(decoder_feeds) > decoder_size:
+      last_target = decoder_feeds[decoder_size].name
+      input_feed[last_target] = np.zeros([self.batch_size], dtype=np.int32)
 
-    # Output feed: depends on whether we do a backward step or not.
-    if not forward_only:
-      output_feed = [self.updates[bucket_id],  # Update Op that does SGD.
-                     self.gradient_norms[bucket_id],  # Gradient norm.
-                     self.losses[bucket_id]]  # Loss for this batch.
-    else:
-      output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-      for l in xrange(decoder_size):  # Output logits.
-        output_feed.append(self.outputs[bucket_id][l])
+    return input_feed
 
-    outputs = session.run(output_feed, input_feed)
-    if not forward_only:
-      return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
-    else:
-      return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
+  def enqueue(self, session, bucket_id, encoder_inputs, decoder_inputs,
+              target_weights):
+    """Adds a batch, as returned by get_batch, to the queue of its bucket.
+
+    Blocks while the queue is full; meant to be called from a feeder thread
+    while queued_step() runs the training steps.
+    """
+    feeds = self._enqueue_feeds[bucket_id]
+    session.run(self.enqueue_ops[bucket_id],
+                {feeds[0]: encoder_inputs, feeds[1]: decoder_inputs,
+                 feeds[2]: target_weights})
+
+  def queued_step(self, session, bucket_id):
+    """Runs a training step on the next batch queued for the bucket.
 
-  def get_batch(self, data, bucket_id):
+    Returns:
+      the gradient norm and the loss of the batch.
+    """
+    _, norm, loss = session.run([self.updates[bucket_id],
+                                 self.gradient_norms[bucket_id],
+                                 self.losses[bucket_id]])
+    return norm, loss
+
+  def get_batch(self, data, bucket_id, indices=None, out=None):
     """Get a random batch of data from the specified bucket, prepare for step.
 
     To feed data in step(..) it must be a list of batch-major vectors, while
     data here contains single length-major cases. So the main logic of this
-    function is to re-index data cases to be in the proper format for feeding.
+    function is to re-index data cases to be in the proper format for feeding,
+    which token_corpus.time_major_batch does with array indexing.
 
     Args:
       data: a tuple of size len(self.buckets) in which each element contains
-        lists of pairs of input and output data that we use to create a batch.
+        lists of pairs of input and output data that we use to create a batch;
+        a token_corpus.PairBucket can stand in for such a list.
       bucket_id: integer, which bucket to get the batch for.
+      indices: optional array with the batch_size indices of the pairs to
+        take from the bucket; drawn at random (with replacement) if None.
+      out: optional triple returned by an earlier call for the same bucket,
+        whose arrays are filled in place instead of allocating new ones. Only
+        pass it once the earlier batch is no longer used.
 
     Returns:
       The triple (encoder_inputs, decoder_inputs, target_weights) for
-      the constructed batch that has the proper format to call step(...) later.
+      the constructed batch that has the proper format to call step(...) later:
+      [length, batch_size] arrays whose row l is the vector of time step l.
     """
     encoder_size, decoder_size = self.buckets[bucket_id]
-    encoder_inputs, decoder_inputs = [], []
+    bucket = data[bucket_id]
+    if not isinstance(bucket, token_corpus.PairBucket):
+      bucket = token_corpus.PairBucket.from_pairs(bucket)
 
     # Get a random batch of encoder and decoder inputs from data,
     # pad them if needed, reverse encoder inputs and add GO to decoder.
-    for _ in xrange(self.batch_size):
-      encoder_input, decoder_input = random.choice(data[bucket_id])
-
-      # Encoder inputs are padded and then reversed.
-      encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(encoder_input))
-      encoder_inputs.append(list(reversed(encoder_input + encoder_pad)))
-
-      # Decoder inputs get an extra "GO" symbol, and are padded then.
-      decoder_pad_size = decoder_size - len(decoder_input) - 1
-      decoder_inputs.append([data_utils.GO_ID] + decoder_input +
-                            [data_utils.PAD_ID] * decoder_pad_size)
-
-    # Now we create batch-major vectors from the data selected above.
-    batch_encoder_inputs, batch_decoder_inputs, batch_weights = [], [], []
-
-    # Batch encoder inputs are just re-indexed encoder_inputs.
-    for length_idx in xrange(encoder_size):
-      batch_encoder_inputs.append(
-          np.array([encoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
-
-    # Batch decoder inputs are re-indexed decoder_inputs, we create weights.
-    for length_idx in xrange(decoder_size):
-      batch_decoder_inputs.append(
-          np.array([decoder_inputs[batch_idx][length_idx]
-                    for batch_idx in xrange(self.batch_size)], dtype=np.int32))
-
-      # Create target_weights to be 0 for targets that are padding.
-      batch_weight = np.ones(self.batch_size, dtype=np.float32)
-      for batch_idx in xrange(self.batch_size):
-        # We set weight to 0 if the corresponding target is a PAD symbol.
-        # The corresponding target is decoder_input shifted by 1 forward.
-        if length_idx < decoder_size - 1:
-          target = decoder_inputs[batch_idx][length_idx + 1]
-        if length_idx == decoder_size - 1 or target == data_utils.PAD_ID:
-          batch_weight[batch_idx] = 0.0
-      batch_weights.append(batch_weight)
-    return batch_encoder_inputs, batch_decoder_inputs, batch_weights
+    if indices is None:
+      indices = np.random.randint(len(bucket), size=self.batch_size)
+    return token_corpus.time_major_batch(
+        bucket, indices, encoder_size, decoder_size, data_utils.GO_ID,
+        data_utils.PAD_ID, out)
+
+
+def _optimizer(model, sync_replicas):
+  """SGD on the model's learning rate, synchronized over sync_replicas."""
+  opt = tf.train.GradientDescentOptimizer(model.learning_rate)
+  if sync_replicas > 0:
+    model.sync = distributed.SyncReplicas(opt, sync_replicas,
+                                          model.global_step)
+    return model.sync
+  return opt
+
+
+def _projected_seq2seq(encoder_inputs, decoder_inputs, cell,
+                       num_encoder_symbols, num_decoder_symbols,
+                       embedding_size, project=None, candidates=None):
+  """embedding_attention_seq2seq with an output layer of its own.
+
+  Builds the graph of tf.nn.seq2seq.embedding_attention_seq2seq, with the
+  same variables, returning the decoder outputs unprojected (the output
+  layer is the caller's). With project, decoding feeds the previous output
+  back: project maps it to scores whose argmax is the next symbol, an index
+  into candidates if given (a shortlist), else a target id.
+  """
+  with tf.variable_scope("embedding_attention_seq2seq"):
+    encoder_cell = tf.nn.rnn_cell.EmbeddingWrapper(
+        cell, embedding_classes=num_encoder_symbols,
+        embedding_size=embedding_size)
+    encoder_outputs, encoder_state = tf.nn.rnn(encoder_cell, encoder_inputs,
+                                               dtype=tf.float32)
+    top_states = [tf.reshape(e, [-1, 1, cell.output_size])
+                  for e in encoder_outputs]
+    attention_states = tf.concat(1, top_states)
+
+    with tf.variable_scope("embedding_attention_decoder"):
+      embedding = tf.get_variable("embedding",
+                                  [num_decoder_symbols, embedding_size])
+      loop_function = None
+      if project is not None:
+        def loop_function(prev, _):
+          prev_symbol = tf.argmax(project(prev), 1)
+          if candidates is not None:
+            prev_symbol = tf.gather(candidates, prev_symbol)
+          return tf.nn.embedding_lookup(embedding, prev_symbol)
+      emb_inp = [tf.nn.embedding_lookup(embedding, i) for i in decoder_inputs]
+      return tf.nn.seq2seq.attention_decoder(
+          emb_inp, encoder_state, attention_states, cell,
+          loop_function=loop_function)
+
+
+def _eval_loss(outputs, targets, weights, eval_loss_function, loss):
+  """Exact loss of a bucket; loss itself when it is exact already."""
+  if eval_loss_function is None:
+    return loss
+  return tf.nn.seq2seq.sequence_loss(
+      outputs, targets[:len(outputs)], weights[:len(outputs)],
+      softmax_loss_function=eval_loss_function)
+
+
+class _AdaptiveSoftmax(object):
+  """Softmax over frequency clusters of the target vocabulary.
+
+  The head holds the most frequent target ids plus one entry per tail
+  cluster; a tail id's probability is its cluster's head probability times
+  its probability within the cluster. The tails project the outputs to
+  fewer dimensions (a quarter per cluster), and the loss only computes the
+  tail of every target, so training mostly pays for the head (Grave et al.,
+  Efficient softmax approximation for GPUs).
+  """
+
+  def __init__(self, input_size, vocab_size, cutoffs):
+    cutoffs = [c for c in cutoffs if c < vocab_size]
+    if cutoffs != sorted(set(cutoffs)) or (cutoffs and cutoffs[0] <= 0):
+      raise ValueError("Adaptive softmax cutoffs must be increasing.")
+    self.bounds = [0] + cutoffs + [vocab_size]
+    with tf.variable_scope("adaptive_softmax"):
+      head_size = self.bounds[1] + len(self.bounds) - 2
+      self.head_w = tf.get_variable("head_w", [input_size, head_size])
+      self.head_b = tf.get_variable("head_b", [head_size])
+      self.tails = []
+      for i in range(1, len(self.bounds) - 1):
+        tail_size = self.bounds[i + 1] - self.bounds[i]
+        proj_size = max(input_size // 4**i, 1)
+        self.tails.append((
+            tf.get_variable("tail%d_proj" % i, [input_size, proj_size]),
+            tf.get_variable("tail%d_w" % i, [proj_size, tail_size]),
+            tf.get_variable("tail%d_b" % i, [tail_size])))
+
+  def _tail_logits(self, i, inputs):
+    proj, w, b = self.tails[i]
+    return tf.matmul(tf.matmul(inputs, proj), w) + b
+
+  def loss(self, inputs, labels):
+    """Cross-entropy of labels [batch] given inputs [batch, input_size]."""
+    labels = tf.to_int32(tf.reshape(labels, [-1]))
+    head_labels = labels
+    for i in range(1, len(self.bounds) - 1):
+      # Tail ids are replaced by their cluster's head entry.
+      in_tail = tf.to_int32(labels >= self.bounds[i])
+      head_labels = head_labels * (1 - in_tail) + (
+          self.bounds[1] + i - 1) * in_tail
+    losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=tf.matmul(inputs, self.head_w) + self.head_b,
+        labels=head_labels)
+    batch_size = tf.shape(labels)[0]
+    for i in range(len(self.tails)):
+      low, high = self.bounds[i + 1], self.bounds[i + 2]
+      rows = tf.reshape(tf.where(tf.logical_and(labels >= low,
+                                                labels < high)), [-1])
+      tail_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+          logits=self._tail_logits(i, tf.gather(inputs, rows)),
+          labels=tf.gather(labels, rows) - low)
+      losses += tf.unsorted_segment_sum(tail_losses, tf.to_int32(rows),
+                                        batch_size)
+    return losses
+
+  def log_probs(self, inputs):
+    """Log-probabilities [batch, vocab_size] of all target ids."""
+    head = tf.nn.log_softmax(tf.matmul(inputs, self.head_w) + self.head_b)
+    parts = [tf.slice(head, [0, 0], [-1, self.bounds[1]])]
+    for i in range(len(self.tails)):
+      cluster = tf.slice(head, [0, self.bounds[1] + i], [-1, 1])
+      parts.append(cluster + tf.nn.log_softmax(self._tail_logits(i, inputs)))
+    return tf.concat(1, parts)
+
+
+def _dense(inputs, output_size, scope):
+  """Affine map of the concatenated inputs."""
+  with tf.variable_scope(scope):
+    inputs = tf.concat(1, inputs)
+    w = tf.get_variable("w", [inputs.get_shape()[1].value, output_size])
+    b = tf.get_variable("b", [output_size],
+                        initializer=tf.constant_initializer(0.0))
+    return tf.matmul(inputs, w) + b
+
+
+class _AttentionCell(RNNCell):
+  """Wraps a decoder cell with attention over the encoder outputs.
+
+  Like the attention decoder of embedding_attention_seq2seq, the previous
+  attention context is fed along with the input and the output combines the
+  cell output with the new context; padded encoder steps get no attention.
+  """
+
+  def __init__(self, cell, memory, memory_lengths, output_size):
+    """Create the cell.
+
+    Args:
+      cell: the decoder RNNCell.
+      memory: batch-major [batch, time, size] encoder outputs.
+      memory_lengths: int32 [batch] number of real steps of every memory.
+      output_size: size of the outputs.
+    """
+    self._cell = cell
+    self._memory = memory
+    self._memory_size = memory.get_shape()[2].value
+    self._output_size = output_size
+    with tf.variable_scope("attention_keys"):
+      w = tf.get_variable("w", [self._memory_size, self._memory_size])
+      keys = tf.matmul(tf.reshape(memory, [-1, self._memory_size]), w)
+    self._keys = tf.reshape(keys, tf.shape(memory))
+    steps = tf.expand_dims(tf.range(tf.shape(memory)[1]), 0)
+    # 0 for real steps, a large negative score for padding.
+    self._score_mask = -1e9 * tf.to_float(
+        tf.greater_equal(steps, tf.expand_dims(memory_lengths, 1)))
+
+  @property
+  def state_size(self):
+    return (self._cell.state_size, self._memory_size)
+
+  @property
+  def output_size(self):
+    return self._output_size
+
+  def __call__(self, inputs, state, scope=None):
+    cell_state, context = state
+    with tf.variable_scope(scope or type(self).__name__):
+      cell_input = _dense([inputs, context], inputs.get_shape()[1].value,
+                          "input")
+      cell_output, cell_state = self._cell(cell_input, cell_state)
+      query = _dense([cell_output], self._memory_size, "query")
+      scores = tf.reduce_sum(self._keys * tf.expand_dims(query, 1), 2)
+      alignments = tf.nn.softmax(scores + self._score_mask)
+      context = tf.reduce_sum(tf.expand_dims(alignments, 2) * self._memory, 1)
+      output = _dense([cell_output, context], self._output_size, "output")
+    return output, (cell_state, context)
+
+
+class DynamicSeq2SeqModel(Seq2SeqModel):
+  """Sequence-to-sequence model with attention built on dynamic RNNs.
+
+  Seq2SeqModel unrolls a subgraph, with its own gradients, for every
+  bucket. This model has a single graph: encoder and decoder are while
+  loops (tf.nn.dynamic_rnn) running for as many steps as the fed batch has,
+  and the padded encoder steps are masked by sequence length. Buckets only
+  decide how batches are padded (get_batch), so any number of them costs
+  nothing at graph construction. The variables differ from Seq2SeqModel's,
+  so their checkpoints are not interchangeable.
+  """
+
+  def __init__(self, source_vocab_size, target_vocab_size, buckets, size,
+               num_layers, max_gradient_norm, batch_size, learning_rate,
+               learning_rate_decay_factor, use_lstm=True,
+               num_samples=512, forward_only=False, sync_replicas=0,
+               loss="sampled_softmax"):
+    """Create the model; the arguments are those of Seq2SeqModel.
+
+    Raises:
+      ValueError: if loss is not "sampled_softmax" or "nce".
+    """
+    if loss not in ("sampled_softmax", "nce"):
+      raise ValueError("The dynamic model has no %s loss." % loss)
+    self.source_vocab_size = source_vocab_size
+    self.target_vocab_size = target_vocab_size
+    self.buckets = buckets
+    self.batch_size = batch_size
+    self.learning_rate = tf.Variable(float(learning_rate), trainable=False)
+    self.learning_rate_decay_op = self.learning_rate.assign(
+        self.learning_rate * learning_rate_decay_factor)
+    self.global_step = tf.Variable(0, trainable=False)
+
+    # Time-major [time, batch] inputs, as returned by get_batch.
+    self.encoder_inputs = tf.placeholder(tf.int32, shape=[None, None],
+                                         name="encoder")
+    self.decoder_inputs = tf.placeholder(tf.int32, shape=[None, None],
+                                         name="decoder")
+    self.target_weights = tf.placeholder(tf.float32, shape=[None, None],
+                                         name="weight")
+
+    single_cell = GRUCell(size)
+    if use_lstm:
+      single_cell = BasicLSTMCell(size, state_is_tuple=True)
+    single_cell = DropoutWrapper(single_cell, output_keep_prob=0.8)
+    cell = single_cell
+    if num_layers > 1:
+      cell = MultiRNNCell([single_cell] * num_layers, state_is_tuple=True)
+
+    # get_batch reverses the padded source, which puts the padding first;
+    # undo that, then reverse only the real tokens so they start at step 0.
+    source = tf.reverse(self.encoder_inputs, [True, False])
+    source_lengths = tf.reduce_sum(
+        tf.to_int32(tf.not_equal(source, data_utils.PAD_ID)), 0)
+    source = tf.reverse_sequence(source, tf.to_int64(source_lengths),
+                                 seq_dim=0, batch_dim=1)
+
+    with tf.variable_scope("encoder"):
+      embedding = tf.get_variable("embedding", [source_vocab_size, size])
+      encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
+          cell, tf.nn.embedding_lookup(embedding, source),
+          sequence_length=source_lengths, dtype=tf.float32, time_major=True)
+
+    with tf.variable_scope("decoder") as decoder_scope:
+      embedding = tf.get_variable("embedding", [target_vocab_size, size])
+      decoder_cell = _AttentionCell(
+          cell, tf.transpose(encoder_outputs, [1, 0, 2]), source_lengths,
+          size)
+      initial_state = (encoder_state,
+                       tf.zeros(tf.pack([tf.shape(source)[1], size])))
+      w = tf.get_variable("proj_w", [size, target_vocab_size])
+      b = tf.get_variable("proj_b", [target_vocab_size])
+      if forward_only:
+        outputs = self._greedy_decode(decoder_cell, initial_state, embedding,
+                                      (w, b), decoder_scope)
+      else:
+        outputs, _ = tf.nn.dynamic_rnn(
+            decoder_cell,
+            tf.nn.embedding_lookup(embedding, self.decoder_inputs),
+            initial_state=initial_state, time_major=True,
+            scope=decoder_scope)
+
+    # Our targets are decoder inputs shifted by one.
+    targets = tf.concat(0, [self.decoder_inputs[1:],
+                            tf.zeros_like(self.decoder_inputs[:1])])
+    flat_outputs = tf.reshape(outputs, [-1, size])
+    flat_targets = tf.reshape(targets, [-1])
+    logits = tf.matmul(flat_outputs, w) + b
+    self.eval_loss = self._sequence_loss(
+        tf.nn.sparse_softmax_cross_entropy_with_logits(
+            logits=logits, labels=flat_targets), targets)
+    if not forward_only and 0 < num_samples < target_vocab_size:
+      sampled_loss_function = (tf.nn.nce_loss if loss == "nce" else
+                               tf.nn.sampled_softmax_loss)
+      self.loss = self._sequence_loss(sampled_loss_function(
+          tf.transpose(w), b, flat_outputs, tf.reshape(flat_targets, [-1, 1]),
+          num_samples, target_vocab_size), targets)
+      self.outputs = None
+    else:
+      self.loss = self.eval_loss
+      self.outputs = tf.reshape(
+          logits, tf.pack([tf.shape(outputs)[0], -1, target_vocab_size]))
+      if forward_only:
+        self.output_ids = tf.to_int32(tf.argmax(self.outputs, 2))
+
+    params = tf.trainable_variables()
+    if not forward_only:
+      opt = _optimizer(self, sync_replicas)
+      gradients = tf.gradients(self.loss, params)
+      clipped_gradients, self.gradient_norm = tf.clip_by_global_norm(
+          gradients, max_gradient_norm)
+      self.update = opt.apply_gradients(zip(clipped_gradients, params),
+                                        global_step=self.global_step)
+
+    self.saver = tf.train.Saver(tf.all_variables())
+
+  def _sequence_loss(self, crossent, targets):
+    """Loss of sequence_loss: weighted mean cross-entropy per sequence."""
+    crossent = tf.reshape(crossent, tf.shape(targets))
+    sequence_losses = (tf.reduce_sum(crossent * self.target_weights, 0) /
+                       (tf.reduce_sum(self.target_weights, 0) + 1e-12))
+    return tf.reduce_mean(sequence_losses)
+
+  def _greedy_decode(self, cell, initial_state, embedding, projection,
+                     scope):
+    """Decodes feeding back the argmax of every output, like feed_previous.
+
+    Runs for as many steps as the fed decoder inputs have; only their first
+    row (GO) is used.
+    """
+    num_steps = tf.shape(self.decoder_inputs)[0]
+    # The first step is outside the loop: it creates the variables (with the
+    # names dynamic_rnn gives them), which cannot be done inside a loop.
+    output, state = cell(
+        tf.nn.embedding_lookup(embedding, self.decoder_inputs[0]),
+        initial_state)
+    scope.reuse_variables()
+    outputs = tf.TensorArray(tf.float32, size=num_steps).write(0, output)
+
+    def body(time, output, state, outputs):
+      logits = tf.matmul(output, projection[0]) + projection[1]
+      inputs = tf.nn.embedding_lookup(embedding, tf.argmax(logits, 1))
+      output, state = cell(inputs, state)
+      return time + 1, output, state, outputs.write(time, output)
+
+    _, _, _, outputs = tf.while_loop(
+        lambda time, *_: time < num_steps, body,
+        [tf.constant(1), output, state, outputs])
+    return outputs.pack()
+
+  def step(self, session, encoder_inputs, decoder_inputs, target_weights,
+           bucket_id, forward_only):
+    """Run a step of the model feeding the given inputs.
+
+    Takes and returns the same as Seq2SeqModel.step; the arrays may have any
+    number of steps, bucket_id is only kept for compatibility.
+    """
+    input_feed = {self.encoder_inputs: encoder_inputs,
+                  self.decoder_inputs: decoder_inputs,
+                  self.target_weights: target_weights}
+    if not forward_only:
+      _, norm, loss = session.run(
+          [self.update, self.gradient_norm, self.loss], input_feed)
+      return norm, loss, None  # Gradient norm, loss, no outputs.
+    if self.outputs is None:
+      return None, session.run(self.loss, input_feed), None
+    loss, outputs = session.run([self.loss, self.outputs], input_feed)
+    return None, loss, list(outputs)  # No gradient norm, loss, outputs.
+
+  def eval_step(self, session, encoder_inputs, decoder_inputs,
+                target_weights, bucket_id):
+    """Returns the exact (full softmax) loss of a batch, as Seq2SeqModel."""
+    return session.run(self.eval_loss,
+                       {self.encoder_inputs: encoder_inputs,
+                        self.decoder_inputs: decoder_inputs,
+                        self.target_weights: target_weights})
+
+  def decode_step(self, session, encoder_inputs, decoder_inputs,
+                  target_weights, bucket_id):
+    """Returns the greedy output ids of a batch, as Seq2SeqModel."""
+    return session.run(self.output_ids,
+                       {self.encoder_inputs: encoder_inputs,
+                        self.decoder_inputs: decoder_inputs,
+                        self.target_weights: target_weights})
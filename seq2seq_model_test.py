@@ -0,0 +1,81 @@
+"""Construction-and-step tests of seq2seq_model.DynamicSeq2SeqModel."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import data_utils
+import seq2seq_model
+
+_VOCAB_SIZE = 12
+_BUCKETS = [(4, 4), (6, 5)]
+_BATCH_SIZE = 4
+
+
+def _pairs(seed):
+  """Pairs of every bucket, of random tokens that are not _START_VOCAB."""
+  rng = np.random.RandomState(seed)
+  low = len(data_utils._START_VOCAB)
+  return [[(list(rng.randint(low, _VOCAB_SIZE, encoder_size - 1)),
+            list(rng.randint(low, _VOCAB_SIZE, decoder_size - 2)))
+           for _ in range(_BATCH_SIZE)]
+          for encoder_size, decoder_size in _BUCKETS]
+
+
+def _model(forward_only):
+  # num_samples = 0: the full softmax, as the vocabulary is tiny.
+  return seq2seq_model.DynamicSeq2SeqModel(
+      _VOCAB_SIZE, _VOCAB_SIZE, _BUCKETS, 16, 2, 5.0, _BATCH_SIZE, 0.5, 0.99,
+      num_samples=0, forward_only=forward_only)
+
+
+class DynamicSeq2SeqModelTest(unittest.TestCase):
+
+  def testTrainingStepsLowerTheLoss(self):
+    data_set = _pairs(0)
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = _model(False)
+      sess.run(tf.initialize_all_variables())
+      batches = [model.get_batch(data_set, bucket_id,
+                                 np.arange(_BATCH_SIZE))
+                 for bucket_id in range(len(_BUCKETS))]
+      # One graph serves batches of every bucket size.
+      first_losses = [model.eval_step(sess, batch[0], batch[1], batch[2],
+                                      bucket_id)
+                      for bucket_id, batch in enumerate(batches)]
+      for _ in range(30):
+        for bucket_id, batch in enumerate(batches):
+          norm, loss, outputs = model.step(sess, batch[0], batch[1],
+                                           batch[2], bucket_id, False)
+          self.assertTrue(np.isfinite(norm) and np.isfinite(loss))
+          self.assertIsNone(outputs)
+      for bucket_id, batch in enumerate(batches):
+        self.assertLess(model.eval_step(sess, batch[0], batch[1], batch[2],
+                                        bucket_id),
+                        first_losses[bucket_id])
+      self.assertEqual(60, sess.run(model.global_step))
+
+  def testGreedyDecode(self):
+    data_set = _pairs(1)
+    with tf.Graph().as_default(), tf.Session() as sess:
+      model = _model(True)
+      sess.run(tf.initialize_all_variables())
+      for bucket_id, (_, decoder_size) in enumerate(_BUCKETS):
+        batch = model.get_batch(data_set, bucket_id, np.arange(_BATCH_SIZE))
+        ids = model.decode_step(sess, batch[0], batch[1], batch[2],
+                                bucket_id)
+        self.assertEqual((decoder_size, _BATCH_SIZE), ids.shape)
+        self.assertTrue(np.all((ids >= 0) & (ids < _VOCAB_SIZE)))
+        _, loss, outputs = model.step(sess, batch[0], batch[1], batch[2],
+                                      bucket_id, True)
+        self.assertTrue(np.isfinite(loss))
+        self.assertEqual(decoder_size, len(outputs))
+        self.assertEqual((_BATCH_SIZE, _VOCAB_SIZE), outputs[0].shape)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,107 @@
+"""Session threading settings and their auto-tuning.
+
+TensorFlow sizes its intra-op and inter-op thread pools to the number of
+cores by default, so several training or decoding processes on one host
+oversubscribe it. A session profile holds the settings of the sessions of
+one purpose (training or decoding):
+
+  intra_op_threads   threads running a single op (0: TF default)
+  inter_op_threads   threads running independent ops (0: TF default)
+  optimizer          graph optimization level, L1 (constant folding and
+                     common subexpression elimination) or L0 (none)
+
+The settings are written to seq2seq.ini or, by tune, to a profile in the
+working directory. tune times short runs with every setting of a grid;
+each run gets a session with its own thread pools
+(use_per_session_threads), since the global pools TF otherwise shares
+between the sessions of a process are sized once, by the first session.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import time
+
+import tensorflow as tf
+
+PROFILE_NAME = "session_profile.json"
+DEFAULT_SETTINGS = {"intra_op_threads": 0, "inter_op_threads": 0,
+                    "optimizer": "L1"}
+
+
+def session_config(settings, config=None):
+  """Applies session settings to a tf.ConfigProto (a new one if None)."""
+  if config is None:
+    config = tf.ConfigProto()
+  unknown = set(settings) - set(DEFAULT_SETTINGS)
+  if unknown:
+    raise ValueError("Unknown session settings: %s." % sorted(unknown))
+  settings = dict(DEFAULT_SETTINGS, **settings)
+  config.intra_op_parallelism_threads = settings["intra_op_threads"]
+  config.inter_op_parallelism_threads = settings["inter_op_threads"]
+  config.graph_options.optimizer_options.opt_level = getattr(
+      tf.OptimizerOptions, settings["optimizer"])
+  return config
+
+
+def thread_grid(workers_per_host=1, optimizer="L1", num_cpus=None):
+  """Settings to try: thread counts up to this worker's share of the cores."""
+  cores = max((num_cpus or multiprocessing.cpu_count()) // workers_per_host,
+              1)
+  intra = sorted(set([2**i for i in range(cores.bit_length())] + [cores]))
+  inter = [n for n in (1, 2, 4) if n <= cores]
+  return [{"intra_op_threads": i, "inter_op_threads": j,
+           "optimizer": optimizer} for i in intra for j in inter]
+
+
+def tune(trial_fn, grid, steps):
+  """Returns the settings of the grid running trial steps fastest.
+
+  Args:
+    trial_fn: function taking a tf.ConfigProto and building what the steps
+      need (model, session) with it, in the default graph; it returns a
+      function running one step and a function closing the session.
+    grid: list of settings, as returned by thread_grid.
+    steps: number of timed steps per setting, after one untimed step.
+
+  Returns:
+    the best settings and a list of (settings, steps per second) for all of
+    them.
+  """
+  timings = []
+  for settings in grid:
+    config = session_config(settings)
+    config.use_per_session_threads = True
+    with tf.Graph().as_default():
+      step, close = trial_fn(config)
+      try:
+        step()  # Warm-up: allocations, first run of the graph.
+        start_time = time.time()
+        for _ in range(steps):
+          step()
+        rate = steps / (time.time() - start_time)
+      finally:
+        close()
+    print("  intra %2d, inter %d: %8.2f steps/s"
+          % (settings["intra_op_threads"], settings["inter_op_threads"], rate))
+    timings.append((settings, rate))
+  return max(timings, key=lambda timing: timing[1])[0], timings
+
+
+def save_profile(path, profiles):
+  """Stores the settings of every purpose ({"train": ..., "decode": ...})."""
+  tmp_path = "%s.tmp%d" % (path, os.getpid())
+  with open(tmp_path, "w") as f:
+    json.dump(profiles, f, indent=1, sort_keys=True)
+  os.replace(tmp_path, path)
+
+
+def load_profile(path):
+  """Returns the settings stored by save_profile, {} if there are none."""
+  if not os.path.exists(path):
+    return {}
+  with open(path) as f:
+    return json.load(f)
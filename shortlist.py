@@ -0,0 +1,38 @@
+"""Target vocabulary shortlists for decoding.
+
+A headline mostly reuses words of its article plus frequent words, so the
+decoder only needs the logits of those: a Shortlist maps a source to the
+sorted target ids of its own words and of the most frequent target words
+(vocabularies are sorted by frequency, after the special symbols, which
+are always included). Seq2SeqModel(shortlist=True) projects its outputs
+onto such candidates instead of the whole target vocabulary.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+class Shortlist(object):
+  """Candidate target ids of a source: its words plus the frequent ones."""
+
+  def __init__(self, enc_vocab, dec_vocab, num_frequent):
+    """Create the shortlist.
+
+    Args:
+      enc_vocab: vocabulary.Vocabulary of the sources.
+      dec_vocab: vocabulary.Vocabulary of the targets.
+      num_frequent: number of most frequent target ids always included.
+    """
+    self.frequent = np.arange(min(num_frequent, len(dec_vocab)),
+                              dtype=np.int32)
+    # Target id of every source word, UNK_ID for the missing ones.
+    self.source_to_target = dec_vocab.lookup(
+        enc_vocab.decode(np.arange(len(enc_vocab))))
+
+  def __call__(self, token_ids):
+    """Returns the sorted int32 candidates of source token-ids (any shape)."""
+    source_ids = np.asarray(token_ids, dtype=np.int64).ravel()
+    return np.union1d(self.frequent,
+                      self.source_to_target[source_ids]).astype(np.int32)
@@ -2,8 +2,12 @@ import numpy as np
 import random
 import codecs
 
+import corpus_io
+
 def split_dataset(path):
-    dataset = open(path).read().split('\n')
+    # the dataset may be gzip/bz2/xz/zstd compressed
+    with corpus_io.open_input(path, text=True) as f:
+        dataset = f.read().split('\n')
 
     dataset_len = len(dataset)
     print("There are %s headline-article pairs" % dataset_len)
@@ -0,0 +1,463 @@
+"""Memory-mapped binary corpus of token-ids.
+
+A token-id file is stored as three files sharing the same path prefix:
+
+  <path>.tokens   flat array with the token-ids of all lines, one after the
+                  other (uint16 for vocabularies up to 65536 words, int32
+                  otherwise)
+  <path>.offsets  int64 array of len(lines) + 1 offsets; line i is
+                  tokens[offsets[i]:offsets[i + 1]]
+  <path>.json     dtype, line and token counts; written last, so a corpus
+                  without it is incomplete
+
+Both arrays are opened with np.memmap, so loading is near-instant and every
+process reading the same corpus shares its pages through the page cache.
+
+Text token-id files (one line of space-separated ids per sentence) are
+parsed into the same flat tokens + offsets layout by read_text_pairs, in
+chunks and without creating a Python object per id.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import itertools
+import json
+import os
+
+import numpy as np
+
+import corpus_io
+
+_OFFSET_DTYPE = np.dtype("<i8")
+# Number of lines of a text token-id file parsed at a time.
+_TEXT_CHUNK_LINES = 20000
+# The bytes str.split() splits on.
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+
+
+def token_dtype(vocabulary_size):
+  """Returns the smallest dtype able to hold ids of the given vocabulary."""
+  if vocabulary_size <= np.iinfo(np.uint16).max + 1:
+    return np.dtype("<u2")
+  return np.dtype("<i4")
+
+
+def exists(path):
+  """True if a complete binary corpus is stored at `path`."""
+  return os.path.exists(path + ".json")
+
+
+def to_arrays(batch, vocabulary_size):
+  """Flattens a list of token-id lists to (lengths, tokens) arrays."""
+  lengths = np.fromiter((len(ids) for ids in batch), dtype=_OFFSET_DTYPE,
+                        count=len(batch))
+  tokens = np.fromiter(itertools.chain.from_iterable(batch),
+                       dtype=token_dtype(vocabulary_size),
+                       count=int(lengths.sum()))
+  return lengths, tokens
+
+
+class TokenCorpusWriter(object):
+  """Streams lines of token-ids into a binary corpus."""
+
+  def __init__(self, path, vocabulary_size):
+    self.path = path
+    self.dtype = token_dtype(vocabulary_size)
+    self.vocabulary_size = vocabulary_size
+    self.num_lines = 0
+    self.num_tokens = 0
+    if exists(path):
+      os.remove(path + ".json")
+    self._tokens_file = open(path + ".tokens", "wb")
+    self._offsets_file = open(path + ".offsets", "wb")
+    self._offsets_file.write(np.zeros(1, dtype=_OFFSET_DTYPE).tobytes())
+
+  def write_batch(self, batch):
+    """Appends a list of lines, each one a list of token-ids."""
+    self.write_arrays(*to_arrays(batch, self.vocabulary_size))
+
+  def write_arrays(self, lengths, tokens):
+    """Appends lines given as an array of lengths and their flat tokens."""
+    offsets = self.num_tokens + np.cumsum(lengths, dtype=_OFFSET_DTYPE)
+    self._tokens_file.write(tokens.astype(self.dtype, copy=False).tobytes())
+    self._offsets_file.write(offsets.tobytes())
+    self.num_lines += len(lengths)
+    self.num_tokens += len(tokens)
+
+  def write(self, token_ids):
+    """Appends a single line of token-ids."""
+    self.write_batch([token_ids])
+
+  def close(self):
+    self._tokens_file.close()
+    self._offsets_file.close()
+    meta = {"dtype": self.dtype.str, "lines": self.num_lines,
+            "tokens": self.num_tokens,
+            "vocabulary_size": self.vocabulary_size}
+    tmp_path = self.path + ".json.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(meta, f)
+    os.replace(tmp_path, self.path + ".json")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self._tokens_file.close()
+      self._offsets_file.close()
+
+
+def _memmap(path, dtype, count):
+  if count == 0:
+    # np.memmap refuses to map empty files.
+    return np.zeros(0, dtype=dtype)
+  return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class _Corpus(object):
+  """Lines of token-ids stored as flat `tokens` and `offsets` arrays."""
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    """Returns the token-ids of line i as an array."""
+    return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+  def lengths(self, max_lines=None):
+    """Returns an int64 array with the number of tokens of every line."""
+    offsets = self.offsets
+    if max_lines is not None:
+      offsets = offsets[:max_lines + 1]
+    return np.diff(offsets)
+
+  def select(self, lines):
+    """Returns an ArrayCorpus holding only the given lines, in that order."""
+    lines = np.asarray(lines, dtype=np.int64)
+    starts = self.offsets[lines]
+    lengths = self.offsets[lines + 1] - starts
+    offsets = np.zeros(len(lines) + 1, dtype=_OFFSET_DTYPE)
+    np.cumsum(lengths, out=offsets[1:])
+    index = np.repeat(starts - offsets[:-1], lengths)
+    index += np.arange(offsets[-1], dtype=np.int64)
+    return ArrayCorpus(np.asarray(self.tokens[index]), offsets)
+
+
+class ArrayCorpus(_Corpus):
+  """Lines of token-ids held in memory, as returned by read_text."""
+
+  def __init__(self, tokens, offsets):
+    self.tokens = tokens
+    self.offsets = offsets
+
+
+def _parse_text_chunk(chunk):
+  """Parses newline-terminated lines of space-separated ids.
+
+  Returns:
+    the int64 number of ids of every line and the int32 ids of all lines.
+  """
+  data = np.frombuffer(chunk, dtype=np.uint8)
+  space = _WHITESPACE[data]
+  starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+  newlines = np.flatnonzero(data == ord("\n"))
+  # A token belongs to the line of the first newline after its start.
+  lengths = np.bincount(np.searchsorted(newlines, starts),
+                        minlength=len(newlines)).astype(_OFFSET_DTYPE)
+  if not len(starts):
+    # np.fromstring would parse a blank chunk as a single 0.
+    return lengths, np.zeros(0, dtype=np.int32)
+  tokens = np.fromstring(chunk.decode("ascii"), dtype=np.int32, sep=" ")
+  if len(tokens) != len(starts):
+    raise ValueError("Malformed token-ids line in chunk starting %r."
+                     % chunk[:40])
+  return lengths, tokens
+
+
+class TokenCorpus(_Corpus):
+  """Read-only, memory-mapped view of a binary corpus."""
+
+  def __init__(self, path):
+    if not exists(path):
+      raise ValueError("Binary corpus %s not found." % path)
+    with open(path + ".json") as f:
+      meta = json.load(f)
+    self.path = path
+    self.dtype = np.dtype(str(meta["dtype"]))
+    self.vocabulary_size = meta["vocabulary_size"]
+    self.tokens = _memmap(path + ".tokens", self.dtype, meta["tokens"])
+    self.offsets = _memmap(path + ".offsets", _OFFSET_DTYPE,
+                           meta["lines"] + 1)
+
+
+class PairBucket(object):
+  """The (source, target) pairs of one bucket, read lazily from two corpora.
+
+  Behaves like a list of [source_ids, target_ids] pairs, but only keeps the
+  line numbers of its pairs in memory; Seq2SeqModel.get_batch gathers its
+  batches straight from the corpora with time_major_batch.
+  """
+
+  def __init__(self, source, target, lines, target_suffix=()):
+    """Create the bucket.
+
+    Args:
+      source: TokenCorpus or ArrayCorpus with the source lines.
+      target: corpus with the target lines, aligned with source.
+      lines: array with the line numbers of the pairs in this bucket.
+      target_suffix: ids appended to every target, e.g. [EOS_ID].
+    """
+    self.source = source
+    self.target = target
+    self.lines = np.asarray(lines, dtype=np.int64)
+    self.target_suffix = list(target_suffix)
+
+  def __len__(self):
+    return len(self.lines)
+
+  def __getitem__(self, i):
+    line = self.lines[i]
+    return [self.source[line].tolist(),
+            self.target[line].tolist() + self.target_suffix]
+
+  @classmethod
+  def from_pairs(cls, pairs):
+    """Returns a PairBucket holding a list of (source_ids, target_ids)."""
+    source = _array_corpus([source for source, _ in pairs])
+    target = _array_corpus([target for _, target in pairs])
+    return cls(source, target, np.arange(len(pairs)))
+
+
+def _array_corpus(lines):
+  """ArrayCorpus with int32 tokens holding a list of token-id lists."""
+  lengths = np.fromiter((len(ids) for ids in lines), dtype=_OFFSET_DTYPE,
+                        count=len(lines))
+  offsets = np.zeros(len(lines) + 1, dtype=_OFFSET_DTYPE)
+  np.cumsum(lengths, out=offsets[1:])
+  tokens = np.fromiter(itertools.chain.from_iterable(lines), dtype=np.int32,
+                       count=int(offsets[-1]))
+  return ArrayCorpus(tokens, offsets)
+
+
+def time_major_batch(bucket, indices, encoder_size, decoder_size, go_id,
+                     pad_id, out=None):
+  """Gathers pairs of a bucket into padded, time-major batch arrays.
+
+  Row t of the arrays holds time step t of every pair of the batch:
+  encoder inputs are the padded source, reversed; decoder inputs are GO,
+  the target and its suffix, then padding; the weight of a decoder input is
+  0 where the next input (its target) is padding, and in the last row.
+  A source longer than encoder_size keeps its last encoder_size tokens and
+  a target only its first decoder_size - 1, as the list-based get_batch did.
+
+  Args:
+    bucket: PairBucket to draw from.
+    indices: array with the index in the bucket of every pair of the batch.
+    encoder_size: number of encoder time steps.
+    decoder_size: number of decoder time steps.
+    go_id: id the decoder inputs start with.
+    pad_id: id of the padding.
+    out: optional (encoder, decoder, weights) arrays to fill in place, as
+      returned by an earlier call with the same sizes.
+
+  Returns:
+    int32 [encoder_size, batch] encoder inputs, int32 [decoder_size, batch]
+    decoder inputs and float32 [decoder_size, batch] target weights.
+  """
+  lines = bucket.lines[np.asarray(indices, dtype=np.int64)]
+  batch_size = len(lines)
+  if out is None:
+    out = (np.empty((encoder_size, batch_size), dtype=np.int32),
+           np.empty((decoder_size, batch_size), dtype=np.int32),
+           np.empty((decoder_size, batch_size), dtype=np.float32))
+  encoder, decoder, weights = out
+
+  # Encoder row t is element max(length, encoder_size) - 1 - t of the padded
+  # source, a token where that is below the source length.
+  starts = bucket.source.offsets[lines]
+  lengths = bucket.source.offsets[lines + 1] - starts
+  positions = (np.maximum(lengths, encoder_size) - 1 -
+               np.arange(encoder_size)[:, None])
+  is_token = positions < lengths
+  encoder.fill(pad_id)
+  encoder[is_token] = bucket.source.tokens[(starts + positions)[is_token]]
+
+  # Decoder row t > 0 is element t - 1 of the target followed by its suffix.
+  starts = bucket.target.offsets[lines]
+  lengths = bucket.target.offsets[lines + 1] - starts
+  positions = np.arange(-1, decoder_size - 1)[:, None] + np.zeros(
+      batch_size, dtype=np.int64)
+  decoder.fill(pad_id)
+  decoder[0] = go_id
+  is_token = (positions >= 0) & (positions < lengths)
+  decoder[is_token] = bucket.target.tokens[(starts + positions)[is_token]]
+  for i, suffix_id in enumerate(bucket.target_suffix):
+    decoder[positions == lengths + i] = suffix_id
+
+  weights[:-1] = decoder[1:] != pad_id
+  weights[-1] = 0.0
+  return encoder, decoder, weights
+
+
+def assign_buckets(source_lengths, target_lengths, buckets):
+  """Returns the bucket id of every pair, -1 for pairs that fit no bucket.
+
+  A pair goes to the first bucket (I, O) with source_length < I and
+  target_length < O. Which bucket that is only depends on how many of the
+  distinct I and O sizes the two lengths reach, so it is looked up, for all
+  pairs at once, in a small table indexed by np.searchsorted positions.
+  """
+  input_sizes = np.unique([size for size, _ in buckets])
+  output_sizes = np.unique([size for _, size in buckets])
+  # table[a, b]: first bucket whose input size is at least input_sizes[a]
+  # and whose output size is at least output_sizes[b].
+  table = np.full((len(input_sizes) + 1, len(output_sizes) + 1), -1,
+                  dtype=np.int32)
+  for a in range(len(input_sizes)):
+    for b in range(len(output_sizes)):
+      for bucket_id, (source_size, target_size) in enumerate(buckets):
+        if source_size >= input_sizes[a] and target_size >= output_sizes[b]:
+          table[a, b] = bucket_id
+          break
+  # Index of the smallest size larger than the length.
+  a = np.searchsorted(input_sizes, source_lengths, side="right")
+  b = np.searchsorted(output_sizes, target_lengths, side="right")
+  return table[a, b]
+
+
+def bucket_pairs(source, target, buckets, max_size=None, target_suffix=()):
+  """Splits two aligned corpora into buckets without reading their tokens.
+
+  A pair goes to the first bucket (I, O) with len(source) < I and
+  len(target) + len(target_suffix) < O; pairs that fit no bucket are
+  dropped.
+
+  Args:
+    source: TokenCorpus or ArrayCorpus with the source lines.
+    target: corpus with the target lines, aligned with source.
+    buckets: list of (I, O) bucket sizes.
+    max_size: maximum number of pairs to use; if 0 or None, all of them.
+    target_suffix: ids appended to every target, e.g. [EOS_ID].
+
+  Returns:
+    a list with one PairBucket per bucket.
+  """
+  num_lines = min(len(source), len(target))
+  if max_size:
+    num_lines = min(num_lines, max_size)
+  bucket_ids = assign_buckets(
+      source.lengths(num_lines),
+      target.lengths(num_lines) + len(target_suffix), buckets)
+  return _group_by_bucket(source, target, bucket_ids, len(buckets),
+                          target_suffix)
+
+
+def _group_by_bucket(source, target, bucket_ids, num_buckets, target_suffix):
+  """Returns one PairBucket per bucket id, skipping the lines with id -1."""
+  # A stable sort groups the lines by bucket, each group in line order.
+  order = np.argsort(bucket_ids, kind="stable")
+  bounds = np.cumsum(np.bincount(bucket_ids + 1, minlength=num_buckets + 1))
+  return [PairBucket(source, target, order[bounds[i]:bounds[i + 1]],
+                     target_suffix) for i in range(num_buckets)]
+
+
+def _read_lines(f, num_lines):
+  """Reads up to num_lines lines, returns (number read, newline-ended data)."""
+  lines = list(itertools.islice(f, num_lines))
+  if lines and not lines[-1].endswith(b"\n"):
+    lines[-1] += b"\n"  # Last line of a file without a trailing newline.
+  return len(lines), b"".join(lines)
+
+
+def _concatenate(parts):
+  """Concatenates the (lengths, tokens) parts of a corpus to an ArrayCorpus."""
+  lengths = np.concatenate([p[0] for p in parts] or
+                           [np.zeros(0, dtype=_OFFSET_DTYPE)])
+  offsets = np.zeros(len(lengths) + 1, dtype=_OFFSET_DTYPE)
+  np.cumsum(lengths, out=offsets[1:])
+  # The parts were narrowed one by one; concatenate widens to the largest.
+  tokens = np.concatenate([p[1] for p in parts] or
+                          [np.zeros(0, dtype=token_dtype(1))])
+  return ArrayCorpus(tokens, offsets)
+
+
+def _narrowed(corpus):
+  """(lengths, tokens) of an ArrayCorpus, tokens in their smallest dtype."""
+  tokens = corpus.tokens
+  vocabulary_size = int(tokens.max()) + 1 if len(tokens) else 1
+  return corpus.lengths(), tokens.astype(token_dtype(vocabulary_size))
+
+
+def line_lengths(path):
+  """Returns the number of ids of every line of a binary or text corpus."""
+  if exists(path):
+    return TokenCorpus(path).lengths()
+  parts = []
+  with corpus_io.open_input(path) as f:
+    while True:
+      num_lines, data = _read_lines(f, _TEXT_CHUNK_LINES)
+      if not num_lines:
+        break
+      parts.append(_parse_text_chunk(data)[0])
+  return np.concatenate(parts or [np.zeros(0, dtype=_OFFSET_DTYPE)])
+
+
+def read_text_pairs(source_path, target_path, buckets, max_size=None,
+                    target_suffix=()):
+  """Reads two aligned text token-id files into buckets.
+
+  Same result as bucket_pairs on the two files, but the files (which may be
+  compressed) are parsed in chunks of lines and only the pairs that fit a
+  bucket are kept in memory.
+
+  Args:
+    source_path: file with one line of space-separated source ids per pair.
+    target_path: file with the target ids, aligned with source_path.
+    buckets: list of (I, O) bucket sizes.
+    max_size: maximum number of pairs to read; if 0 or None, all of them.
+    target_suffix: ids appended to every target, e.g. [EOS_ID].
+
+  Returns:
+    a list with one PairBucket per bucket, over in-memory ArrayCorpus.
+  """
+  source_parts, target_parts, bucket_ids = [], [], []
+  num_lines = 0
+  with corpus_io.open_input(source_path) as source_file:
+    with corpus_io.open_input(target_path) as target_file:
+      while not max_size or num_lines < max_size:
+        chunk_lines = _TEXT_CHUNK_LINES
+        if max_size:
+          chunk_lines = min(chunk_lines, max_size - num_lines)
+        num_source, source_data = _read_lines(source_file, chunk_lines)
+        num_target, target_data = _read_lines(target_file, num_source)
+        if num_target < num_source:
+          # The target file is shorter: drop the unpaired source lines.
+          source_data = b"".join(
+              source_data.splitlines(True)[:num_target])
+        if not num_target:
+          break
+        num_lines += num_target
+        source_lengths, source_tokens = _parse_text_chunk(source_data)
+        target_lengths, target_tokens = _parse_text_chunk(target_data)
+        chunk_ids = assign_buckets(source_lengths,
+                                   target_lengths + len(target_suffix),
+                                   buckets)
+        kept = np.flatnonzero(chunk_ids >= 0)
+        for parts, lengths, tokens in (
+            (source_parts, source_lengths, source_tokens),
+            (target_parts, target_lengths, target_tokens)):
+          offsets = np.zeros(len(lengths) + 1, dtype=_OFFSET_DTYPE)
+          np.cumsum(lengths, out=offsets[1:])
+          parts.append(_narrowed(ArrayCorpus(tokens, offsets).select(kept)))
+        bucket_ids.append(chunk_ids[kept])
+        if num_target < chunk_lines:
+          break
+  return _group_by_bucket(
+      _concatenate(source_parts), _concatenate(target_parts),
+      np.concatenate(bucket_ids or [np.zeros(0, dtype=np.int32)]),
+      len(buckets), target_suffix)
@@ -0,0 +1,343 @@
+"""Exact token counting in bounded memory, and persisted token counts.
+
+Counting a corpus with a dict needs memory proportional to its number of
+distinct tokens. SpillingCounter keeps the counts in a dict only until they
+exceed a memory budget; the dict is then sorted by token, written to a run
+file on disk and started afresh. merge_runs merges the runs with
+heapq.merge, which holds a single block of every run in memory, and
+most_common selects the exact most frequent tokens with a bounded heap. A
+RunBudget sizes the blocks of the runs, the number of runs merged at once
+and the chunks sorted by sorted_runs so that these later phases fit the same
+memory budget, and records their estimated high-water mark.
+
+Every count carries the position of the token's first appearance (byte
+offset of its line, index within the line). Ties are broken by it, exactly
+like the in-memory vocabulary breaks them by order of first appearance, and
+counters of different byte ranges of a file can be merged in any order.
+
+The merged counts of a data file can be saved as a counts file (the same
+token-sorted run format) with a JSON header recording how much of the data
+file they cover and the hash of those bytes. When data is appended to the
+file, only the appended bytes need to be counted: their runs are merged with
+the saved counts.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+# Estimated bytes held by a dict entry besides the token itself: the hash
+# table slot, the [count, offset, position] list and its three ints.
+_ENTRY_OVERHEAD = 232
+# Estimated bytes held by an entry read back from a run: the token, the
+# (token, [count, offset, position]) tuple, its list and their ints.
+_RUN_ENTRY_BYTES = _ENTRY_OVERHEAD + 64
+# Entries pickled together in a run, without a memory budget; smaller
+# budgets make smaller blocks, down to MIN_BLOCK_ENTRIES.
+_RUN_BLOCK_ENTRIES = 10000
+MIN_BLOCK_ENTRIES = 100
+# Most entries of an unsorted counts file sorted at once by sorted_runs.
+_SORT_CHUNK_ENTRIES = 100 * _RUN_BLOCK_ENTRIES
+# Most runs merged at once; more are first merged in groups, which bounds
+# the number of open files and of blocks held in memory.
+_MAX_MERGE_FAN_IN = 128
+_HEADER_SUFFIX = ".json"
+# Version 1 headers only hashed the end of the counted data.
+_HEADER_VERSION = 2
+_HASH_BLOCK_BYTES = 1 << 20
+
+
+class RunBudget(object):
+  """Sizes of the run blocks, merges and sorts fitting a memory budget.
+
+  Merging holds one block of every merged run plus the block being written,
+  sorting a chunk holds the chunk plus the block it is read from. Blocks are
+  made small enough for _MAX_MERGE_FAN_IN runs to be merged at once, but no
+  smaller than MIN_BLOCK_ENTRIES: tighter budgets merge fewer runs at
+  a time (at least 2) instead.
+  """
+
+  def __init__(self, max_memory_bytes=float("inf")):
+    """Create the budget.
+
+    Args:
+      max_memory_bytes: estimated size of the entries the merges and sorts
+        may hold at once; infinite by default.
+    """
+    # Division, not //: float("inf") // n is nan.
+    entries = max_memory_bytes / _RUN_ENTRY_BYTES
+    self.max_memory_bytes = max_memory_bytes
+    self.block_entries = int(min(max(entries / (_MAX_MERGE_FAN_IN + 1),
+                                     MIN_BLOCK_ENTRIES),
+                                 _RUN_BLOCK_ENTRIES))
+    self.fan_in = int(min(max(entries / self.block_entries - 1, 2),
+                          _MAX_MERGE_FAN_IN))
+    self.sort_chunk_entries = int(min(max(entries - self.block_entries,
+                                          self.block_entries),
+                                      _SORT_CHUNK_ENTRIES))
+    self.peak_memory_bytes = 0
+
+  def hold(self, entries):
+    """Records that `entries` run entries are held in memory at once."""
+    self.peak_memory_bytes = max(self.peak_memory_bytes,
+                                 entries * _RUN_ENTRY_BYTES)
+
+
+def _write_run(entries, spill_dir, block_entries=_RUN_BLOCK_ENTRIES):
+  """Writes (token, [count, offset, position]) entries sorted by token."""
+  fd, path = tempfile.mkstemp(suffix=".run", dir=spill_dir)
+  with os.fdopen(fd, "wb") as f:
+    block = []
+    for entry in entries:
+      block.append(entry)
+      if len(block) == block_entries:
+        pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+        block = []
+    if block:
+      pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+  return path
+
+
+class SpillingCounter(object):
+  """Counts tokens, spilling partial counts to disk past a memory budget."""
+
+  def __init__(self, max_memory_bytes, spill_dir,
+               block_entries=_RUN_BLOCK_ENTRIES):
+    """Create the counter.
+
+    Args:
+      max_memory_bytes: estimated size of the in-memory counts that triggers
+        a spill to disk.
+      spill_dir: directory the run files are written to.
+      block_entries: entries per block of the runs (RunBudget.block_entries
+        of the budget they will be merged in).
+    """
+    self.max_memory_bytes = max_memory_bytes
+    self.spill_dir = spill_dir
+    self.block_entries = block_entries
+    self.runs = []
+    self.memory_bytes = 0
+    self.peak_memory_bytes = 0
+    self._counts = {}
+
+  def update(self, tokens, line_offset):
+    """Counts the tokens of the line starting at byte `line_offset`."""
+    counts = self._counts
+    added = 0
+    for position, token in enumerate(tokens):
+      entry = counts.get(token)
+      if entry is None:
+        counts[token] = [1, line_offset, position]
+        added += sys.getsizeof(token) + _ENTRY_OVERHEAD
+      else:
+        entry[0] += 1
+    self.memory_bytes += added
+    self.peak_memory_bytes = max(self.peak_memory_bytes, self.memory_bytes)
+    if self.memory_bytes > self.max_memory_bytes:
+      self.spill()
+
+  def spill(self):
+    """Writes the in-memory counts to a new run file, sorted by token."""
+    if not self._counts:
+      return
+    self.runs.append(_write_run(sorted(self._counts.items()), self.spill_dir,
+                                self.block_entries))
+    self._counts = {}
+    self.memory_bytes = 0
+
+  def finish(self):
+    """Spills the remaining counts and returns the paths of all runs."""
+    self.spill()
+    return self.runs
+
+
+def _read_run(path):
+  with open(path, "rb") as f:
+    while True:
+      try:
+        block = pickle.load(f)
+      except EOFError:
+        return
+      for entry in block:
+        yield entry
+
+
+def _merge_entries(runs):
+  """Yields (token, count, first_offset, first_position) in token order."""
+  merged = heapq.merge(*[_read_run(path) for path in runs])
+  current, count, first = None, 0, None
+  for token, (token_count, offset, position) in merged:
+    if token == current:
+      count += token_count
+      first = min(first, (offset, position))
+      continue
+    if current is not None:
+      yield (current, count) + first
+    current, count, first = token, token_count, (offset, position)
+  if current is not None:
+    yield (current, count) + first
+
+
+def merge_runs(runs, spill_dir, budget=None):
+  """Yields (token, count, first_offset, first_position) in token order.
+
+  Beyond budget.fan_in runs, groups of runs are first merged into
+  intermediate runs in spill_dir. The input runs are left in place; they
+  must have been written in blocks of budget.block_entries at most.
+  """
+  budget = budget or RunBudget()
+  runs = list(runs)
+  intermediate = set()
+  while len(runs) > budget.fan_in:
+    group, runs = runs[:budget.fan_in], runs[budget.fan_in:]
+    budget.hold((len(group) + 1) * budget.block_entries)
+    path = _write_run(
+        ((token, [count, offset, position])
+         for token, count, offset, position in _merge_entries(group)),
+        spill_dir, budget.block_entries)
+    runs.append(path)
+    for done in intermediate.intersection(group):
+      os.remove(done)
+    intermediate.add(path)
+  # The last merge is consumed by the caller, who writes it out in blocks.
+  budget.hold((len(runs) + 1) * budget.block_entries)
+  return _merge_entries(runs)
+
+
+def write_counts(path, entries, block_entries=_RUN_BLOCK_ENTRIES):
+  """Saves (token, count, first_offset, first_position) entries.
+
+  Entries sorted by token make the file a run, which can be merged with
+  the runs of newly counted data as it is; unsorted ones are sorted by
+  sorted_runs when that is needed (record which, and block_entries, in the
+  header).
+  """
+  directory = os.path.dirname(os.path.abspath(path))
+  tmp_path = _write_run(((token, [count, offset, position])
+                         for token, count, offset, position in entries),
+                        directory, block_entries)
+  os.replace(tmp_path, path)
+
+
+def read_counts(path):
+  """Yields the (token, count, first_offset, first_position) of a counts file."""
+  for token, (count, offset, position) in _read_run(path):
+    yield token, count, offset, position
+
+
+def sorted_runs(path, spill_dir, budget=None):
+  """Returns runs, mergeable by merge_runs, of the entries of a counts file.
+
+  A file saved token-sorted (header "token_sorted") in blocks small enough
+  for the budget (header "block_entries") is a run itself; one saved in
+  larger blocks is copied to a run of smaller ones. The entries of an
+  unsorted file are sorted in chunks of budget.sort_chunk_entries, each
+  written to a run in spill_dir.
+  """
+  budget = budget or RunBudget()
+  header = load_header(path) or {}
+  file_block_entries = header.get("block_entries", _RUN_BLOCK_ENTRIES)
+  if header.get("token_sorted", True):
+    if file_block_entries <= budget.block_entries:
+      return [path]
+    budget.hold(file_block_entries + budget.block_entries)
+    return [_write_run(_read_run(path), spill_dir, budget.block_entries)]
+  runs = []
+  entries = _read_run(path)
+  while True:
+    chunk = list(itertools.islice(entries, budget.sort_chunk_entries))
+    if not chunk:
+      return runs
+    budget.hold(len(chunk) + file_block_entries)
+    chunk.sort()
+    runs.append(_write_run(chunk, spill_dir, budget.block_entries))
+
+
+def prefix_digest(data_path, data_bytes):
+  """sha256 of the first data_bytes of a file.
+
+  The whole counted prefix is hashed: any change to it, even one that keeps
+  the file size, makes the saved counts unusable.
+  """
+  digest = hashlib.sha256()
+  with open(data_path, "rb") as f:
+    remaining = data_bytes
+    while remaining > 0:
+      block = f.read(min(remaining, _HASH_BLOCK_BYTES))
+      if not block:
+        break
+      digest.update(block)
+      remaining -= len(block)
+  return digest.hexdigest()
+
+
+def save_header(counts_path, header):
+  """Writes the JSON header describing what a counts file covers."""
+  header = dict(header, version=_HEADER_VERSION)
+  tmp_path = counts_path + _HEADER_SUFFIX + ".tmp%d" % os.getpid()
+  with open(tmp_path, "w") as f:
+    json.dump(header, f, sort_keys=True)
+  os.replace(tmp_path, counts_path + _HEADER_SUFFIX)
+
+
+def load_header(counts_path):
+  """Returns the header of a counts file, None if there is no usable one."""
+  if not (os.path.exists(counts_path) and
+          os.path.exists(counts_path + _HEADER_SUFFIX)):
+    return None
+  with open(counts_path + _HEADER_SUFFIX) as f:
+    header = json.load(f)
+  if header.get("version") != _HEADER_VERSION:
+    return None
+  return header
+
+
+def most_common(entries, n, budget=None):
+  """Returns the n most frequent tokens and the number of distinct tokens.
+
+  Args:
+    entries: iterable of (token, count, first_offset, first_position), as
+      yielded by merge_runs or read_counts.
+    n: number of tokens to return.
+    budget: optional RunBudget recording the entries held: the heap of
+      the n tokens (which the budget does not bound) and a block of
+      entries.
+
+  Tokens are ordered by descending count, ties by first appearance, like
+  data_utils._top_vocabulary orders the in-memory counts.
+  """
+  heap = []
+  num_distinct = 0
+  for token, count, offset, position in entries:
+    num_distinct += 1
+    item = (count, -offset, -position, token)
+    if len(heap) < n:
+      heapq.heappush(heap, item)
+    elif n > 0 and item > heap[0]:
+      heapq.heapreplace(heap, item)
+  if budget is not None:
+    budget.hold(len(heap) + budget.block_entries)
+  heap.sort(reverse=True)
+  return [item[3] for item in heap], num_distinct
+
+
+def peak_rss_bytes():
+  """Peak resident set size of this process, None if it cannot be measured."""
+  if resource is None:
+    return None
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+  scale = 1 if sys.platform == "darwin" else 1024
+  return scale * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
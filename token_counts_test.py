@@ -0,0 +1,63 @@
+"""Tests for token_counts."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import token_counts
+
+
+class RunBudgetTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def _lines(self):
+    for i in range(300):
+      yield ["w%d" % ((i * 7 + j) % 5000) for j in range(40)] + ["the"]
+
+  def testMergesKeepToTheBudget(self):
+    max_memory_bytes = 256 << 10
+    budget = token_counts.RunBudget(max_memory_bytes)
+    counter = token_counts.SpillingCounter(16 << 10, self.scratch,
+                                           budget.block_entries)
+    expected = {}
+    for offset, tokens in enumerate(self._lines()):
+      counter.update(tokens, offset)
+      for token in tokens:
+        expected[token] = expected.get(token, 0) + 1
+    runs = counter.finish()
+    # Enough runs for intermediate merges.
+    self.assertGreater(len(runs), budget.fan_in)
+
+    merged = dict((token, count) for token, count, _, _ in
+                  token_counts.merge_runs(runs, self.scratch, budget))
+    self.assertEqual(expected, merged)
+    self.assertGreater(budget.peak_memory_bytes, 0)
+    self.assertLessEqual(budget.peak_memory_bytes, max_memory_bytes)
+
+  def testUnsortedCountsAreSortedInChunksOfTheBudget(self):
+    budget = token_counts.RunBudget(256 << 10)
+    path = os.path.join(self.scratch, "counts")
+    entries = [("w%d" % (i * 7919 % 5000), 1, 0, i) for i in range(5000)]
+    token_counts.write_counts(path, entries, token_counts.MIN_BLOCK_ENTRIES)
+    token_counts.save_header(path, {
+        "token_sorted": False,
+        "block_entries": token_counts.MIN_BLOCK_ENTRIES})
+
+    runs = token_counts.sorted_runs(path, self.scratch, budget)
+    self.assertEqual(-(-len(entries) // budget.sort_chunk_entries), len(runs))
+    self.assertEqual(sorted(entries),
+                     list(token_counts.merge_runs(runs, self.scratch, budget)))
+    self.assertLessEqual(budget.peak_memory_bytes, 256 << 10)
+
+
+if __name__ == "__main__":
+  unittest.main()
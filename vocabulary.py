@@ -0,0 +1,191 @@
+"""Compact, memory-mapped vocabulary for the decoders.
+
+initialize_vocabulary builds a Python dict and list of every word each time
+a process starts. Vocabulary instead keeps the words in fixed-width byte
+arrays stored next to the vocabulary file:
+
+  <vocab>.rev.npy   words in id order (id -> word)
+  <vocab>.keys.npy  the same words sorted bytewise (word -> position)
+  <vocab>.ids.npy   int32 id of every entry of keys
+  <vocab>.long.npy  (id, word) of the words longer than _MAX_WORD_BYTES
+
+The arrays are only as wide as the longest word up to _MAX_WORD_BYTES, so a
+few very long tokens (URLs, ...) do not widen every entry: they are left out
+of keys, truncated in rev, and kept whole in the small long table, which is
+read into dicts. They are built once and then opened with
+np.load(mmap_mode="r"), so loading is near-instant and all the decode
+workers of a host share one copy through the page cache. Lookups are
+vectorized with np.searchsorted.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+import data_utils
+
+_INDEX_SUFFIXES = (".keys.npy", ".ids.npy", ".rev.npy", ".long.npy")
+# Widest entry of the fixed-width arrays; longer words go to the long table.
+_MAX_WORD_BYTES = 64
+
+
+def _as_bytes(word):
+  if isinstance(word, bytes):
+    return word
+  return word.encode("utf-8")
+
+
+def _index_is_fresh(vocabulary_path):
+  vocab_mtime = os.path.getmtime(vocabulary_path)
+  for suffix in _INDEX_SUFFIXES:
+    path = vocabulary_path + suffix
+    if not os.path.exists(path) or os.path.getmtime(path) < vocab_mtime:
+      return False
+  return True
+
+
+def build_index(vocabulary_path):
+  """Writes the lookup index files of a vocabulary file."""
+  with open(vocabulary_path, "rb") as f:
+    words = [line.strip() for line in f]
+  lengths = np.array([len(w) for w in words], dtype=np.int64)
+  width = min(max(lengths.tolist() + [1]), _MAX_WORD_BYTES)
+  # numpy truncates the words longer than width.
+  rev = np.array(words, dtype="S%d" % width)
+  short = np.flatnonzero(lengths <= width).astype(np.int32)
+  # Stable sort: among duplicate words the last id comes last, which is the
+  # one initialize_vocabulary's dict keeps.
+  order = short[np.argsort(rev[short], kind="mergesort")]
+  long_ids = np.flatnonzero(lengths > width)
+  long_words = np.array(
+      [(i, words[i]) for i in long_ids],
+      dtype=[("id", np.int32),
+             ("word", "S%d" % max(lengths[long_ids].tolist() + [1]))])
+  for suffix, array in zip(_INDEX_SUFFIXES,
+                           (rev[order], order, rev, long_words)):
+    tmp_path = "%s%s.tmp%d" % (vocabulary_path, suffix, os.getpid())
+    with open(tmp_path, "wb") as f:
+      np.save(f, array)
+    os.replace(tmp_path, vocabulary_path + suffix)
+
+
+class Vocabulary(object):
+  """Word <-> id mapping backed by memory-mapped arrays.
+
+  Accepts str and utf-8 bytes words alike and always returns str words. The
+  mapping methods (get, [], in, len) make it a drop-in replacement for the
+  dict returned by initialize_vocabulary.
+  """
+
+  def __init__(self, keys, ids, rev, long_words, tokenizer=None,
+               normalize_digits=True):
+    self._keys = keys
+    self._ids = ids
+    self._rev = rev
+    # Words longer than the arrays' width, in id order so that the last of
+    # duplicate words wins, as in initialize_vocabulary.
+    self._long_ids = {}
+    self._long_words = {}
+    for word_id, word in zip(long_words["id"].tolist(),
+                             long_words["word"].tolist()):
+      self._long_ids[word] = word_id
+      self._long_words[word_id] = word
+    self._tokenizer = data_utils.BatchTokenizer(
+        tokenizer=tokenizer, normalize_digits=normalize_digits)
+
+  @classmethod
+  def load(cls, vocabulary_path, tokenizer=None, normalize_digits=True):
+    """Opens a vocabulary, building its index first if it is out of date.
+
+    Args:
+      vocabulary_path: path to the vocabulary file.
+      tokenizer: a function to use to tokenize each sentence in encode;
+        if None, basic_tokenizer will be used.
+      normalize_digits: Boolean; if true, all digits are replaced by 0s.
+
+    Raises:
+      ValueError: if the vocabulary file does not exist.
+    """
+    if not os.path.exists(vocabulary_path):
+      raise ValueError("Vocabulary file %s not found." % vocabulary_path)
+    if not _index_is_fresh(vocabulary_path):
+      build_index(vocabulary_path)
+    keys, ids, rev, long_words = [
+        np.load(vocabulary_path + suffix, mmap_mode="r")
+        for suffix in _INDEX_SUFFIXES]
+    return cls(keys, ids, rev, long_words, tokenizer, normalize_digits)
+
+  def __len__(self):
+    return len(self._rev)
+
+  def _find(self, words):
+    """Returns the int32 ids of words, -1 for words not in the vocabulary."""
+    if len(words) == 0:
+      return np.zeros(0, dtype=np.int32)
+    encoded = [_as_bytes(w) for w in words]
+    queries = np.array(encoded, dtype=self._keys.dtype)
+    # Words longer than the longest entry would be truncated by numpy; they
+    # can only be in the long table.
+    too_long = np.array([len(w) for w in encoded]) > self._keys.dtype.itemsize
+    positions = np.searchsorted(self._keys, queries, side="right") - 1
+    found = (positions >= 0) & ~too_long
+    positions = np.maximum(positions, 0)
+    found &= self._keys[positions] == queries
+    ids = np.where(found, self._ids[positions], -1).astype(np.int32)
+    if self._long_ids:
+      for i in np.flatnonzero(too_long):
+        ids[i] = self._long_ids.get(encoded[i], -1)
+    return ids
+
+  def lookup(self, words):
+    """Maps a sequence of words to an int32 array of ids (UNK_ID if unknown)."""
+    ids = self._find(words)
+    ids[ids < 0] = data_utils.UNK_ID
+    return ids
+
+  def get(self, word, default=None):
+    word_id = int(self._find([word])[0])
+    return default if word_id < 0 else word_id
+
+  def __getitem__(self, word):
+    word_id = self.get(word)
+    if word_id is None:
+      raise KeyError(word)
+    return word_id
+
+  def __contains__(self, word):
+    return self.get(word) is not None
+
+  def encode(self, lines):
+    """Tokenizes a batch of lines and maps them to token-ids.
+
+    Returns:
+      a list with one int32 array of token-ids per line.
+    """
+    words = self._tokenizer.tokenize_batch(lines)
+    if not words:
+      return []
+    ids = self.lookup([w for line in words for w in line])
+    return np.split(ids, np.cumsum([len(line) for line in words])[:-1])
+
+  def decode(self, id_matrix):
+    """Maps token-ids back to words.
+
+    Args:
+      id_matrix: a sequence of ids, or a batch (list or 2-D array) of them.
+
+    Returns:
+      a list of str words for a single sequence, a list of such lists for
+      a batch.
+    """
+    if len(id_matrix) and np.ndim(id_matrix[0]) == 0:
+      ids = np.asarray(id_matrix, dtype=np.int64)
+      words = self._rev[ids].tolist()
+      if self._long_words:
+        words = [self._long_words.get(word_id, w)
+                 for word_id, w in zip(ids.tolist(), words)]
+      return [w.decode("utf-8") for w in words]
+    return [self.decode(ids) for ids in id_matrix]
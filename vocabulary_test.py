@@ -0,0 +1,47 @@
+"""Tests for vocabulary."""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import vocabulary
+
+
+class LongWordsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scratch = tempfile.mkdtemp()
+    self.vocab_path = os.path.join(self.scratch, "vocab.txt")
+    self.url = "http://example.com/" + "a" * 200
+    self.words = ["_PAD", "_GO", "_EOS", "_UNK", "the", self.url,
+                  self.url[:vocabulary._MAX_WORD_BYTES], "fox", self.url]
+    with open(self.vocab_path, "w") as f:
+      f.write("\n".join(self.words) + "\n")
+
+  def tearDown(self):
+    shutil.rmtree(self.scratch)
+
+  def testLongWordsDoNotWidenTheArrays(self):
+    vocab = vocabulary.Vocabulary.load(self.vocab_path)
+    for suffix in (".keys.npy", ".rev.npy"):
+      array = np.load(self.vocab_path + suffix, mmap_mode="r")
+      self.assertEqual(vocabulary._MAX_WORD_BYTES, array.dtype.itemsize)
+    self.assertEqual(len(self.words), len(vocab))
+
+  def testLongWordsMapLikeADict(self):
+    vocab = vocabulary.Vocabulary.load(self.vocab_path)
+    expected = dict((w, i) for i, w in enumerate(self.words))
+    queries = self.words + [self.url + "b", self.url[:100], "cat"]
+    self.assertEqual([expected.get(w, 3) for w in queries],
+                     vocab.lookup(queries).tolist())
+    self.assertEqual(self.words, vocab.decode(list(range(len(self.words)))))
+
+
+if __name__ == "__main__":
+  unittest.main()